@@ -16,6 +16,7 @@ __all__ = ["admin", "directory", "disk", "iwd", "mdns_discovery", "modules", "up
 from . import (
     backups,
     clan,
+    eval_server,
     history,
     secrets,
     select,
@@ -403,6 +404,30 @@ Examples:
     )
     select.register_parser(parser_select)
 
+    parser_eval_server = subparsers.add_parser(
+        "eval-server",
+        help="Run a local cache of machine evaluation and build results",
+        description="Run a local cache of machine evaluation and build results",
+        epilog=(
+            """
+This subcommand starts a long running process that answers machine evaluation
+and build requests of other clan commands over a unix socket.
+Results are kept in memory until the narHash of the flake changes.
+Requests that are not cached yet start nix, like the command would have done.
+
+Set CLAN_EVAL_SERVER to the socket path to use a non default socket,
+or to 0 to never use the eval server.
+
+Examples:
+
+  $ clan eval-server
+  Listen on the default socket until interrupted.
+        """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    eval_server.register_parser(parser_eval_server)
+
     parser_state = subparsers.add_parser(
         "state",
         aliases=["st"],
@@ -30,6 +30,7 @@ Note: This module assumes the presence of other modules and classes such as `Cla
 """
 
 import dataclasses
+from collections.abc import Callable
 from dataclasses import dataclass, fields, is_dataclass
 from enum import Enum
 from pathlib import Path
@@ -92,17 +93,26 @@ def dataclass_to_dict(obj: Any, *, use_alias: bool = True) -> Any:
 
         It does NOT convert member functions.
         """
+        # Fast path for the json primitives, subclasses (i.e. StrEnum) take the slow path
+        obj_type = type(obj)
+        if obj_type is str:
+            return sanitize_string(obj)
+        if obj_type in _PRIMITIVE_TYPES:
+            return obj
+        if obj_type is list:
+            return [_to_dict(item) for item in obj]
+        if obj_type is dict:
+            return {sanitize_string(k): _to_dict(v) for k, v in obj.items()}
+
         if is_enum(obj):
             return get_enum_value(obj)
         if is_dataclass(obj):
+            dataclass_type = obj if isinstance(obj, type) else obj_type
             return {
                 # Use either the original name or name
-                sanitize_string(
-                    field.metadata.get("alias", field.name) if use_alias else field.name
-                ): _to_dict(getattr(obj, field.name))
-                for field in fields(obj)
-                if not field.name.startswith("_")
-                and getattr(obj, field.name) is not None  # type: ignore
+                key: _to_dict(value)
+                for name, key in _dataclass_keys(dataclass_type, use_alias)
+                if (value := getattr(obj, name)) is not None
             }
         if isinstance(obj, list | tuple | set):
             return [_to_dict(item) for item in obj]
@@ -117,6 +127,33 @@ def dataclass_to_dict(obj: Any, *, use_alias: bool = True) -> Any:
     return _to_dict(obj)
 
 
+_PRIMITIVE_TYPES = frozenset({int, float, bool, type(None)})
+
+
+_dataclass_keys_cache: dict[tuple[type, bool], tuple[tuple[str, str], ...]] = {}
+
+
+def _dataclass_keys(t: type, use_alias: bool) -> tuple[tuple[str, str], ...]:
+    """
+    The public fields of a dataclass and the key they are serialized as.
+    """
+    keys = _dataclass_keys_cache.get((t, use_alias))
+    if keys is not None:
+        return keys
+    keys = tuple(
+        (
+            field.name,
+            sanitize_string(
+                field.metadata.get("alias", field.name) if use_alias else field.name
+            ),
+        )
+        for field in fields(t)
+        if not field.name.startswith("_")
+    )
+    _dataclass_keys_cache[(t, use_alias)] = keys
+    return keys
+
+
 T = TypeVar("T", bound=dataclass)  # type: ignore
 
 
@@ -151,118 +188,356 @@ def unwrap_none_type(type_hint: type | UnionType) -> type:
 
 JsonValue = str | float | dict[str, Any] | list[Any] | None
 
+# Constructs a value from json, the second argument is the location for error messages
+Constructor = Callable[[Any, list[str]], Any]
 
-def construct_value(
-    t: type | UnionType, field_value: JsonValue, loc: list[str] | None = None
-) -> Any:
+# Nested values are constructed without a location
+_NO_LOC: list[str] = []
+
+_constructors: dict[tuple[Any, str], Constructor] = {}
+
+
+def value_constructor(t: type | UnionType | None) -> Constructor:
     """
-    Construct a field value from a type hint and a field value.
+    Returns the constructor for a type hint.
+    The type hint is resolved once, nested type hints are resolved into
+    their own constructors, so construct_value only dispatches on the type
+    hint the first time it sees it.
     """
-    if loc is None:
-        loc = []
-    if t is None and field_value:
-        msg = f"Trying to construct field of type None. But got: {field_value}. loc: {loc}"
-        raise ClanError(msg, location=f"{loc}")
+    # Equal type hints can still differ in their order, i.e. 'int | str' == 'str | int'
+    key = (t, repr(t))
+    try:
+        return _constructors[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable type hint, i.e. Annotated with a dict
+        return _compile_value(t)
+    constructor = _compile_value(t)
+    _constructors[key] = constructor
+    return constructor
+
+
+def _unhandled(t: Any) -> Constructor:
+    def construct(field_value: Any, loc: list[str]) -> Any:
+        msg = f"Unhandled field type {t} with value {field_value}"
+        raise ClanError(msg)
 
-    if is_type_in_union(t, type(None)) and field_value is None:
+    return construct
+
+
+def _compile_value(t: Any) -> Constructor:
+    """
+    Resolve a type hint into a constructor.
+    Checks on the type hint run once here,
+    checks that depend on the value are done by the returned closure.
+    """
+    if t is None:
+
+        def construct_none(field_value: Any, loc: list[str]) -> Any:
+            if field_value:
+                msg = f"Trying to construct field of type None. But got: {field_value}. loc: {loc}"
+                raise ClanError(msg, location=f"{loc}")
+            msg = f"Unhandled field type {t} with value {field_value}"
+            raise ClanError(msg)
+
+        return construct_none
+
+    try:
+        construct = _compile_non_null(t)
+        nullable = is_type_in_union(t, type(None))
+    except TypeError:
+        # issubclass() fails on some union members, i.e. 'Literal["a"] | None'.
+        # Only fail once a value actually reaches the failing check.
+        def construct_invalid(field_value: Any, loc: list[str]) -> Any:
+            if is_type_in_union(t, type(None)) and field_value is None:
+                return None
+            return _compile_non_null(t)(field_value, loc)
+
+        return construct_invalid
+
+    if not nullable:
+        return construct
+
+    def construct_nullable(field_value: Any, loc: list[str]) -> Any:
         # Sometimes the field value is None, which is valid if the type hint allows None
-        return None
+        if field_value is None:
+            return None
+        return construct(field_value, loc)
+
+    return construct_nullable
 
+
+def _compile_non_null(t: Any) -> Constructor:
     # If the field is another dataclass
     # Field_value must be a dictionary
-    if is_dataclass(t) and isinstance(field_value, dict):
+    if is_dataclass(t):
         assert isinstance(t, type)
-        return construct_dataclass(t, field_value)
+        construct_instance = dataclass_constructor(t)
+        fallback = _compile_enum(t)
+
+        def construct_dataclass_value(field_value: Any, loc: list[str]) -> Any:
+            if isinstance(field_value, dict):
+                return construct_instance(field_value, _NO_LOC)
+            return fallback(field_value, loc)
+
+        return construct_dataclass_value
 
     # If the field expects a path
     # Field_value must be a string
     if is_type_in_union(t, Path):
-        if not isinstance(field_value, str):
-            msg = (
-                f"Expected string, cannot construct pathlib.Path() from: {field_value} "
-            )
-            raise ClanError(
-                msg,
-                location=f"{loc}",
-            )
 
-        return Path(field_value)
+        def construct_path(field_value: Any, loc: list[str]) -> Any:
+            if not isinstance(field_value, str):
+                msg = f"Expected string, cannot construct pathlib.Path() from: {field_value} "
+                raise ClanError(
+                    msg,
+                    location=f"{loc}",
+                )
+            return Path(field_value)
+
+        return construct_path
 
     if t is str:
-        if not isinstance(field_value, str):
-            msg = f"Expected string, got {field_value}"
-            raise ClanError(msg, location=f"{loc}")
 
-        return field_value
+        def construct_str(field_value: Any, loc: list[str]) -> Any:
+            if not isinstance(field_value, str):
+                msg = f"Expected string, got {field_value}"
+                raise ClanError(msg, location=f"{loc}")
+            return field_value
+
+        return construct_str
+
+    if t is int or t is float:
+        number = t
+        unhandled = _unhandled(t)
 
-    if t is int and not isinstance(field_value, str):
-        return int(field_value)  # type: ignore
-    if t is float and not isinstance(field_value, str):
-        return float(field_value)  # type: ignore
-    if t is bool and isinstance(field_value, bool):
-        return field_value  # type: ignore
+        def construct_number(field_value: Any, loc: list[str]) -> Any:
+            if isinstance(field_value, str):
+                return unhandled(field_value, loc)
+            return number(field_value)
+
+        return construct_number
+
+    if t is bool:
+        unhandled = _unhandled(t)
+
+        def construct_bool(field_value: Any, loc: list[str]) -> Any:
+            if isinstance(field_value, bool):
+                return field_value
+            return unhandled(field_value, loc)
+
+        return construct_bool
 
     # Union types construct the first non-None type
     if is_union_type(t):
-        # Unwrap the union type
-        inner = unwrap_none_type(t)
-        # Construct the field value
-        return construct_value(inner, field_value)
+        inner = value_constructor(unwrap_none_type(t))
+
+        def construct_union(field_value: Any, loc: list[str]) -> Any:
+            return inner(field_value, _NO_LOC)
+
+        return construct_union
 
     # Nested types
     # list
     # dict
     origin = get_origin(t)
     if origin is list:
-        if not isinstance(field_value, list):
-            msg = f"Expected list, got {field_value}"
-            raise ClanError(msg, location=f"{loc}")
-
-        return [construct_value(get_args(t)[0], item) for item in field_value]
-    if origin is dict and isinstance(field_value, dict):
-        return {
-            key: construct_value(get_args(t)[1], value)
-            for key, value in field_value.items()
-        }
+        construct_item = value_constructor(get_args(t)[0])
+
+        def construct_list(field_value: Any, loc: list[str]) -> Any:
+            if not isinstance(field_value, list):
+                msg = f"Expected list, got {field_value}"
+                raise ClanError(msg, location=f"{loc}")
+            return [construct_item(item, _NO_LOC) for item in field_value]
+
+        return construct_list
+
+    if origin is dict:
+        construct_dict_value = value_constructor(get_args(t)[1])
+        unhandled = _unhandled(t)
+
+        def construct_dict(field_value: Any, loc: list[str]) -> Any:
+            if not isinstance(field_value, dict):
+                return unhandled(field_value, loc)
+            return {
+                key: construct_dict_value(value, _NO_LOC)
+                for key, value in field_value.items()
+            }
+
+        return construct_dict
+
     if origin is Literal:
         valid_values = get_args(t)
-        if field_value not in valid_values:
-            msg = f"Expected one of {', '.join(valid_values)}, got {field_value}"
-            raise ClanError(msg, location=f"{loc}")
-        return field_value
+
+        def construct_literal(field_value: Any, loc: list[str]) -> Any:
+            if field_value not in valid_values:
+                msg = f"Expected one of {', '.join(valid_values)}, got {field_value}"
+                raise ClanError(msg, location=f"{loc}")
+            return field_value
+
+        return construct_literal
 
     # Enums
     if origin is Enum:
-        try:
-            return t(field_value)  # type: ignore
-        except ValueError:
-            msg = f"Expected one of {', '.join(str(origin))}, got {field_value}"
-            raise ClanError(msg, location=f"{loc}") from ValueError
 
+        def construct_enum_origin(field_value: Any, loc: list[str]) -> Any:
+            try:
+                return t(field_value)
+            except ValueError:
+                msg = f"Expected one of {', '.join(str(origin))}, got {field_value}"
+                raise ClanError(msg, location=f"{loc}") from ValueError
+
+        return construct_enum_origin
+
+    return _compile_enum(t)
+
+
+def _compile_enum(t: Any) -> Constructor:
     if isinstance(t, type) and issubclass(t, Enum):
-        try:
-            return t(field_value)  # type: ignore
-        except ValueError:
-            msg = f"Expected one of {', '.join(t.__members__)}, got {field_value}"
-            raise ClanError(msg, location=f"{loc}") from ValueError
+        enum_type = t
+
+        def construct_enum(field_value: Any, loc: list[str]) -> Any:
+            try:
+                return enum_type(field_value)
+            except ValueError:
+                msg = f"Expected one of {', '.join(enum_type.__members__)}, got {field_value}"
+                raise ClanError(msg, location=f"{loc}") from ValueError
+
+        return construct_enum
 
-    if origin is Annotated:
-        (base_type,) = get_args(t)
-        return construct_value(base_type, field_value)
+    if get_origin(t) is Annotated:
+        args = get_args(t)
+
+        def construct_annotated(field_value: Any, loc: list[str]) -> Any:
+            (base_type,) = args
+            return value_constructor(base_type)(field_value, _NO_LOC)
+
+        return construct_annotated
 
     # elif get_origin(t) is Union:
     if t is Any:
-        return field_value
+
+        def construct_any(field_value: Any, loc: list[str]) -> Any:
+            return field_value
+
+        return construct_any
 
     if is_typeddict(t):
-        if not isinstance(field_value, dict):
-            msg = f"Expected TypedDict {t}, got {field_value}"
-            raise ClanError(msg, location=f"{loc}")
 
-        return t(field_value)  # type: ignore
+        def construct_typeddict(field_value: Any, loc: list[str]) -> Any:
+            if not isinstance(field_value, dict):
+                msg = f"Expected TypedDict {t}, got {field_value}"
+                raise ClanError(msg, location=f"{loc}")
+            return t(field_value)
+
+        return construct_typeddict
+
+    return _unhandled(t)
+
+
+def construct_value(
+    t: type | UnionType, field_value: JsonValue, loc: list[str] | None = None
+) -> Any:
+    """
+    Construct a field value from a type hint and a field value.
+    """
+    if loc is None:
+        loc = []
+    return value_constructor(t)(field_value, loc)
+
+
+def _is_nullable(type_hint: Any) -> bool | None:
+    """
+    Whether None is a valid value for a field,
+    None if that can only be checked (and fail) once the value is None.
+    """
+    try:
+        return type_hint is None or is_type_in_union(type_hint, type(None))
+    except TypeError:
+        return None
+
 
-    msg = f"Unhandled field type {t} with value {field_value}"
-    raise ClanError(msg)
+# name, key in the data, type hint, whether it is nullable and the constructor of a field
+_FieldSpec = tuple[str, str, Any, bool | None, Constructor]
+
+
+_dataclass_constructors: dict[type, Constructor] = {}
+
+
+def dataclass_constructor(t: type) -> Constructor:
+    """
+    type t MUST be a dataclass
+    Returns the constructor for the dataclass t.
+    The fields are resolved on the first call,
+    so that dataclasses can refer to themselves.
+    """
+    constructor = _dataclass_constructors.get(t)
+    if constructor is None:
+        constructor = _dataclass_constructors[t] = _compile_dataclass(t)
+    return constructor
+
+
+def _compile_dataclass(t: type) -> Constructor:
+    resolved: tuple[list[_FieldSpec], list[str]] | None = None
+
+    def resolve() -> tuple[list[_FieldSpec], list[str]]:
+        specs: list[_FieldSpec] = []
+        required: list[str] = []
+        for field in fields(t):
+            if field.name.startswith("_"):
+                continue
+            if (
+                field.default is dataclasses.MISSING
+                and field.default_factory is dataclasses.MISSING
+            ):
+                required.append(field.name)
+            # The first type in a Union
+            # str <- None | str | Path
+            field_type = unwrap_none_type(field.type)  # type: ignore
+            specs.append(
+                (
+                    field.name,
+                    field.metadata.get("alias", field.name),
+                    field.type,
+                    _is_nullable(field.type),
+                    value_constructor(field_type),
+                )
+            )
+        return specs, required
+
+    def construct(data: dict[str, Any], path: list[str]) -> Any:
+        nonlocal resolved
+        if resolved is None:
+            resolved = resolve()
+        specs, required = resolved
+
+        # Attempt to create an instance of the data_class#
+        field_values: dict[str, Any] = {}
+        for name, data_field_name, type_hint, nullable, construct_field in specs:
+            # Populate the field_values dictionary with the field value
+            # if present in the data
+            if data_field_name in data:
+                field_value = data[data_field_name]
+                if field_value is None and (
+                    nullable
+                    if nullable is not None
+                    else is_type_in_union(type_hint, type(None))
+                ):
+                    field_values[name] = None
+                else:
+                    field_values[name] = construct_field(field_value, _NO_LOC)
+
+        # Check that all required field are present.
+        for field_name in required:
+            if field_name not in field_values:
+                formatted_path = " ".join(path)
+                msg = f"Default value missing for: '{field_name}' in {t} {formatted_path}, got Value: {data}"
+                raise ClanError(msg)
+
+        return t(**field_values)
+
+    return construct
 
 
 def construct_dataclass(
@@ -278,44 +553,7 @@ def construct_dataclass(
         msg = f"{t.__name__} is not a dataclass"
         raise ClanError(msg)
 
-    # Attempt to create an instance of the data_class#
-    field_values: dict[str, Any] = {}
-    required: list[str] = []
-
-    for field in fields(t):
-        if field.name.startswith("_"):
-            continue
-        # The first type in a Union
-        # str <- None | str | Path
-        field_type: type[Any] = unwrap_none_type(field.type)  # type: ignore
-        data_field_name = field.metadata.get("alias", field.name)
-
-        if (
-            field.default is dataclasses.MISSING
-            and field.default_factory is dataclasses.MISSING
-        ):
-            required.append(field.name)
-
-        # Populate the field_values dictionary with the field value
-        # if present in the data
-        if data_field_name in data:
-            field_value = data.get(data_field_name)
-
-            if field_value is None and (
-                field.type is None or is_type_in_union(field.type, type(None))  # type: ignore
-            ):
-                field_values[field.name] = None
-            else:
-                field_values[field.name] = construct_value(field_type, field_value)
-
-    # Check that all required field are present.
-    for field_name in required:
-        if field_name not in field_values:
-            formatted_path = " ".join(path)
-            msg = f"Default value missing for: '{field_name}' in {t} {formatted_path}, got Value: {data}"
-            raise ClanError(msg)
-
-    return t(**field_values)  # type: ignore
+    return dataclass_constructor(t)(data, path)
 
 
 def from_dict(
@@ -242,6 +242,18 @@ class AsyncRuntime:
             ):  # Check if any tasks are still running
                 self.condition.wait()  # Wait until a thread signals completion
 
+    def wait_any(self, tids: list[str]) -> list[str]:
+        """
+        Wait until at least one of the given tasks finished,
+        returns the finished ones
+        """
+        with self.condition:
+            while True:
+                finished = [tid for tid in tids if self.tasks[tid].finished]
+                if finished:
+                    return finished
+                self.condition.wait()
+
     def check_all(self) -> None:
         """
         Check if there where any errors
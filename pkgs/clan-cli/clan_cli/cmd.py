@@ -1,8 +1,9 @@
 import contextlib
+import io
 import logging
 import math
 import os
-import select
+import selectors
 import shlex
 import shutil
 import signal
@@ -16,7 +17,7 @@ from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import IO, Any
+from typing import IO
 
 from clan_cli.async_run import get_async_ctx, is_async_cancelled
 from clan_cli.colors import Color
@@ -54,6 +55,13 @@ class MsgColor:
     stdout: Color | None = None
 
 
+# Reads start small and grow while the pipe stays full, up to MAX_READ_SIZE.
+MIN_READ_SIZE = 64 * 1024
+MAX_READ_SIZE = 1024 * 1024
+# Seconds to wait for output before checking if the command was cancelled or exited.
+IDLE_WAKEUP = 1.0
+
+
 def handle_io(
     process: subprocess.Popen,
     log: Log,
@@ -64,27 +72,14 @@ def handle_io(
     stderr: IO[bytes] | None,
     timeout: float = math.inf,
     msg_color: MsgColor | None = None,
+    retain_output: bool = True,
 ) -> tuple[str, str]:
-    rlist = [
-        process.stdout,
-        process.stderr,
-    ]  # rlist is a list of file descriptors to be monitored for read events
-    wlist = (
-        [process.stdin] if input_bytes is not None else []
-    )  # wlist is a list of file descriptors to be monitored for write events
-    stdout_buf = b""
-    stderr_buf = b""
-    start = time.time()
-
-    # Function to handle file descriptors
-    def handle_fd(fd: IO[Any] | None, readlist: list[IO[Any]]) -> bytes:
-        if fd and fd in readlist:
-            read = os.read(fd.fileno(), 4096)
-            if len(read) != 0:
-                return read
-            rlist.remove(fd)
-        return b""
-
+    """
+    Log, stream and collect the output of the process until it exits,
+    while writing `input_bytes` to its stdin.
+    Without `retain_output` only streamed or logged output is kept,
+    and empty strings are returned.
+    """
     # Extra information passed to the logger
     stdout_extra = {}
     stderr_extra = {}
@@ -96,81 +91,106 @@ def handle_io(
     if msg_color and msg_color.stdout:
         stderr_extra["color"] = msg_color.stdout.value
 
-    # Loop until no more data is available
-    while len(rlist) != 0 or len(wlist) != 0:
-        # Check if the command has timed out
-        if time.time() - start > timeout:
-            msg = f"Command timed out after {timeout} seconds"
-            description = prefix
-            raise ClanCmdTimeoutError(msg=msg, description=description, timeout=timeout)
+    stdout_buf = bytearray()
+    stderr_buf = bytearray()
+    # fd -> (buffer, stream, log this output, logger extra)
+    outputs: dict[int, tuple[bytearray, IO[bytes] | None, bool, dict[str, str]]] = {}
+    if process.stdout is not None:
+        outputs[process.stdout.fileno()] = (
+            stdout_buf,
+            stdout,
+            log in [Log.STDOUT, Log.BOTH],
+            stdout_extra,
+        )
+    if process.stderr is not None:
+        outputs[process.stderr.fileno()] = (
+            stderr_buf,
+            stderr,
+            log in [Log.STDERR, Log.BOTH],
+            stderr_extra,
+        )
+    read_sizes = dict.fromkeys(outputs, MIN_READ_SIZE)
+
+    selector = selectors.DefaultSelector()
+    for fd in outputs:
+        selector.register(fd, selectors.EVENT_READ)
+    pending_input = memoryview(input_bytes or b"")
+    stdin_fd = None
+    if input_bytes is not None and process.stdin is not None:
+        stdin_fd = process.stdin.fileno()
+        if pending_input:
+            # partial writes instead of blocking while the process waits for us to read
+            os.set_blocking(stdin_fd, False)
+            selector.register(stdin_fd, selectors.EVENT_WRITE)
+        else:
+            process.stdin.close()
+
+    def close_stdin(fd: int) -> None:
+        assert process.stdin is not None
+        selector.unregister(fd)
+        with contextlib.suppress(BrokenPipeError):
+            process.stdin.close()
+
+    deadline = time.monotonic() + timeout
+    with selector:
+        while selector.get_map():
+            # Check if the command has timed out
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                msg = f"Command timed out after {timeout} seconds"
+                description = prefix
+                raise ClanCmdTimeoutError(
+                    msg=msg, description=description, timeout=timeout
+                )
+
+            # Check if the command has been cancelled
+            if is_async_cancelled():
+                cmdlog.warning("Command cancelled", extra=stderr_extra)
+
+                # Terminate process
+                break
+
+            events = selector.select(min(remaining, IDLE_WAKEUP))
+            if not events:
+                if process.poll() is None:
+                    continue
+                # Process has exited, but a child of it may still hold the pipes open
+                break
+
+            for key, _ in events:
+                fd = key.fd
+                if fd == stdin_fd:
+                    try:
+                        written = os.write(fd, pending_input)
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        close_stdin(fd)
+                        continue
+                    pending_input = pending_input[written:]
+                    if not pending_input:
+                        close_stdin(fd)
+                    continue
+
+                size = read_sizes[fd]
+                data = os.read(fd, size)
+                if not data:
+                    selector.unregister(fd)
+                    continue
+                if len(data) == size:
+                    read_sizes[fd] = min(size * 2, MAX_READ_SIZE)
+
+                buf, stream, log_output, extra = outputs[fd]
+                if log_output:
+                    lines = data.decode("utf-8", "replace").rstrip("\n").rstrip()
+                    for line in lines.split("\n"):
+                        cmdlog.info(line, extra=extra)
+                if stream:
+                    stream.write(data)
+                    stream.flush()
+                if retain_output:
+                    buf += data
 
-        # Check if the command has been cancelled
-        if is_async_cancelled():
-            cmdlog.warning("Command cancelled", extra=stderr_extra)
-
-            # Terminate process
-            break
-
-        # Wait for data to be available
-        readlist, writelist, _ = select.select(rlist, wlist, [], 0.1)
-        if len(readlist) == 0 and len(writelist) == 0:
-            if process.poll() is None:
-                continue
-            # Process has exited
-            break
-
-        #
-        # Process stdout
-        #
-        ret = handle_fd(process.stdout, readlist)
-
-        # If Log.STDOUT is set, log the stdout output
-        if ret and log in [Log.STDOUT, Log.BOTH]:
-            lines = ret.decode("utf-8", "replace").rstrip("\n").rstrip().split("\n")
-            for line in lines:
-                cmdlog.info(line, extra=stdout_extra)
-
-        # If stdout file is set, stream the stdout output
-        if ret and stdout:
-            stdout.write(ret)
-            stdout.flush()
-        stdout_buf += ret
-
-        #
-        # Process stderr
-        #
-        ret = handle_fd(process.stderr, readlist)
-
-        # If Log.STDERR is set, log the stderr output
-        if ret and log in [Log.STDERR, Log.BOTH]:
-            lines = ret.decode("utf-8", "replace").rstrip("\n").rstrip().split("\n")
-            for line in lines:
-                cmdlog.info(line, extra=stderr_extra)
-
-        # If stderr file is set, stream the stderr output
-        if ret and stderr:
-            stderr.write(ret)
-            stderr.flush()
-        stderr_buf += ret
-
-        #
-        # Process stdin
-        #
-        if process.stdin in writelist:
-            if input_bytes:
-                try:
-                    assert process.stdin is not None
-                    written = os.write(process.stdin.fileno(), input_bytes)
-                except BrokenPipeError:
-                    wlist.remove(process.stdin)
-                else:
-                    input_bytes = input_bytes[written:]
-                    if len(input_bytes) == 0:
-                        wlist.remove(process.stdin)
-                    process.stdin.flush()
-                    process.stdin.close()
-            else:
-                wlist.remove(process.stdin)
     return stdout_buf.decode("utf-8", "replace"), stderr_buf.decode("utf-8", "replace")
 
 
@@ -259,7 +279,8 @@ if os.environ.get("CLAN_CLI_PERF"):
 
 @dataclass
 class RunOpts:
-    input: bytes | None = None
+    # a stream with a file descriptor is passed to the process as its stdin
+    input: bytes | IO[bytes] | None = None
     stdout: IO[bytes] | None = None
     stderr: IO[bytes] | None = None
     env: dict[str, str] | None = None
@@ -277,6 +298,8 @@ class RunOpts:
     # Ask for sudo password in a graphical way.
     # This is needed for GUI applications
     graphical_perm: bool = False
+    # Keep the output in CmdOut, disable for large output that is only logged or streamed
+    retain_output: bool = True
 
 
 def cmd_with_root(cmd: list[str], graphical: bool = False) -> list[str]:
@@ -329,22 +352,37 @@ def run(
     if options.requires_root_perm:
         cmd = cmd_with_root(cmd, options.graphical_perm)
 
-    if options.input:
-        if any(not ch.isprintable() for ch in options.input.decode("ascii", "replace")):
+    input_bytes = None
+    stdin: int | IO[bytes] | None = None
+    if isinstance(options.input, bytes):
+        input_bytes = options.input
+        stdin = subprocess.PIPE
+    elif options.input is not None:
+        try:
+            options.input.fileno()
+        except (OSError, io.UnsupportedOperation):
+            input_bytes = options.input.read()
+            stdin = subprocess.PIPE
+        else:
+            stdin = options.input
+
+    if input_bytes:
+        if not input_bytes.decode("ascii", "replace").isprintable():
             filtered_input = "<<binary_blob>>"
         else:
-            filtered_input = options.input.decode("ascii", "replace")
+            filtered_input = input_bytes.decode("ascii", "replace")
         print_trace(
             f"echo '{filtered_input}' | {indent_command(cmd)}",
             cmdlog,
             options.prefix,
         )
+    elif stdin is options.input and stdin is not None:
+        print_trace(f"<<stream>> | {indent_command(cmd)}", cmdlog, options.prefix)
     elif cmdlog.isEnabledFor(logging.DEBUG):
         print_trace(f"{indent_command(cmd)}", cmdlog, options.prefix)
 
     start = timeit.default_timer()
     with ExitStack() as stack:
-        stdin = subprocess.PIPE if options.input is not None else None
         process = stack.enter_context(
             subprocess.Popen(
                 cmd,
@@ -370,9 +408,10 @@ def run(
             prefix=options.prefix,
             msg_color=options.msg_color,
             timeout=options.timeout,
-            input_bytes=options.input,
+            input_bytes=input_bytes,
             stdout=options.stdout,
             stderr=options.stderr,
+            retain_output=options.retain_output,
         )
         if not is_async_cancelled():
             process.wait()
@@ -1,9 +1,16 @@
 import argparse
 import contextlib
+import fcntl
 import json
+import logging
+import os
 import subprocess
+import sys
 import threading
+import time
 from collections.abc import Callable, Iterable
+from hashlib import sha1
+from pathlib import Path
 from types import ModuleType
 from typing import Any
 
@@ -26,6 +33,12 @@ with contextlib.suppress(ImportError):
 COMPLETION_TIMEOUT: int = 3
 
 
+# Seconds after a refresh of the completion index in which no new refresh is started
+INDEX_REFRESH_INTERVAL: int = 30
+
+log = logging.getLogger(__name__)
+
+
 def clan_dir(flake: str | None) -> str | None:
     from .dirs import get_clan_flake_toplevel_or_env
 
@@ -33,12 +46,175 @@ def clan_dir(flake: str | None) -> str | None:
     return str(path_result) if path_result is not None else None
 
 
+def completion_index_path(flake: str) -> Path:
+    from .dirs import user_cache_dir
+
+    digest = sha1(str(Path(flake).resolve()).encode()).hexdigest()
+    return user_cache_dir() / "clan" / "completions" / f"{digest}.json"
+
+
+def completion_index() -> dict[str, Any] | None:
+    """
+    Returns the completion index of the current clan, or None if there is none yet.
+    The index is refreshed in a background process if it was not checked recently,
+    so completions only ever read a file and never wait for nix.
+    """
+    flake = clan_dir_result if (clan_dir_result := clan_dir(None)) is not None else "."
+    index_path = completion_index_path(flake)
+    lock_path = index_path.with_suffix(".lock")
+    # the lock is touched when a refresh is started, so failing refreshes are not
+    # retried on every completion
+    checked = 0.0
+    for path in [index_path, lock_path]:
+        with contextlib.suppress(FileNotFoundError):
+            checked = max(checked, path.stat().st_mtime)
+    if time.time() - checked > INDEX_REFRESH_INTERVAL and not refresh_running(
+        lock_path
+    ):
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        lock_path.touch()
+        devnull = [
+            (os.POSIX_SPAWN_OPEN, fd, os.devnull, os.O_RDWR, 0) for fd in range(3)
+        ]
+        # not waited for, it outlives the completion
+        os.posix_spawn(
+            sys.executable,
+            [sys.executable, "-m", "clan_cli.completions", flake],
+            # the wrapper of the clan executable might extend sys.path
+            {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+            file_actions=devnull,
+            setsid=True,
+        )
+    try:
+        return json.loads(index_path.read_text())
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def refresh_running(lock_path: Path) -> bool:
+    """
+    True while a refresh holds the lock of the index,
+    a refresh of a large clan can take longer than INDEX_REFRESH_INTERVAL.
+    """
+    try:
+        with lock_path.open() as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except FileNotFoundError:
+        return False
+    except BlockingIOError:
+        return True
+    return False
+
+
+def refresh_completion_index(flake: str) -> None:
+    """
+    Runs in the background process started by completion_index().
+    Nobody sees its output, so failures are logged next to the index.
+    The log is only written on failure and holds the last one.
+    """
+    log_path = completion_index_path(flake).with_suffix(".log")
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(log_path, mode="w", delay=True)
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    root_log = logging.getLogger()
+    root_log.addHandler(handler)
+    try:
+        build_completion_index(flake)
+    except Exception:
+        log.exception(f"Failed to refresh the completion index of {flake}")
+    finally:
+        root_log.removeHandler(handler)
+        handler.close()
+
+
+def build_completion_index(flake: str) -> None:
+    """
+    Evaluates everything completions need in a single nix evaluation,
+    unless the index is already up to date with the narHash of the flake.
+    """
+    from .flake import Flake
+    from .nix import nix_command, nix_config
+
+    index_path = completion_index_path(flake)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    lock_path = index_path.with_suffix(".lock")
+    with lock_path.open("w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another process is refreshing the index
+            return
+        lock_path.touch()
+
+        flake_obj = Flake(flake)
+        flake_obj.prefetch()
+        try:
+            if json.loads(index_path.read_text()).get("hash") == flake_obj.hash:
+                # mark the index as checked
+                index_path.touch()
+                return
+        except (OSError, json.JSONDecodeError):
+            pass
+
+        system = nix_config()["system"]
+        nix_code = f"""
+          let
+            flake = builtins.getFlake "path:{flake_obj.store_path}?narHash={flake_obj.hash}";
+            inventory = flake.clanInternals.inventory;
+            try = default: value:
+              let result = builtins.tryEval value;
+              in if result.success then result.value else default;
+            names = set: try [ ] (builtins.attrNames set);
+            concatMapValues = f: set: builtins.concatMap f (builtins.attrValues set);
+          in {{
+            machines = names flake.clanInternals.machines.{system};
+            tags = names (inventory.tags or {{ }})
+              ++ concatMapValues (service:
+                concatMapValues (instance:
+                  concatMapValues (role: role.tags or [ ]) (instance.roles or {{ }})
+                ) service
+              ) (inventory.services or {{ }})
+              ++ concatMapValues (machine: machine.tags or [ ]) (inventory.machines or {{ }});
+            perMachine = builtins.mapAttrs (name: machine:
+              let core = machine.config.clan.core;
+              in {{
+                services = names (core.facts.services or {{ }});
+                generators = names (core.vars.generators or {{ }});
+                backupProviders = names (core.backups.providers or {{ }});
+                stateServices = names (core.state or {{ }});
+                targetHost = try null (core.networking.targetHost or null);
+              }}
+            ) (flake.nixosConfigurations or {{ }});
+          }}
+        """
+        index = json.loads(
+            run(nix_command(["eval", "--json", "--expr", nix_code])).stdout
+        )
+        index["hash"] = flake_obj.hash
+        tmp_path = index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(index))
+        tmp_path.replace(index_path)
+
+
+def machine_index(machine: str) -> dict[str, Any] | None:
+    index = completion_index()
+    if index is None:
+        return None
+    return index["perMachine"].get(machine, {})
+
+
 def complete_machines(
     prefix: str, parsed_args: argparse.Namespace, **kwargs: Any
 ) -> Iterable[str]:
     """
     Provides completion functionality for machine names configured in the clan.
     """
+    index = completion_index()
+    if index is not None:
+        return dict.fromkeys(index["machines"], "machine")
+
     machines: list[str] = []
 
     def run_cmd() -> None:
@@ -80,6 +256,10 @@ def complete_services_for_machine(
     """
     Provides completion functionality for machine facts generation services.
     """
+    machines_arg: list[str] = parsed_args.machines
+    if machines_arg and (index := machine_index(machines_arg[0])) is not None:
+        return dict.fromkeys(index.get("services", []), "service")
+
     services: list[str] = []
     # TODO: consolidate, if multiple machines are used
     machines: list[str] = parsed_args.machines
@@ -117,12 +297,28 @@ def complete_services_for_machine(
     return services_dict
 
 
+def complete_generators_for_machine(
+    prefix: str, parsed_args: argparse.Namespace, **kwargs: Any
+) -> Iterable[str]:
+    """
+    Provides completion functionality for the vars generators of a machine.
+    Only served from the completion index.
+    """
+    machines: list[str] = parsed_args.machines
+    if not machines or (index := machine_index(machines[0])) is None:
+        return iter([])
+    return dict.fromkeys(index.get("generators", []), "generator")
+
+
 def complete_backup_providers_for_machine(
     prefix: str, parsed_args: argparse.Namespace, **kwargs: Any
 ) -> Iterable[str]:
     """
     Provides completion functionality for machine backup providers.
     """
+    if (index := machine_index(parsed_args.machine)) is not None:
+        return dict.fromkeys(index.get("backupProviders", []), "provider")
+
     providers: list[str] = []
     machine: str = parsed_args.machine
 
@@ -165,6 +361,9 @@ def complete_state_services_for_machine(
     """
     Provides completion functionality for machine state providers.
     """
+    if (index := machine_index(parsed_args.machine)) is not None:
+        return dict.fromkeys(index.get("stateServices", []), "service")
+
     providers: list[str] = []
     machine: str = parsed_args.machine
 
@@ -266,6 +465,10 @@ def complete_target_host(
     """
     Provides completion functionality for target_host for a specific machine
     """
+    if (index := machine_index(parsed_args.machine)) is not None:
+        target_host = index.get("targetHost")
+        return {target_host: "target_host"} if target_host else {}
+
     target_hosts: list[str] = []
     machine: str = parsed_args.machine
 
@@ -306,6 +509,10 @@ def complete_tags(
     """
     Provides completion functionality for tags inside the inventory
     """
+    index = completion_index()
+    if index is not None:
+        return dict.fromkeys(index["tags"], "tag")
+
     tags: list[str] = []
     threads = []
 
@@ -416,3 +623,8 @@ def add_dynamic_completer(
     if argcomplete:
         # mypy doesn't check this correctly, so we ignore it
         action.completer = completer  # type: ignore[attr-defined]
+
+
+if __name__ == "__main__":
+    # started in the background by completion_index()
+    refresh_completion_index(sys.argv[1])
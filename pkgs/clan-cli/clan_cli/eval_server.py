@@ -0,0 +1,276 @@
+"""
+A long running cache of evaluation results.
+
+Every `Machine.eval_nix()` / `Machine.build_nix()` call starts a new nix process
+that parses the flake again. The eval server remembers the results of these
+calls, and of flake selects, in memory and answers requests over a unix socket.
+It does not keep nix running: a request that is not cached starts a new nix
+process, like the client would have done.
+Cached values are dropped as soon as the narHash of the flake changes.
+To notice that without running `nix flake prefetch` for every request, clients
+send the narHash they know. Otherwise the server compares a stamp of the local
+flake directory, and prefetches remote flakes again after REMOTE_TTL seconds.
+
+The protocol is one json object per line in each direction:
+
+  request:  {"method": "eval" | "build", "flake": ..., "hash": ..., "machine": ..., "attr": ...,
+             "nix_options": [...], "refresh": false}
+            {"method": "select", "flake": ..., "hash": ..., "selector": ...}
+  response: {"result": ...} or {"error": "..."}
+
+"flake" must be an absolute path or a flake url, "hash" is optional.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from clan_cli.dirs import user_cache_dir
+from clan_cli.errors import ClanError
+from clan_cli.flake import Flake
+
+log = logging.getLogger(__name__)
+
+# flakes that are not local directories are prefetched again after this many seconds
+REMOTE_TTL = 60
+
+
+def default_socket_path() -> Path:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    base_dir = Path(runtime_dir) if runtime_dir else user_cache_dir()
+    return base_dir / "clan" / "eval-server.sock"
+
+
+def eval_server_socket() -> Path | None:
+    """
+    Returns the socket of a running eval server, or None if there is none.
+    CLAN_EVAL_SERVER can point to a different socket, or be set to "0" to
+    never use the eval server.
+    """
+    value = os.environ.get("CLAN_EVAL_SERVER")
+    if value == "0":
+        return None
+    socket_path = Path(value) if value else default_socket_path()
+    if socket_path.is_socket():
+        return socket_path
+    return None
+
+
+def eval_server_request(socket_path: Path, request: dict[str, Any]) -> Any:
+    """
+    Send a single request to the eval server and return its result.
+    Raises OSError if the server cannot be reached.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        msg = f"eval server at {socket_path} closed the connection"
+        raise ConnectionError(msg)
+    response = json.loads(line)
+    if "error" in response:
+        msg = f"eval server failed to handle {request['method']} request"
+        raise ClanError(msg, description=response["error"])
+    return response["result"]
+
+
+def local_stamp(identifier: str) -> tuple[int, ...] | None:
+    """
+    A cheap fingerprint of a flake in a local directory, None for other flakes.
+    It covers the flake files, the checked out commit and the git index.
+    Edits to files that are not staged are not seen, clients that know the
+    narHash of the flake send it along with their request.
+    """
+    if not identifier.startswith("/"):
+        return None
+    path = Path(identifier)
+    git_dir = path / ".git"
+    files = [path, path / "flake.nix", path / "flake.lock"]
+    files += [git_dir / "HEAD", git_dir / "index", git_dir / "packed-refs"]
+    try:
+        head = (git_dir / "HEAD").read_text()
+    except OSError:
+        pass
+    else:
+        if head.startswith("ref: "):
+            files.append(git_dir / head.removeprefix("ref: ").strip())
+    stamp: list[int] = []
+    for file in files:
+        try:
+            st = file.stat()
+        except OSError:
+            stamp += [0, 0, 0]
+        else:
+            stamp += [st.st_ino, st.st_mtime_ns, st.st_size]
+    return tuple(stamp)
+
+
+class EvalServerState:
+    def __init__(self) -> None:
+        self.flakes: dict[str, Flake] = {}
+        # identifier -> (local stamp, time of the last prefetch)
+        self.checks: dict[str, tuple[tuple[int, ...] | None, float]] = {}
+        # (flake, machine, method, attr, nix_options) -> result
+        self.machine_cache: dict[tuple[str, str, str, str, tuple[str, ...]], str] = {}
+        # serializes the requests for one flake, held while nix runs
+        self.flake_locks: dict[str, threading.Lock] = {}
+        # guards the dicts above, never held while nix runs
+        self.lock = threading.Lock()
+
+    def flake_lock(self, identifier: str) -> threading.Lock:
+        with self.lock:
+            return self.flake_locks.setdefault(identifier, threading.Lock())
+
+    def is_current(self, identifier: str, nar_hash: str | None) -> bool:
+        """
+        Whether the cached flake for the identifier is still up to date,
+        without starting nix.
+        """
+        flake = self.flakes.get(identifier)
+        if flake is None:
+            return False
+        if nar_hash is not None:
+            return flake.hash == nar_hash
+        stamp, checked = self.checks[identifier]
+        if stamp is None:
+            return time.monotonic() - checked < REMOTE_TTL
+        return local_stamp(identifier) == stamp
+
+    def flake(self, identifier: str, nar_hash: str | None = None) -> Flake:
+        """
+        Returns the cached flake for the identifier.
+        The flake is only prefetched again if it might have changed,
+        everything cached for it is dropped if its narHash changed.
+        """
+        if not identifier.startswith("/") and ":" not in identifier:
+            msg = (
+                f"Relative flake identifier {identifier} must be resolved by the client"
+            )
+            raise ClanError(msg)
+        with self.lock:
+            if self.is_current(identifier, nar_hash):
+                return self.flakes[identifier]
+        # taken before prefetching, so changes made meanwhile are checked again
+        stamp = local_stamp(identifier)
+        flake = Flake(identifier)
+        flake.prefetch()
+        with self.lock:
+            self.checks[identifier] = (stamp, time.monotonic())
+            current = self.flakes.get(identifier)
+            if current is not None and current.hash == flake.hash:
+                return current
+            if current is not None:
+                log.info(f"{identifier} changed, dropping cached values")
+            self.flakes[identifier] = flake
+            self.machine_cache = {
+                key: value
+                for key, value in self.machine_cache.items()
+                if key[0] != identifier
+            }
+            return flake
+
+    def handle(self, request: dict[str, Any]) -> Any:
+        method = request.get("method")
+        if method not in ("select", "eval", "build"):
+            msg = f"Unknown eval server method: {method}"
+            raise ClanError(msg)
+        # concurrent requests for the same value wait for the first one
+        with self.flake_lock(request["flake"]):
+            return self._handle(request)
+
+    def _handle(self, request: dict[str, Any]) -> Any:
+        from clan_cli.machines.machines import Machine
+
+        method = request["method"]
+        flake = self.flake(request["flake"], request.get("hash"))
+        if method == "select":
+            return flake.select(request["selector"])
+
+        nix_options = tuple(request.get("nix_options", []))
+        key = (
+            flake.identifier,
+            request["machine"],
+            method,
+            request["attr"],
+            nix_options,
+        )
+        if not request.get("refresh", False):
+            with self.lock:
+                if key in self.machine_cache:
+                    return self.machine_cache[key]
+        machine = Machine(
+            name=request["machine"], flake=flake, nix_options=list(nix_options)
+        )
+        result = str(machine.nix(method, request["attr"]))
+        with self.lock:
+            self.machine_cache[key] = result
+        return result
+
+
+class EvalRequestHandler(socketserver.StreamRequestHandler):
+    server: "EvalServer"
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                response = {"result": self.server.state.handle(json.loads(line))}
+            except Exception as e:
+                log.debug("eval server request failed", exc_info=e)
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class EvalServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path) -> None:
+        self.state = EvalServerState()
+        super().__init__(str(socket_path), EvalRequestHandler)
+
+
+def serve(socket_path: Path) -> None:
+    if socket_path.is_socket():
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(str(socket_path))
+        except OSError:
+            # left over from a server that did not shut down cleanly
+            socket_path.unlink()
+        else:
+            msg = f"An eval server is already listening on {socket_path}"
+            raise ClanError(msg)
+    socket_path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+
+    with EvalServer(socket_path) as server:
+        socket_path.chmod(0o600)
+        log.info(f"Eval server listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            log.info("Eval server stopped")
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def eval_server_command(args: argparse.Namespace) -> None:
+    serve(args.socket or default_socket_path())
+
+
+def register_parser(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(func=eval_server_command)
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        default=None,
+        help=f"unix socket to listen on (default: {default_socket_path()})",
+    )
@@ -15,7 +15,7 @@ from clan_cli.completions import (
     complete_services_for_machine,
 )
 from clan_cli.errors import ClanError
-from clan_cli.git import commit_files
+from clan_cli.git import commit_files, commit_transaction
 from clan_cli.machines.inventory import get_all_machines, get_selected_machines
 from clan_cli.machines.machines import Machine
 from clan_cli.nix import nix_shell
@@ -199,8 +199,13 @@ def generate_facts(
     regenerate: bool = False,
     prompt: Callable[[str, str], str] = prompt_func,
 ) -> bool:
+    if not machines:
+        return False
     was_regenerated = False
-    with TemporaryDirectory(prefix="facts-generate-") as tmp:
+    with (
+        TemporaryDirectory(prefix="facts-generate-") as tmp,
+        commit_transaction(machines[0].flake_dir, "Update facts/secrets"),
+    ):
         tmpdir = Path(tmp)
 
         for machine in machines:
@@ -219,7 +224,7 @@ def generate_facts(
                 )
                 raise ClanError(msg)
 
-    if not was_regenerated and len(machines) > 0:
+    if not was_regenerated:
         machine.info("All secrets and facts are already up to date")
     return was_regenerated
 
@@ -4,6 +4,7 @@ from pathlib import Path
 from typing import override
 
 from clan_cli.cmd import Log, RunOpts
+from clan_cli.git import last_commits
 from clan_cli.machines.machines import Machine
 from clan_cli.nix import nix_shell
 
@@ -45,48 +46,18 @@ class SecretStore(SecretStoreBase):
         return secret_path.exists()
 
     def generate_hash(self) -> bytes:
-        password_store = os.environ.get(
-            "PASSWORD_STORE_DIR", f"{os.environ['HOME']}/.password-store"
-        )
-        hashes = []
-        hashes.append(
-            subprocess.run(
-                nix_shell(
-                    ["nixpkgs#git"],
-                    [
-                        "git",
-                        "-C",
-                        password_store,
-                        "log",
-                        "-1",
-                        "--format=%H",
-                        f"machines/{self.machine.name}",
-                    ],
-                ),
-                stdout=subprocess.PIPE,
-                check=False,
-            ).stdout.strip()
+        password_store = Path(
+            os.environ.get(
+                "PASSWORD_STORE_DIR", f"{os.environ['HOME']}/.password-store"
+            )
         )
-        for symlink in Path(password_store).glob(f"machines/{self.machine.name}/**/*"):
+        machine_dir = f"machines/{self.machine.name}"
+        commits = last_commits(password_store, machine_dir)
+        hashes = [commits.get(machine_dir, "").encode()]
+        for symlink in password_store.glob(f"{machine_dir}/**/*"):
             if symlink.is_symlink():
-                hashes.append(
-                    subprocess.run(
-                        nix_shell(
-                            ["nixpkgs#git"],
-                            [
-                                "git",
-                                "-C",
-                                password_store,
-                                "log",
-                                "-1",
-                                "--format=%H",
-                                str(symlink),
-                            ],
-                        ),
-                        stdout=subprocess.PIPE,
-                        check=False,
-                    ).stdout.strip()
-                )
+                path = str(symlink.relative_to(password_store))
+                hashes.append(commits.get(path, "").encode())
 
         # we sort the hashes to make sure that the order is always the same
         hashes.sort()
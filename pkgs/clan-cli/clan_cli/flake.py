@@ -1,8 +1,12 @@
 import json
 import logging
-import pickle
 import re
+import sqlite3
+import threading
+from collections.abc import Sequence
+from contextlib import closing
 from dataclasses import dataclass
+from functools import lru_cache
 from hashlib import sha1
 from pathlib import Path
 from typing import Any, cast
@@ -16,15 +20,21 @@ log = logging.getLogger(__name__)
 
 
 class AllSelector:
-    pass
+    __slots__ = ()
 
 
-Selector = str | int | AllSelector | set[int] | set[str]
+Selector = str | int | AllSelector | frozenset[int] | frozenset[str]
+Selectors = Sequence[Selector]
 
+SELECTOR_PATTERN = re.compile(r'"[^"]*"|[^.]+')
 
-def split_selector(selector: str) -> list[Selector]:
+
+@lru_cache(maxsize=4096)
+def split_selector(selector: str) -> tuple[Selector, ...]:
     """
-    takes a string and returns a list of selectors.
+    takes a string and returns an immutable tuple of selectors.
+    results are memoized, so callers can pass the same string over and over
+    without tokenizing it again.
 
     a selector can be:
     - a string, which is a key in a dict
@@ -34,8 +44,7 @@ def split_selector(selector: str) -> list[Selector]:
     - a quoted string, which is a key in a dict
     - the string "*", which selects all elements in a list or dict
     """
-    pattern = r'"[^"]*"|[^.]+'
-    matches = re.findall(pattern, selector)
+    matches = SELECTOR_PATTERN.findall(selector)
 
     # Extract the matched groups (either quoted or unquoted parts)
     selectors: list[Selector] = []
@@ -43,50 +52,58 @@ def split_selector(selector: str) -> list[Selector]:
         if selector == "*":
             selectors.append(AllSelector())
         elif selector.isdigit():
-            selectors.append({int(selector)})
+            selectors.append(frozenset({int(selector)}))
         elif selector.startswith("{") and selector.endswith("}"):
-            sub_selectors = set(selector[1:-1].split(","))
+            sub_selectors = frozenset(selector[1:-1].split(","))
             selectors.append(sub_selectors)
         elif selector.startswith('"') and selector.endswith('"'):
             selectors.append(selector[1:-1])
         else:
             selectors.append(selector)
 
-    return selectors
+    return tuple(selectors)
 
 
-@dataclass
 class FlakeCacheEntry:
     """
     a recursive structure to store the cache, with a value and a selector
+
+    selectors are walked by index (depth) instead of slicing the selector list
+    at every level, chains of plain keys are walked iteratively.
+    lists are stored as dicts indexed by position, `is_list` remembers to
+    return them as lists again.
     """
 
+    __slots__ = ("is_list", "selector", "value")
+
     def __init__(
         self,
-        value: str | float | dict[str, Any] | list[Any],
-        selectors: list[Selector],
+        value: str | float | dict[str, Any] | list[Any] | None,
+        selectors: Selectors,
         is_out_path: bool = False,
+        depth: int = 0,
     ) -> None:
-        self.value: str | float | int | dict[str | int, FlakeCacheEntry]
+        self.value: str | float | int | dict[str | int, FlakeCacheEntry] | None
         self.selector: set[int] | set[str] | AllSelector
+        self.is_list = False
         selector: Selector = AllSelector()
 
-        if selectors == []:
-            self.selector = AllSelector()
-        elif isinstance(selectors[0], set):
-            self.selector = selectors[0]
-            selector = selectors[0]
-        elif isinstance(selectors[0], int):
-            self.selector = {int(selectors[0])}
-            selector = int(selectors[0])
-        elif isinstance(selectors[0], str):
-            self.selector = {(selectors[0])}
-            selector = selectors[0]
-        elif isinstance(selectors[0], AllSelector):
+        head = AllSelector() if depth >= len(selectors) else selectors[depth]
+        if isinstance(head, frozenset):
+            # copy, the selector set grows when more keys are inserted
+            self.selector = cast(set[int] | set[str], set(head))
+            selector = head
+        elif isinstance(head, int):
+            self.selector = {int(head)}
+            selector = int(head)
+        elif isinstance(head, str):
+            self.selector = {(head)}
+            selector = head
+        elif isinstance(head, AllSelector):
             self.selector = AllSelector()
 
         if is_out_path:
-            if selectors != []:
+            if depth < len(selectors):
                 msg = "Cannot index outPath"
                 raise ValueError(msg)
             if not isinstance(value, str):
@@ -95,7 +112,7 @@ class FlakeCacheEntry:
             self.value = value
 
         elif isinstance(selector, str):
-            self.value = {selector: FlakeCacheEntry(value, selectors[1:])}
+            self.value = {selector: FlakeCacheEntry(value, selectors, depth=depth + 1)}
 
         elif isinstance(value, dict):
             if isinstance(self.selector, set):
@@ -106,10 +123,12 @@ class FlakeCacheEntry:
             for key, value_ in value.items():
                 if key == "outPath":
                     self.value[key] = FlakeCacheEntry(
-                        value_, selectors[1:], is_out_path=True
+                        value_, selectors, is_out_path=True, depth=depth + 1
                     )
                 else:
-                    self.value[key] = FlakeCacheEntry(value_, selectors[1:])
+                    self.value[key] = FlakeCacheEntry(
+                        value_, selectors, depth=depth + 1
+                    )
 
         elif isinstance(value, list):
             if isinstance(selector, int):
@@ -117,22 +136,27 @@ class FlakeCacheEntry:
                     msg = "Cannot index list with int selector when value is not singleton"
                     raise ValueError(msg)
                 self.value = {
-                    int(selector): FlakeCacheEntry(value[0], selectors[1:]),
+                    int(selector): FlakeCacheEntry(
+                        value[0], selectors, depth=depth + 1
+                    ),
                 }
-            if isinstance(selector, set):
+            if isinstance(selector, frozenset):
                 if all(isinstance(v, int) for v in selector):
                     self.value = {}
                     for i, v in enumerate([selector]):
                         assert isinstance(v, int)
-                        self.value[int(v)] = FlakeCacheEntry(value[i], selectors[1:])
+                        self.value[int(v)] = FlakeCacheEntry(
+                            value[i], selectors, depth=depth + 1
+                        )
                 else:
                     msg = "Cannot index list with non-int set"
                     raise ValueError(msg)
             elif isinstance(self.selector, AllSelector):
                 self.value = {}
+                self.is_list = True
                 for i, v in enumerate(value):
-                    if isinstance(v, dict | list | str | float | int):
-                        self.value[i] = FlakeCacheEntry(v, selectors[1:])
+                    if isinstance(v, dict | list | str | float | int | None):
+                        self.value[i] = FlakeCacheEntry(v, selectors, depth=depth + 1)
             else:
                 msg = f"expected integer selector or all for type list, but got {type(selector)}"
                 raise TypeError(msg)
@@ -141,44 +165,49 @@ class FlakeCacheEntry:
             self.value = {}
             self.selector = self.selector = {"outPath"}
             self.value["outPath"] = FlakeCacheEntry(
-                value, selectors[1:], is_out_path=True
+                value, selectors, is_out_path=True, depth=depth + 1
             )
 
-        elif isinstance(value, (str | float | int)):
+        elif isinstance(value, (str | float | int)) or value is None:
             self.value = value
 
     def insert(
-        self, value: str | float | dict[str, Any] | list[Any], selectors: list[Selector]
+        self,
+        value: str | float | dict[str, Any] | list[Any] | None,
+        selectors: Selectors,
+        depth: int = 0,
     ) -> None:
         selector: Selector
-        if selectors == []:
+        if depth >= len(selectors):
             selector = AllSelector()
         else:
-            selector = selectors[0]
+            selector = selectors[depth]
 
         if isinstance(selector, str):
             if isinstance(self.value, dict):
                 if selector in self.value:
-                    self.value[selector].insert(value, selectors[1:])
+                    self.value[selector].insert(value, selectors, depth + 1)
                 else:
-                    self.value[selector] = FlakeCacheEntry(value, selectors[1:])
+                    self.value[selector] = FlakeCacheEntry(
+                        value, selectors, depth=depth + 1
+                    )
                 return
             msg = f"Cannot insert {selector} into non dict value"
             raise TypeError(msg)
 
         if isinstance(selector, AllSelector):
             self.selector = AllSelector()
-        elif isinstance(self.selector, set) and isinstance(selector, set):
+        elif isinstance(self.selector, set) and isinstance(selector, frozenset):
             if all(isinstance(v, str) for v in self.selector) and all(
                 isinstance(v, str) for v in selector
             ):
-                selector = cast(set[str], selector)
+                selector = cast(frozenset[str], selector)
                 self.selector = cast(set[str], self.selector)
                 self.selector = self.selector.union(selector)
             elif all(isinstance(v, int) for v in self.selector) and all(
                 isinstance(v, int) for v in selector
             ):
-                selector = cast(set[int], selector)
+                selector = cast(frozenset[int], selector)
                 self.selector = cast(set[int], self.selector)
                 self.selector = self.selector.union(selector)
             else:
@@ -201,12 +230,14 @@ class FlakeCacheEntry:
         if isinstance(self.value, dict) and isinstance(value, dict):
             for key, value_ in value.items():
                 if key in self.value:
-                    self.value[key].insert(value_, selectors[1:])
+                    self.value[key].insert(value_, selectors, depth + 1)
                 else:
-                    self.value[key] = FlakeCacheEntry(value_, selectors[1:])
+                    self.value[key] = FlakeCacheEntry(
+                        value_, selectors, depth=depth + 1
+                    )
 
         elif isinstance(self.value, dict) and isinstance(value, list):
-            if isinstance(selector, set):
+            if isinstance(selector, frozenset):
                 if not all(isinstance(v, int) for v in selector):
                     msg = "Cannot list with non-int set"
                     raise ValueError(msg)
@@ -214,26 +245,31 @@ class FlakeCacheEntry:
                     assert isinstance(requested_index, int)
                     if requested_index in self.value:
                         self.value[requested_index].insert(
-                            value[realindex], selectors[1:]
+                            value[realindex], selectors, depth + 1
                         )
             elif isinstance(selector, AllSelector):
+                self.is_list = True
                 for index, v in enumerate(value):
                     if index in self.value:
-                        self.value[index].insert(v, selectors[1:])
+                        self.value[index].insert(v, selectors, depth + 1)
                     else:
-                        self.value[index] = FlakeCacheEntry(v, selectors[1:])
+                        self.value[index] = FlakeCacheEntry(
+                            v, selectors, depth=depth + 1
+                        )
             elif isinstance(selector, int):
                 if selector in self.value:
-                    self.value[selector].insert(value[0], selectors[1:])
+                    self.value[selector].insert(value[0], selectors, depth + 1)
                 else:
-                    self.value[selector] = FlakeCacheEntry(value[0], selectors[1:])
+                    self.value[selector] = FlakeCacheEntry(
+                        value[0], selectors, depth=depth + 1
+                    )
         elif isinstance(value, str) and value.startswith("/nix/store/"):
             self.value = {}
             self.value["outPath"] = FlakeCacheEntry(
-                value, selectors[1:], is_out_path=True
+                value, selectors, is_out_path=True, depth=depth + 1
             )
 
-        elif isinstance(value, (str | float | int)):
+        elif isinstance(value, (str | float | int)) or value is None:
             if self.value:
                 if self.value != value:
                     msg = "value mismatch in cache, something is fishy"
@@ -242,60 +278,70 @@ class FlakeCacheEntry:
             msg = f"Cannot insert value of type {type(value)} into cache"
             raise TypeError(msg)
 
-    def is_cached(self, selectors: list[Selector]) -> bool:
+    def is_cached(self, selectors: Selectors, depth: int = 0) -> bool:
+        entry = self
         selector: Selector
-        if selectors == []:
-            selector = AllSelector()
-        else:
-            selector = selectors[0]
+        # walk plain keys iteratively, only recurse where the selector fans out
+        while True:
+            if depth >= len(selectors):
+                selector = AllSelector()
+            else:
+                selector = selectors[depth]
+
+            if isinstance(entry.value, str | float | int | None):
+                return depth >= len(selectors)
+            if not isinstance(selector, str | int):
+                break
+            if selector not in entry.value:
+                return False
+            entry = entry.value[selector]
+            depth += 1
 
-        if isinstance(self.value, str | float | int):
-            return selectors == []
         if isinstance(selector, AllSelector):
-            if isinstance(self.selector, AllSelector):
+            if isinstance(entry.selector, AllSelector):
                 return all(
-                    self.value[sel].is_cached(selectors[1:]) for sel in self.value
+                    v.is_cached(selectors, depth + 1) for v in entry.value.values()
                 )
             # TODO: check if we already have all the keys anyway?
             return False
-        if (
-            isinstance(selector, set)
-            and isinstance(self.selector, set)
-            and isinstance(self.value, dict)
-        ):
-            if not selector.issubset(self.selector):
+        if isinstance(selector, frozenset) and isinstance(entry.selector, set):
+            if not selector.issubset(entry.selector):
                 return False
-            return all(self.value[sel].is_cached(selectors[1:]) for sel in selector)
-        if isinstance(selector, str | int) and isinstance(self.value, dict):
-            if selector in self.value:
-                return self.value[selector].is_cached(selectors[1:])
-            return False
+            return all(
+                entry.value[sel].is_cached(selectors, depth + 1) for sel in selector
+            )
         return False
 
-    def select(self, selectors: list[Selector]) -> Any:
+    def select(self, selectors: Selectors, depth: int = 0) -> Any:
+        entry = self
         selector: Selector
-        if selectors == []:
-            selector = AllSelector()
-        else:
-            selector = selectors[0]
+        # walk plain keys iteratively, only recurse where the selector fans out
+        while True:
+            if depth >= len(selectors):
+                if isinstance(entry.value, dict) and "outPath" in entry.value:
+                    return entry.value["outPath"].value
+                selector = AllSelector()
+            else:
+                selector = selectors[depth]
 
-        if selectors == [] and isinstance(self.value, dict) and "outPath" in self.value:
-            return self.value["outPath"].value
+            if isinstance(entry.value, str | float | int | None):
+                return entry.value
+            if not isinstance(selector, str | int):
+                break
+            entry = entry.value[selector]
+            depth += 1
 
-        if isinstance(self.value, str | float | int):
-            return self.value
-        if isinstance(self.value, dict):
-            if isinstance(selector, AllSelector):
-                return {k: v.select(selectors[1:]) for k, v in self.value.items()}
-            if isinstance(selector, set):
-                return {
-                    k: v.select(selectors[1:])
-                    for k, v in self.value.items()
-                    if k in selector
-                }
-            if isinstance(selector, str | int):
-                return self.value[selector].select(selectors[1:])
-        msg = f"Cannot select {selector} from type {type(self.value)}"
+        if isinstance(selector, AllSelector):
+            if entry.is_list:
+                return [v.select(selectors, depth + 1) for v in entry.value.values()]
+            return {k: v.select(selectors, depth + 1) for k, v in entry.value.items()}
+        if isinstance(selector, frozenset):
+            return {
+                k: v.select(selectors, depth + 1)
+                for k, v in entry.value.items()
+                if k in selector
+            }
+        msg = f"Cannot select {selector} from type {type(entry.value)}"
         raise TypeError(msg)
 
     def __getitem__(self, name: str) -> "FlakeCacheEntry":
@@ -313,36 +359,120 @@ class FlakeCacheEntry:
 class FlakeCache:
     """
     an in-memory cache for flake outputs, uses a recursive FLakeCacheEntry structure
+
+    The cache can be persisted to an append-only sqlite database, which stores
+    every inserted selector together with its value.
+    Loading only replays the entries that were added since the last load,
+    saving only appends the entries that were inserted since the last save.
+    All methods can be called from several threads.
     """
 
     def __init__(self) -> None:
         self.cache: FlakeCacheEntry = FlakeCacheEntry({}, [])
+        self._last_row_id = 0
+        self._unsaved: list[tuple[str, Any]] = []
+        self._file_stamp: tuple[int, ...] | None = None
+        self._lock = threading.RLock()
+
+    def _insert(self, data: Any, selector_str: str) -> None:
+        self.cache.insert(data, split_selector(selector_str))
 
     def insert(self, data: dict[str, Any], selector_str: str) -> None:
-        if selector_str:
-            selectors = split_selector(selector_str)
-        else:
-            selectors = []
+        with self._lock:
+            self._insert(data, selector_str)
+            self._unsaved.append((selector_str, data))
 
-        self.cache.insert(data, selectors)
+    def select(self, selector: str | Selectors) -> Any:
+        if isinstance(selector, str):
+            selector = split_selector(selector)
+        with self._lock:
+            return self.cache.select(selector)
+
+    def is_cached(self, selector: str | Selectors) -> bool:
+        if isinstance(selector, str):
+            selector = split_selector(selector)
+        with self._lock:
+            return self.cache.is_cached(selector)
 
-    def select(self, selector_str: str) -> Any:
-        selectors = split_selector(selector_str)
-        return self.cache.select(selectors)
+    def _connect(self, path: Path) -> sqlite3.Connection:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # autocommit mode, transactions are managed explicitly
+        conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        # WAL allows readers to continue while another process appends
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY, selector TEXT NOT NULL, value TEXT NOT NULL)"
+        )
+        return conn
 
-    def is_cached(self, selector_str: str) -> bool:
-        selectors = split_selector(selector_str)
-        return self.cache.is_cached(selectors)
+    def _stat_file(self, path: Path) -> tuple[int, ...]:
+        """
+        (inode, mtime, size) of the database and its write-ahead log.
+        Any append by another process changes at least one of them.
+        """
+        stamp: list[int] = []
+        for file in [path, path.with_name(f"{path.name}-wal")]:
+            try:
+                st = file.stat()
+            except FileNotFoundError:
+                stamp += [0, 0, 0]
+            else:
+                stamp += [st.st_ino, st.st_mtime_ns, st.st_size]
+        return tuple(stamp)
+
+    def _replay(self, conn: sqlite3.Connection) -> None:
+        rows = conn.execute(
+            "SELECT id, selector, value FROM entries WHERE id > ? ORDER BY id",
+            (self._last_row_id,),
+        )
+        for row_id, selector_str, value in rows:
+            self._insert(json.loads(value), selector_str)
+            self._last_row_id = row_id
 
     def save_to_file(self, path: Path) -> None:
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("wb") as f:
-            pickle.dump(self.cache, f)
+        with self._lock:
+            self._save_to_file(path)
+
+    def _save_to_file(self, path: Path) -> None:
+        if not self._unsaved:
+            return
+        with closing(self._connect(path)) as conn:
+            # take the write lock first, so no other writer can append
+            # between replaying their entries and appending ours
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._replay(conn)
+                conn.executemany(
+                    "INSERT INTO entries (selector, value) VALUES (?, ?)",
+                    [
+                        (selector_str, json.dumps(data))
+                        for selector_str, data in self._unsaved
+                    ],
+                )
+                (last_row_id,) = conn.execute("SELECT max(id) FROM entries").fetchone()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        self._last_row_id = last_row_id
+        self._unsaved.clear()
+        self._file_stamp = self._stat_file(path)
 
     def load_from_file(self, path: Path) -> None:
+        with self._lock:
+            self._load_from_file(path)
+
+    def _load_from_file(self, path: Path) -> None:
+        # Skip the reload if nobody wrote to the file since we last read it.
+        # The stamp is taken after reading, so a concurrent append can be missed,
+        # but that only causes a cache miss whose save replays the entry anyway.
+        if self._stat_file(path) == self._file_stamp:
+            return
         if path.exists():
-            with path.open("rb") as f:
-                self.cache = pickle.load(f)
+            with closing(self._connect(path)) as conn:
+                self._replay(conn)
+        self._file_stamp = self._stat_file(path)
 
 
 @dataclass
@@ -350,14 +480,20 @@ class Flake:
     """
     This class represents a flake, and is used to interact with it.
     values can be accessed using the select method, which will fetch the value from the cache if it is present.
+    Machines share their flake, so it can be used from several threads.
     """
 
     identifier: str
 
     def __post_init__(self) -> None:
         self._cache: FlakeCache | None = None
+        self._hash: str | None = None
         self._path: Path | None = None
         self._is_local: bool | None = None
+        self.store_path: str | None = None
+        self.flake_cache_path: Path | None = None
+        # guards the values set by prefetch
+        self._lock = threading.RLock()
 
     @classmethod
     def from_json(cls: type["Flake"], data: dict[str, Any]) -> "Flake":
@@ -376,19 +512,57 @@ class Flake:
 
     @property
     def is_local(self) -> bool:
-        if self._is_local is None:
-            self.prefetch()
-        assert isinstance(self._is_local, bool)
-        return self._is_local
+        with self._lock:
+            if self._is_local is None:
+                self.prefetch()
+            assert isinstance(self._is_local, bool)
+            return self._is_local
 
     @property
     def path(self) -> Path:
-        if self._path is None:
-            self.prefetch()
-        assert isinstance(self._path, Path)
-        return self._path
+        with self._lock:
+            if self._path is None:
+                self.prefetch()
+            assert isinstance(self._path, Path)
+            return self._path
+
+    @property
+    def hash(self) -> str:
+        """narHash of the flake, as of the last prefetch"""
+        with self._lock:
+            if self._hash is None:
+                self.prefetch()
+            assert isinstance(self._hash, str)
+            return self._hash
+
+    def invalidate_cache(self) -> None:
+        """
+        Prefetch the flake again on the next access.
+        Call this after changing the flake, so values are evaluated for the new narHash.
+        Threads that are selecting a value finish with the cache they started with.
+        """
+        with self._lock:
+            self._cache = None
+            self._hash = None
+
+    def _prefetched(self) -> tuple[FlakeCache, Path, str | None, str | None]:
+        """
+        The cache of the last prefetch, with its file, store path and narHash.
+        They are read together, so a concurrent invalidate_cache() cannot mix
+        the values of two prefetches. Prefetches first if needed.
+        """
+        with self._lock:
+            if self._cache is None:
+                self.prefetch()
+            assert self._cache is not None
+            assert self.flake_cache_path is not None
+            return self._cache, self.flake_cache_path, self.store_path, self._hash
 
     def prefetch(self) -> None:
+        with self._lock:
+            self._prefetch()
+
+    def _prefetch(self) -> None:
         flake_prefetch = run(
             nix_command(
                 [
@@ -403,14 +577,19 @@ class Flake:
             )
         )
         flake_metadata = json.loads(flake_prefetch.stdout)
-        self.store_path = flake_metadata["storePath"]
-        self.hash = flake_metadata["hash"]
+        nar_hash = flake_metadata["hash"]
+        cache = FlakeCache()
+        hashed_hash = sha1(nar_hash.encode()).hexdigest()
+        cache_path = (
+            Path(user_cache_dir()) / "clan" / "flakes" / f"{hashed_hash}.sqlite"
+        )
+        if cache_path.exists():
+            cache.load_from_file(cache_path)
 
-        self._cache = FlakeCache()
-        hashed_hash = sha1(self.hash.encode()).hexdigest()
-        self.flake_cache_path = Path(user_cache_dir()) / "clan" / "flakes" / hashed_hash
-        if self.flake_cache_path.exists():
-            self._cache.load_from_file(self.flake_cache_path)
+        self.store_path = flake_metadata["storePath"]
+        self._hash = nar_hash
+        self.flake_cache_path = cache_path
+        self._cache = cache
 
         if flake_metadata["original"].get("url", "").startswith("file:"):
             self._is_local = True
@@ -422,39 +601,64 @@ class Flake:
             self._path = Path(flake_metadata["original"]["path"])
         else:
             self._is_local = False
-            self._path = Path(self.store_path)
+            self._path = Path(flake_metadata["storePath"])
 
     def get_from_nix(self, selectors: list[str]) -> None:
-        if self._cache is None:
-            self.prefetch()
-        assert self._cache is not None
+        self._get_from_nix(selectors, *self._prefetched())
 
+    def _get_from_nix(
+        self,
+        selectors: list[str],
+        cache: FlakeCache,
+        cache_path: Path,
+        store_path: str | None,
+        nar_hash: str | None,
+    ) -> None:
+        assert store_path is not None
+        assert nar_hash is not None
         config = nix_config()
+        select_exprs = " ".join(
+            f'(flake.clanInternals.lib.select "{attr}" flake)' for attr in selectors
+        )
         nix_code = f"""
             let
-              flake = builtins.getFlake("path:{self.store_path}?narHash={self.hash}");
+              flake = builtins.getFlake("path:{store_path}?narHash={nar_hash}");
             in
-              flake.inputs.nixpkgs.legacyPackages.{config["system"]}.writeText "clan-flake-select" (builtins.toJSON [ ({" ".join([f'flake.clanInternals.lib.select "{attr}" flake' for attr in selectors])}) ])
+              flake.inputs.nixpkgs.legacyPackages.{config["system"]}.writeText "clan-flake-select" (builtins.toJSON [ {select_exprs} ])
         """
         build_output = Path(run(nix_build(["--expr", nix_code])).stdout.strip())
         if tmp_store := nix_test_store():
             build_output = tmp_store.joinpath(*build_output.parts[1:])
         outputs = json.loads(build_output.read_text())
         if len(outputs) != len(selectors):
-            msg = f"flake_prepare_cache: Expected {len(outputs)} outputs, got {len(outputs)}"
+            msg = f"flake_prepare_cache: Expected {len(selectors)} outputs, got {len(outputs)}"
             raise ClanError(msg)
-        self._cache.load_from_file(self.flake_cache_path)
         for i, selector in enumerate(selectors):
-            self._cache.insert(outputs[i], selector)
-        self._cache.save_to_file(self.flake_cache_path)
+            cache.insert(outputs[i], selector)
+        # also picks up entries that other processes appended in the meantime
+        cache.save_to_file(cache_path)
 
-    def select(self, selector: str) -> Any:
-        if self._cache is None:
-            self.prefetch()
-        assert self._cache is not None
+    def precache(self, selectors: list[str]) -> None:
+        """
+        Resolve all selectors that are not cached yet in a single nix evaluation.
+        Commands that know upfront which values they need should call this
+        before selecting them one by one.
+        """
+        cache, cache_path, _, _ = self._prefetched()
+        cache.load_from_file(cache_path)
+        not_cached = [
+            selector for selector in selectors if not cache.is_cached(selector)
+        ]
+        if not_cached:
+            log.info(f"Cache miss for {', '.join(not_cached)}")
+            self.get_from_nix(not_cached)
 
-        self._cache.load_from_file(self.flake_cache_path)
-        if not self._cache.is_cached(selector):
+    def select(self, selector: str) -> Any:
+        prefetched = self._prefetched()
+        cache, cache_path, _, _ = prefetched
+        if not cache.is_cached(selector):
+            cache.load_from_file(cache_path)
+        if not cache.is_cached(selector):
             log.info(f"Cache miss for {selector}")
-            self.get_from_nix([selector])
-        return self._cache.select(selector)
+            self._get_from_nix([selector], *prefetched)
+        return cache.select(selector)
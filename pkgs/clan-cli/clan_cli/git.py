@@ -1,9 +1,13 @@
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
 
 from .cmd import Log, RunOpts, run
 from .errors import ClanError
 from .locked_open import locked_open
-from .nix import run_cmd
+from .nix import nix_shell_program, run_cmd
 
 
 def commit_file(
@@ -21,6 +25,73 @@ def commit_file(
     commit_files([file_path], repo_dir, commit_message)
 
 
+class GitTransaction:
+    """Collects the files of every commit_files() call for a repository,
+    so that they end up in a single commit.
+
+    :param repo_dir: The path to the git repository.
+    :param commit_message: The commit message, the messages of the collected
+        commits are appended to it.
+    """
+
+    def __init__(self, repo_dir: Path, commit_message: str) -> None:
+        self.repo_dir = repo_dir
+        self.commit_message = commit_message
+        self.file_paths: list[Path] = []
+        self.messages: list[str] = []
+        self._lock = threading.Lock()
+
+    def add(self, file_paths: list[Path], commit_message: str) -> None:
+        with self._lock:
+            self.file_paths.extend(file_paths)
+            if commit_message not in self.messages:
+                self.messages.append(commit_message)
+
+    def commit(self) -> None:
+        with self._lock:
+            file_paths = list(dict.fromkeys(self.file_paths))
+            if len(self.messages) == 1:
+                commit_message = self.messages[0]
+            else:
+                commit_message = "\n\n".join(
+                    [self.commit_message, "\n".join(self.messages)]
+                )
+            self.file_paths.clear()
+            self.messages.clear()
+        if file_paths and (self.repo_dir / ".git").exists():
+            _commit_file_to_git(self.repo_dir, file_paths, commit_message)
+
+
+# the open transactions by repository. Threads that should join them must run
+# in a copy of the context, see contextvars.copy_context().
+_transactions: ContextVar[dict[Path, GitTransaction]] = ContextVar("git_transactions")
+
+
+@contextmanager
+def commit_transaction(repo_dir: Path, commit_message: str) -> Iterator[GitTransaction]:
+    """Batch all commits to `repo_dir` made within the context into one commit.
+
+    The commit is made when the context is left, also if it is left with an
+    exception, as the files have been changed on disk already.
+    Nested transactions for the same repository join the outermost one.
+    Transactions belong to the current context, unrelated threads that commit
+    to the same repository at the same time make their own commits.
+    """
+    key = repo_dir.resolve()
+    transactions = _transactions.get({})
+    outer = transactions.get(key)
+    if outer is not None:
+        yield outer
+        return
+    transaction = GitTransaction(repo_dir, commit_message)
+    token = _transactions.set({**transactions, key: transaction})
+    try:
+        yield transaction
+    finally:
+        _transactions.reset(token)
+        transaction.commit()
+
+
 # generic vcs agnostic commit function
 def commit_files(
     file_paths: list[Path],
@@ -40,6 +111,10 @@ def commit_files(
         for file_path in file_paths:
             # ensure that mentioned file path is relative to repo
             commit_message += f"Add {file_path.relative_to(repo_dir)}"
+    transaction = _transactions.get({}).get(repo_dir.resolve())
+    if transaction is not None:
+        transaction.add(file_paths, commit_message)
+        return
     # check if the repo is a git repo and commit
     if (repo_dir / ".git").exists():
         _commit_file_to_git(repo_dir, file_paths, commit_message)
@@ -67,34 +142,57 @@ def _commit_file_to_git(
             raise ClanError(msg)
         real_git_dir = repo_dir / actual_git_dir[len("gitdir: ") :]
 
+    # NUL separated, so that no path needs quoting
+    pathspec = b"".join(bytes(file_path) + b"\0" for file_path in file_paths)
+    pathspec_args = ["--pathspec-from-file=-", "--pathspec-file-nul"]
+
     with locked_open(real_git_dir / "clan.lock", "w+"):
-        for file_path in file_paths:
-            cmd = run_cmd(
-                ["git"],
-                ["git", "-C", str(repo_dir), "add", "--", str(file_path)],
-            )
-            # add the file to the git index
-
-            run(
-                cmd,
-                RunOpts(
-                    log=Log.BOTH,
-                    error_msg=f"Failed to add {file_path} file to git index",
-                ),
-            )
-
-        # check if there is a diff
+        # add the files to the git index
         cmd = run_cmd(
             ["git"],
-            ["git", "-C", str(repo_dir), "diff", "--cached", "--exit-code", "--"]
-            + [str(file_path) for file_path in file_paths],
+            ["git", "-C", str(repo_dir), "add", *pathspec_args],
         )
-        result = run(cmd, RunOpts(check=False, cwd=repo_dir))
+        run(
+            cmd,
+            RunOpts(
+                input=pathspec,
+                log=Log.BOTH,
+                error_msg=f"Failed to add {file_paths} to git index",
+            ),
+        )
+
+        # check if there is a diff, the paths are not passed as arguments,
+        # as there can be more of them than fit on a command line
+        cmd = run_cmd(
+            ["git"],
+            [
+                "git",
+                "-C",
+                str(repo_dir),
+                "diff",
+                "--cached",
+                "--name-only",
+                "--relative",
+                "-z",
+            ],
+        )
+        result = run(cmd, RunOpts(cwd=repo_dir))
+        staged = [Path(name) for name in result.stdout.split("\0") if name]
+        # only resolve the parent, the paths themselves can be symlinks
+        prefixes = {
+            (
+                (repo_dir / file_path).parent.resolve() / Path(file_path).name
+            ).relative_to(repo_dir.resolve())
+            for file_path in file_paths
+        }
         # if there is no diff, return
-        if result.returncode == 0:
+        if not any(
+            name in prefixes or any(parent in prefixes for parent in name.parents)
+            for name in staged
+        ):
             return
 
-        # commit only that file
+        # commit only these files
         cmd = run_cmd(
             ["git"],
             [
@@ -105,13 +203,72 @@ def _commit_file_to_git(
                 "-m",
                 commit_message,
                 "--no-verify",  # dont run pre-commit hooks
-            ]
-            + [str(file_path) for file_path in file_paths],
+                *pathspec_args,
+            ],
         )
 
         run(
             cmd,
             RunOpts(
-                error_msg=f"Failed to commit {file_paths} to git repository {repo_dir}"
+                input=pathspec,
+                error_msg=f"Failed to commit {file_paths} to git repository {repo_dir}",
             ),
         )
+
+
+# (repo_dir, pathspec) -> (HEAD, last commits)
+_last_commits: dict[tuple[Path, str], tuple[str, dict[str, str]]] = {}
+_last_commits_lock = threading.Lock()
+
+
+def last_commits(repo_dir: Path, pathspec: str) -> dict[str, str]:
+    """Return the last commit that changed `pathspec` and every file below it.
+
+    The history is walked once with a single git log, the result is kept
+    until HEAD of the repository changes.
+
+    :param repo_dir: The path to the git repository.
+    :param pathspec: A path relative to `repo_dir`.
+    :return: commit hashes by path relative to `repo_dir`,
+        the last commit of `pathspec` itself is stored under `pathspec`.
+    """
+    git = nix_shell_program("nixpkgs#git", "git")
+    head = run(
+        [git, "-C", str(repo_dir), "rev-parse", "HEAD"],
+        RunOpts(log=Log.NONE, check=False),
+    ).stdout.strip()
+    key = (repo_dir, pathspec)
+    with _last_commits_lock:
+        cached = _last_commits.get(key)
+    if cached is not None and cached[0] == head:
+        return cached[1]
+
+    # newest first: \x01<hash>\0\n<file>\0<file>\0\0\x01<hash>...
+    out = run(
+        [
+            git,
+            "-C",
+            str(repo_dir),
+            "log",
+            "--format=%x01%H",
+            "--name-only",
+            "-z",
+            "--relative",
+            "--",
+            pathspec,
+        ],
+        RunOpts(log=Log.NONE, check=False),
+    ).stdout
+    commits: dict[str, str] = {}
+    commit = None
+    for token in out.split("\0"):
+        token = token.lstrip("\n")
+        if token.startswith("\x01"):
+            commit = token[1:]
+            commits.setdefault(pathspec, commit)
+        elif token and commit is not None:
+            commits.setdefault(token, commit)
+
+    with _last_commits_lock:
+        _last_commits[key] = (head, commits)
+    return commits
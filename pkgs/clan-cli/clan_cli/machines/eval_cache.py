@@ -0,0 +1,94 @@
+"""
+A disk cache for the results of `Machine.eval_nix()` and `Machine.build_nix()`,
+shared between cli invocations.
+
+Entries are keyed by the narHash of the flake, so they never become stale.
+The least recently used entries are dropped when the cache grows beyond its size limit.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+
+from clan_cli.dirs import user_cache_dir
+
+log = logging.getLogger(__name__)
+
+# bytes of keys and values kept in the cache
+MAX_SIZE = 32 * 1024 * 1024
+
+
+def default_cache_path() -> Path:
+    return user_cache_dir() / "clan" / "machine-eval.sqlite"
+
+
+class MachineEvalCache:
+    def __init__(self, path: Path | None = None, max_size: int = MAX_SIZE) -> None:
+        self.path = path or default_cache_path()
+        self.max_size = max_size
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        return conn
+
+    @staticmethod
+    def key(
+        flake_hash: str,
+        machine: str,
+        method: str,
+        attr: str,
+        nix_options: list[str],
+    ) -> str:
+        return json.dumps([flake_hash, machine, method, attr, nix_options])
+
+    def get(self, key: str) -> str | None:
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    "SELECT value FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE entries SET last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                return row[0]
+        except sqlite3.Error as e:
+            log.debug(f"failed to read {self.path}", exc_info=e)
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO entries (key, value, size, last_used) "
+                        "VALUES (?, ?, ?, ?)",
+                        (key, value, len(key) + len(value), time.time()),
+                    )
+                    # drop everything beyond the most recently used max_size bytes
+                    conn.execute(
+                        "DELETE FROM entries WHERE key IN ("
+                        "SELECT key FROM ("
+                        "SELECT key, SUM(size) OVER (ORDER BY last_used DESC) AS total "
+                        "FROM entries) WHERE total > ?)",
+                        (self.max_size,),
+                    )
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            log.debug(f"failed to write {self.path}", exc_info=e)
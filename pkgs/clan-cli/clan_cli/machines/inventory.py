@@ -1,9 +1,5 @@
-import json
-from pathlib import Path
-
-from clan_cli.cmd import run
 from clan_cli.flake import Flake
-from clan_cli.nix import nix_build, nix_config, nix_test_store
+from clan_cli.nix import nix_config
 
 from .machines import Machine
 
@@ -12,17 +8,11 @@ from .machines import Machine
 def get_all_machines(flake: Flake, nix_options: list[str]) -> list[Machine]:
     config = nix_config()
     system = config["system"]
-    json_path = Path(
-        run(
-            nix_build([f'{flake}#clanInternals.all-machines-json."{system}"'])
-        ).stdout.rstrip()
+    # goes through the flake cache, which is kept until the flake hash changes
+    machines_json = flake.select(
+        f"clanInternals.machines.{system}.*.config.system.clan.deployment.data"
     )
 
-    if test_store := nix_test_store():
-        json_path = test_store.joinpath(*json_path.parts[1:])
-
-    machines_json = json.loads(json_path.read_text())
-
     machines = []
     for name, machine_data in machines_json.items():
         machines.append(
@@ -39,7 +29,23 @@ def get_all_machines(flake: Flake, nix_options: list[str]) -> list[Machine]:
 def get_selected_machines(
     flake: Flake, nix_options: list[str], machine_names: list[str]
 ) -> list[Machine]:
+    config = nix_config()
+    system = config["system"]
+    selectors = {
+        name: f"clanInternals.machines.{system}.{name}.config.system.clan.deployment.data"
+        for name in machine_names
+    }
+    # fetch the deployment data of all selected machines in a single evaluation
+    flake.precache(list(selectors.values()))
+
     machines = []
     for name in machine_names:
-        machines.append(Machine(name=name, flake=flake, nix_options=nix_options))
+        machines.append(
+            Machine(
+                name=name,
+                flake=flake,
+                cached_deployment=flake.select(selectors[name]),
+                nix_options=nix_options,
+            )
+        )
     return machines
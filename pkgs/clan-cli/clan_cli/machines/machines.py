@@ -10,9 +10,11 @@ from typing import TYPE_CHECKING, Any, Literal
 
 from clan_cli.cmd import RunOpts, run_no_stdout
 from clan_cli.errors import ClanError
+from clan_cli.eval_server import eval_server_request, eval_server_socket
 from clan_cli.facts import public_modules as facts_public_modules
 from clan_cli.facts import secret_modules as facts_secret_modules
 from clan_cli.flake import Flake
+from clan_cli.machines.eval_cache import MachineEvalCache
 from clan_cli.nix import nix_build, nix_config, nix_eval, nix_metadata, nix_test_store
 from clan_cli.ssh.host import Host
 from clan_cli.ssh.host_key import HostKeyCheck
@@ -45,6 +47,7 @@ class Machine:
         self.cached_deployment = None
         self._build_cache.clear()
         self._eval_cache.clear()
+        self.flake.invalidate_cache()
 
     def __str__(self) -> str:
         return f"Machine(name={self.name}, flake={self.flake})"
@@ -311,6 +314,70 @@ class Machine:
             ).stdout.strip()
         )
 
+    def nix_via_eval_server(
+        self,
+        method: Literal["eval", "build"],
+        attr: str,
+        nix_options: list[str],
+        refresh: bool = False,
+    ) -> str | None:
+        """
+        Ask a running `clan eval-server` for the attribute
+        returns None if no eval server is reachable
+        """
+        socket_path = eval_server_socket()
+        if socket_path is None:
+            return None
+        # the server runs in a different directory, send it an absolute path
+        flake = str(self.flake.path) if self.flake.is_local else self.flake.identifier
+        request = {
+            "method": method,
+            "flake": flake,
+            "hash": self.flake.hash,
+            "machine": self.name,
+            "attr": attr,
+            "nix_options": nix_options + self.nix_options,
+            "refresh": refresh,
+        }
+        try:
+            return eval_server_request(socket_path, request)
+        except OSError as e:
+            self.debug(f"eval server at {socket_path} is not reachable", exc_info=e)
+            return None
+
+    def nix_cached(
+        self,
+        method: Literal["eval", "build"],
+        attr: str,
+        nix_options: list[str],
+        refresh: bool = False,
+    ) -> str:
+        """
+        Like nix(), but reuses results of earlier cli invocations on the same flake
+        from the disk cache, and asks a running eval server before starting nix.
+        With `refresh` the disk cache is only updated.
+        """
+        cache = MachineEvalCache()
+        key = cache.key(
+            self.flake.hash, self.name, method, attr, nix_options + self.nix_options
+        )
+        output = None if refresh else cache.get(key)
+        if output is not None:
+            if method == "eval":
+                return output
+            path = Path(output)
+            if tmp_store := nix_test_store():
+                path = tmp_store.joinpath(*path.parts[1:])
+            # the build result might have been garbage collected
+            if path.exists():
+                return output
+
+        output = self.nix_via_eval_server(method, attr, nix_options, refresh)
+        if output is None:
+            output = str(self.nix(method, attr, None, nix_options))
+        cache.set(key, output)
+        return output
+
     def eval_nix(
         self,
         attr: str,
@@ -327,7 +394,11 @@ class Machine:
         if attr in self._eval_cache and not refresh and extra_config is None:
             return self._eval_cache[attr]
 
-        output = self.nix("eval", attr, extra_config, nix_options)
+        output: str | Path
+        if extra_config is None:
+            output = self.nix_cached("eval", attr, nix_options, refresh)
+        else:
+            output = self.nix("eval", attr, extra_config, nix_options)
         if isinstance(output, str):
             self._eval_cache[attr] = output
             return output
@@ -351,7 +422,11 @@ class Machine:
         if attr in self._build_cache and not refresh and extra_config is None:
             return self._build_cache[attr]
 
-        output = self.nix("build", attr, extra_config, nix_options)
+        output: str | Path
+        if extra_config is None:
+            output = Path(self.nix_cached("build", attr, nix_options, refresh))
+        else:
+            output = self.nix("build", attr, extra_config, nix_options)
         assert isinstance(output, Path), "Nix build did not result in a single path"
         if tmp_store := nix_test_store():
             output = tmp_store.joinpath(*output.parts[1:])
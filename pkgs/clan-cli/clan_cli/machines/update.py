@@ -5,6 +5,12 @@ import os
 import re
 import shlex
 import sys
+import threading
+import urllib.parse
+from collections.abc import Callable
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, TypeVar
 
 from clan_cli.api import API
 from clan_cli.async_run import AsyncContext, AsyncOpts, AsyncRuntime, is_async_cancelled
@@ -13,12 +19,14 @@ from clan_cli.colors import AnsiColor
 from clan_cli.completions import (
     add_dynamic_completer,
     complete_machines,
+    complete_tags,
 )
 from clan_cli.errors import ClanError
 from clan_cli.facts.generate import generate_facts
 from clan_cli.facts.upload import upload_secrets
 from clan_cli.flake import Flake
 from clan_cli.inventory import Machine as InventoryMachine
+from clan_cli.inventory import load_inventory_eval
 from clan_cli.machines.machines import Machine
 from clan_cli.nix import nix_command, nix_metadata
 from clan_cli.ssh.host import Host, HostKeyCheck
@@ -42,14 +50,67 @@ def is_local_input(node: dict[str, dict[str, str]]) -> bool:
     )
 
 
-def upload_sources(machine: Machine) -> str:
-    host = machine.build_host
-    env = host.nix_ssh_env(os.environ.copy())
+T = TypeVar("T")
 
-    flake_url = (
-        str(machine.flake.path) if machine.flake.is_local else machine.flake.identifier
-    )
-    flake_data = nix_metadata(flake_url)
+
+class SourceUploads:
+    """
+    Uploads the sources of a flake once per build host during a deployment.
+    The flake metadata is looked up once per narHash of the flake, generating
+    values for a machine changes the narHash.
+    Deployments that need sources which are already being uploaded
+    to their build host wait for that upload instead of starting another one.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.metadata: dict[tuple[str, str], Future[dict[str, Any]]] = {}
+        self.uploads: dict[tuple[str, str, int | None], Future[str]] = {}
+
+    def _once(self, futures: dict[Any, Future[T]], key: Any, fn: Callable[[], T]) -> T:
+        with self.lock:
+            future = futures.get(key)
+            owner = future is None
+            if future is None:
+                future = futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def upload(self, machine: Machine) -> str:
+        host = machine.build_host
+        flake_url = (
+            str(machine.flake.path)
+            if machine.flake.is_local
+            else machine.flake.identifier
+        )
+        flake_data = self._once(
+            self.metadata,
+            (flake_url, machine.flake.hash),
+            lambda: nix_metadata(flake_url),
+        )
+        # the store path of the flake is determined by its narHash
+        key = (flake_data["path"], host.target, host.port)
+        return self._once(
+            self.uploads,
+            key,
+            lambda: _upload_flake(machine, host, flake_url, flake_data),
+        )
+
+
+def upload_sources(machine: Machine, uploads: SourceUploads | None = None) -> str:
+    if uploads is None:
+        uploads = SourceUploads()
+    return uploads.upload(machine)
+
+
+def _upload_flake(
+    machine: Machine, host: Host, flake_url: str, flake_data: dict[str, Any]
+) -> str:
+    env = host.nix_ssh_env(os.environ.copy())
     has_path_inputs = any(
         is_local_input(node) for node in flake_data["locks"]["nodes"].values()
     )
@@ -119,22 +180,206 @@ def update_machines(base_path: str, machines: list[InventoryMachine]) -> None:
     deploy_machines(group_machines)
 
 
-def deploy_machines(machines: list[Machine]) -> None:
+def build_host_first(machines: list[Machine]) -> list[Machine]:
+    """
+    Orders machines that are the build host of another machine first,
+    so they are up to date before building for others.
+    """
+    build_hosts = set()
+    for machine in machines:
+        try:
+            if machine.override_build_host or machine.deployment.get("buildHost"):
+                build_hosts.add(machine.build_host.host)
+        except ClanError:
+            # reported when deploying the machine
+            continue
+
+    def is_build_host(machine: Machine) -> bool:
+        try:
+            return machine.target_host.host in build_hosts
+        except ClanError:
+            return False
+
+    return sorted(machines, key=lambda machine: not is_build_host(machine))
+
+
+def deployment_batches(
+    machines: list[Machine],
+    batch_tags: list[str],
+    machine_tags: dict[str, list[str]],
+) -> list[list[Machine]]:
+    """
+    Splits machines into one batch per tag in `batch_tags`, in that order,
+    followed by a batch of the machines that have none of the tags.
+    A machine is deployed in the batch of the first of its tags.
+    """
+    batches: list[list[Machine]] = [[] for _ in range(len(batch_tags) + 1)]
+    for machine in machines:
+        tags = machine_tags.get(machine.name, [])
+        index = next(
+            (i for i, tag in enumerate(batch_tags) if tag in tags), len(batch_tags)
+        )
+        batches[index].append(machine)
+    return [build_host_first(batch) for batch in batches if batch]
+
+
+def build_toplevels(machines: list[Machine]) -> dict[str, Path]:
     """
-    Deploy to all hosts in parallel
+    Build the system of all machines locally in one nix invocation,
+    so the flake is evaluated once and nix schedules all builds together.
+    Builds the same attribute as `nixos-rebuild --flake`, with the nixpkgs
+    and platform of the machine.
+    Returns the store path of every machine by name.
     """
+    groups: dict[tuple[Path, tuple[str, ...]], list[Machine]] = {}
+    for machine in machines:
+        key = (machine.flake_dir, tuple(machine.nix_options))
+        groups.setdefault(key, []).append(machine)
 
-    def deploy(machine: Machine) -> None:
-        host = machine.build_host
+    toplevels = {}
+    for (flake_dir, nix_options), group in groups.items():
+        if (flake_dir / ".git").exists():
+            flake = f"git+file://{flake_dir}"
+        else:
+            flake = f"path:{flake_dir}"
+        installables = [
+            f'{flake}#nixosConfigurations."{machine.name}".config.system.build.toplevel'
+            for machine in group
+        ]
+        cmd = nix_command(
+            [
+                "build",
+                "--json",
+                "--no-link",
+                "--print-build-logs",
+                "--keep-going",
+                *installables,
+                *nix_options,
+            ]
+        )
+        proc = run(cmd, RunOpts(error_msg="failed to build the machines"))
+        try:
+            results = json.loads(proc.stdout)
+            for machine, result in zip(group, results, strict=True):
+                toplevels[machine.name] = Path(result["outputs"]["out"])
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            msg = (
+                f"failed to parse output of {shlex.join(cmd)}: {e}\nGot: {proc.stdout}"
+            )
+            raise ClanError(msg) from e
+    return toplevels
+
+
+def nix_copy_url(host: Host) -> str:
+    """
+    The store of `host` for copying unsigned paths built locally.
+    Only trusted users may add them, a user other than root talks to
+    a nix daemon started with sudo, like `Host.run` with `become_root`.
+    """
+    if host.user is None or host.user == "root":
+        return f"ssh://{host.target}"
+    remote_program = urllib.parse.quote("sudo -- nix-daemon", safe="")
+    return f"ssh-ng://{host.target}?remote-program={remote_program}"
+
+
+def activate_toplevel(machine: Machine, toplevel: Path) -> None:
+    """
+    Copy a system built locally to the machine and switch to it.
+    """
+    host = machine.target_host
+    env = host.nix_ssh_env(os.environ.copy())
+    run(
+        nix_command(
+            ["copy", "--to", nix_copy_url(host), "--no-check-sigs", str(toplevel)]
+        ),
+        RunOpts(env=env, error_msg="failed to upload the system", prefix=machine.name),
+    )
+
+    host.run(
+        ["nix-env", "-p", "/nix/var/nix/profiles/system", "--set", str(toplevel)],
+        RunOpts(msg_color=MsgColor(stderr=AnsiColor.DEFAULT)),
+        become_root=True,
+    )
+    switch_cmd = [str(toplevel / "bin" / "switch-to-configuration"), "switch"]
+    ret = host.run(
+        switch_cmd,
+        RunOpts(check=False, msg_color=MsgColor(stderr=AnsiColor.DEFAULT)),
+        become_root=True,
+    )
+    if ret.returncode == 0 or is_async_cancelled():
+        return
+
+    # same fallbacks as nixos-rebuild in deploy_machines
+    if machine.deployment.get("nixosMobileWorkaround", False):
+        machine.info("Mobile machine detected, applying workaround deployment method")
+        switch_cmd[-1] = "test"
+    host.run(
+        switch_cmd,
+        RunOpts(msg_color=MsgColor(stderr=AnsiColor.DEFAULT)),
+        become_root=True,
+    )
+
+
+def deploy_machines(
+    machines: list[Machine],
+    max_parallel: int | None = None,
+    batches: list[list[Machine]] | None = None,
+    max_failures: int | None = None,
+    build_locally: bool = False,
+) -> None:
+    """
+    Deploy to all hosts in parallel, at most `max_parallel` at a time.
+    If `batches` is given, it is deployed instead of `machines`.
+    Batches are deployed one after the other, the next one starts when
+    every machine of the previous one is done.
+    After `max_failures` failed deployments no further machines are started.
+    With `build_locally`, all machines are built here at once
+    and only the results are copied to them.
+    Facts and vars of all machines are generated before the first deployment.
+    """
+    if max_parallel is not None and max_parallel < 1:
+        msg = f"max_parallel must be at least 1, got {max_parallel}"
+        raise ClanError(msg)
+    if batches is None:
+        batches = [build_host_first(machines)]
+
+    def generate(machine: Machine) -> None:
         generate_facts([machine], service=None, regenerate=False)
         generate_vars([machine], generator_name=None, regenerate=False)
 
+    # Generating changes the flake that all machines share and invalidates its
+    # cache, so it runs for every machine before the deployments start.
+    # A failed generation fails the deployment of the machine, not all of them.
+    generate_errors: dict[str, Exception] = {}
+    generated = []
+    for machine in [machine for batch in batches for machine in batch]:
+        try:
+            generate(machine)
+        except Exception as e:
+            machine.error(f"Failed to generate facts and vars: {e}")
+            generate_errors[machine.name] = e
+        else:
+            generated.append(machine)
+
+    toplevels: dict[str, Path] = {}
+    if build_locally and generated:
+        toplevels = build_toplevels(generated)
+    uploads = SourceUploads()
+
+    def deploy(machine: Machine) -> None:
+        if machine.name in generate_errors:
+            raise generate_errors[machine.name]
+        if build_locally:
+            upload_secrets(machine)
+            upload_secret_vars(machine)
+            activate_toplevel(machine, toplevels[machine.name])
+            return
+
+        host = machine.build_host
         upload_secrets(machine)
         upload_secret_vars(machine)
 
-        path = upload_sources(
-            machine=machine,
-        )
+        path = upload_sources(machine, uploads)
 
         nix_options = [
             "--show-trace",
@@ -160,7 +405,8 @@ def deploy_machines(machines: list[Machine]) -> None:
             switch_cmd.extend(["--target-host", target_host.target])
             test_cmd.extend(["--target-host", target_host.target])
 
-        env = host.nix_ssh_env(None)
+        # nixos-rebuild runs on the build host, where our ssh sockets do not exist
+        env = host.nix_ssh_env(None, control_master=False)
         ret = host.run(
             switch_cmd,
             RunOpts(check=False, msg_color=MsgColor(stderr=AnsiColor.DEFAULT)),
@@ -195,17 +441,49 @@ def deploy_machines(machines: list[Machine]) -> None:
                 extra_env=env,
             )
 
+    failures = 0
+    skipped: list[Machine] = []
+
+    def budget_left() -> bool:
+        return max_failures is None or failures < max_failures
+
     with AsyncRuntime() as runtime:
-        for machine in machines:
-            machine.info(f"Updating {machine.name}")
-            runtime.async_run(
-                AsyncOpts(
-                    tid=machine.name, async_ctx=AsyncContext(prefix=machine.name)
-                ),
-                deploy,
-                machine,
-            )
+        for index, batch in enumerate(batches):
+            pending = list(batch)
+            running: list[str] = []
+            while running or (pending and budget_left()):
+                while (
+                    pending
+                    and budget_left()
+                    and (max_parallel is None or len(running) < max_parallel)
+                ):
+                    machine = pending.pop(0)
+                    machine.info(f"Updating {machine.name}")
+                    runtime.async_run(
+                        AsyncOpts(
+                            tid=machine.name,
+                            async_ctx=AsyncContext(prefix=machine.name),
+                        ),
+                        deploy,
+                        machine,
+                    )
+                    running.append(machine.name)
+                for tid in runtime.wait_any(running):
+                    running.remove(tid)
+                    result = runtime.tasks[tid].result
+                    if result is not None and result.error is not None:
+                        failures += 1
+            if not budget_left():
+                skipped.extend(pending)
+                for later in batches[index + 1 :]:
+                    skipped.extend(later)
+                break
         runtime.join_all()
+        if skipped:
+            log.error(
+                f"Stopped after {failures} failed deployments, not updated: "
+                + ", ".join(machine.name for machine in skipped)
+            )
         runtime.check_all()
 
 
@@ -258,7 +536,22 @@ def update_command(args: argparse.Namespace) -> None:
                     machine.override_build_host = args.build_host
                     machine.host_key_check = HostKeyCheck.from_str(args.host_key_check)
 
-        deploy_machines(machines)
+        batches = None
+        if args.batch_tag:
+            inventory = load_inventory_eval(args.flake.path)
+            machine_tags = {
+                name: machine.get("tags", [])
+                for name, machine in inventory.get("machines", {}).items()
+            }
+            batches = deployment_batches(machines, args.batch_tag, machine_tags)
+
+        deploy_machines(
+            machines,
+            max_parallel=args.max_parallel,
+            batches=batches,
+            max_failures=args.max_failures,
+            build_locally=args.build_locally,
+        )
     except KeyboardInterrupt:
         log.warning("Interrupted by user")
         sys.exit(1)
@@ -291,4 +584,31 @@ def register_update_parser(parser: argparse.ArgumentParser) -> None:
         type=str,
         help="Address of the machine to build the flake, in the format of user@host:1234.",
     )
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        default=None,
+        help="maximum number of machines to update at the same time (default: all)",
+    )
+    tag_parser = parser.add_argument(
+        "--batch-tag",
+        action="append",
+        default=[],
+        metavar="TAG",
+        help="update machines with this tag in a batch, before the next batch starts. "
+        "Can be given multiple times, machines without any of the tags are updated last.",
+    )
+    add_dynamic_completer(tag_parser, complete_tags)
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        default=None,
+        help="do not start updating further machines after this many failed",
+    )
+    parser.add_argument(
+        "--build-locally",
+        action="store_true",
+        help="build all machines here in one nix invocation and copy the results to them, "
+        "instead of running nixos-rebuild on every build host",
+    )
     parser.set_defaults(func=update_command)
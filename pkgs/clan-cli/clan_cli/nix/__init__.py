@@ -1,10 +1,11 @@
 import json
 import logging
 import os
+from functools import cache
 from pathlib import Path
 from typing import Any
 
-from clan_cli.cmd import run, run_no_stdout
+from clan_cli.cmd import RunOpts, run, run_no_stdout
 from clan_cli.dirs import nixpkgs_flake, nixpkgs_source
 from clan_cli.errors import ClanError
 from clan_cli.locked_open import locked_open
@@ -115,6 +116,24 @@ def nix_shell(packages: list[str], cmd: list[str]) -> list[str]:
     ]
 
 
+def nix_shell_program(package: str, program: str) -> str:
+    """
+    Like nix_shell(), but for programs that are called many times:
+    instead of evaluating nixpkgs for every call,
+    the path of the program is resolved once per process.
+    """
+    if nix_shell([package], [program]) == [program]:
+        return program
+    return _resolve_program(package, program)
+
+
+@cache
+def _resolve_program(package: str, program: str) -> str:
+    cmd = nix_shell([package], ["sh", "-c", 'command -v "$0"', program])
+    proc = run(cmd, RunOpts(error_msg=f"Failed to find {program} in {package}"))
+    return proc.stdout.strip()
+
+
 # lazy loads list of allowed and static programs
 class Programs:
     allowed_programs: list[str] | None = None
@@ -2,6 +2,7 @@ import functools
 from collections.abc import Callable
 from pathlib import Path
 
+from . import index
 from .groups import get_groups
 
 
@@ -13,10 +14,10 @@ def get_secrets_filter_for_users_or_machines(
     groups_names = get_groups(flake_dir, what, name)
 
     def filter_secrets(secret: Path) -> bool:
-        if (secret / what / name).is_symlink():
+        if index.is_symlink(secret / what / name):
             return True
         groups_folder = secret / "groups"
-        return any((groups_folder / name).is_symlink() for name in groups_names)
+        return any(index.is_symlink(groups_folder / name) for name in groups_names)
 
     return filter_secrets
 
@@ -0,0 +1,185 @@
+"""
+A cached view of the directories below `sops/` and `vars/` of a flake.
+
+Secrets link to the same few users, machines and groups, so walking them
+with `iterdir()`, `exists()` and `resolve()` stats the same paths over and
+over. Here every directory is read with a single `os.scandir()`, and its
+entries (including symlink targets) are reused until the mtime of the
+directory changes. Files that are parsed, like `key.json` and the sops
+metadata of a secret, are cached by their inode, mtime and size.
+
+The caches live for the whole process, a walk over thousands of secrets
+only stats the directories it already listed.
+"""
+
+# Paths are plain strings in here, constructing pathlib.Path objects
+# costs more than the cached lookups themselves.
+# ruff: noqa: PTH115, PTH116, PTH118, PTH119, PTH120
+
+import logging
+import os
+import stat
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, TypeVar
+
+from . import sops
+
+log = logging.getLogger(__name__)
+
+# Entries modified this recently are not cached: a second change within
+# the timestamp granularity of the filesystem would not change their mtime.
+RACY_NS = 2 * 1_000_000_000
+
+# like MAXSYMLINKS on linux
+MAX_SYMLINKS = 40
+
+T = TypeVar("T")
+StrPath = str | os.PathLike[str]
+
+
+class Entry:
+    """
+    A directory entry.
+    `target` is the lexically resolved target if the entry is a symlink.
+    """
+
+    __slots__ = ("is_dir", "target")
+
+    def __init__(self, is_dir: bool, target: str | None) -> None:
+        self.is_dir = is_dir
+        self.target = target
+
+
+# path -> ((device, inode, mtime), entries)
+_listings: dict[str, tuple[tuple[int, int, int], dict[str, Entry]]] = {}
+# (path, parser) -> ((inode, mtime, size), parsed)
+_files: dict[tuple[str, Callable[..., Any]], tuple[tuple[int, int, int], Any]] = {}
+
+
+def _is_racy(st: os.stat_result) -> bool:
+    return st.st_mtime_ns >= time.time_ns() - RACY_NS
+
+
+def list_dir(path: StrPath) -> dict[str, Entry]:
+    """
+    The entries of a directory, empty if it does not exist.
+    Symlinks are not followed, except for `path` itself. Relative symlink
+    targets are resolved against `path`, so `path` must not be reached
+    through a symlink for them to be correct.
+    """
+    key = os.fspath(path)
+    try:
+        st = os.stat(key)
+    except (FileNotFoundError, NotADirectoryError):
+        _listings.pop(key, None)
+        return {}
+    if not stat.S_ISDIR(st.st_mode):
+        return {}
+    ident = (st.st_dev, st.st_ino, st.st_mtime_ns)
+    cached = _listings.get(key)
+    if cached is not None and cached[0] == ident:
+        return cached[1]
+
+    entries: dict[str, Entry] = {}
+    with os.scandir(key) as it:
+        for entry in it:
+            if entry.is_symlink():
+                link = os.readlink(entry.path)
+                target = os.path.normpath(os.path.join(key, link))
+                entries[entry.name] = Entry(False, target)
+            else:
+                entries[entry.name] = Entry(entry.is_dir(follow_symlinks=False), None)
+    if _is_racy(st):
+        _listings.pop(key, None)
+    else:
+        _listings[key] = (ident, entries)
+    return entries
+
+
+def exists(path: StrPath) -> bool:
+    """Like Path.exists(), but answered from the listing of the parent."""
+    current = os.fspath(path)
+    for _ in range(MAX_SYMLINKS):
+        parent, name = os.path.split(current)
+        entry = list_dir(parent).get(name)
+        if entry is None:
+            return False
+        if entry.target is None:
+            return True
+        current = entry.target
+    return False
+
+
+def is_symlink(path: StrPath) -> bool:
+    parent, name = os.path.split(os.fspath(path))
+    entry = list_dir(parent).get(name)
+    return entry is not None and entry.target is not None
+
+
+def cached_file(path: StrPath, parse: Callable[[Path], T]) -> T:
+    """
+    The result of `parse(path)`, reused while the file at `path`
+    keeps its inode, mtime and size.
+    """
+    key = (os.fspath(path), parse)
+    st = os.stat(key[0])
+    ident = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _files.get(key)
+    if cached is not None and cached[0] == ident:
+        return cached[1]
+    value = parse(Path(path))
+    if _is_racy(st):
+        _files.pop(key, None)
+    else:
+        _files[key] = (ident, value)
+    return value
+
+
+def _parse_key(key_file: Path) -> tuple[str, sops.KeyType]:
+    return sops.read_key(key_file.parent)
+
+
+def read_key(path: StrPath) -> tuple[str, sops.KeyType]:
+    """Cached sops.read_key() of the key in the directory `path`."""
+    return cached_file(os.path.join(path, "key.json"), _parse_key)
+
+
+def collect_keys(folder: StrPath) -> set[tuple[str, sops.KeyType]]:
+    """
+    The keys of the users or machines linked in `folder`,
+    the links must point to a folder with the same name as `folder`.
+    """
+    keys = set()
+    kind = os.path.basename(folder)
+    for name, entry in list_dir(folder).items():
+        target = entry.target
+        if target is None:
+            continue
+        link = os.path.join(folder, name)
+        if not exists(target):
+            log.warning(f"Ignoring broken symlink {link}")
+            continue
+        target_dir = os.path.dirname(target)
+        if os.path.basename(target_dir) != kind:
+            log.warning(
+                f"Expected {link} to point to {folder} but points to {target_dir}"
+            )
+            continue
+        keys.add(read_key(target))
+    return keys
+
+
+def _parse_recipients(secret_file: Path) -> frozenset[sops.SopsKey]:
+    return frozenset(sops.get_recipients(secret_file.parent))
+
+
+def get_recipients(secret_path: StrPath) -> set[sops.SopsKey]:
+    """Cached sops.get_recipients()."""
+    return set(cached_file(os.path.join(secret_path, "secret"), _parse_recipients))
+
+
+def clear() -> None:
+    _listings.clear()
+    _files.clear()
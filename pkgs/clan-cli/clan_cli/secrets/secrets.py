@@ -1,11 +1,11 @@
 import argparse
-import functools
 import getpass
 import logging
 import os
 import shutil
 import sys
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import IO
@@ -21,7 +21,7 @@ from clan_cli.errors import ClanError
 from clan_cli.flake import Flake
 from clan_cli.git import commit_files
 
-from . import sops
+from . import index, sops
 from .folders import (
     list_objects,
     sops_groups_folder,
@@ -32,8 +32,8 @@ from .folders import (
 from .sops import (
     decrypt_file,
     encrypt_file,
-    read_key,
     update_keys,
+    update_keys_batch,
 )
 from .types import VALID_SECRET_NAME, secret_name_type
 
@@ -41,44 +41,36 @@ log = logging.getLogger(__name__)
 
 
 def list_generators_secrets(generators_path: Path) -> list[Path]:
-    for generator_path in generators_path.iterdir():
-        if not generator_path.is_dir():
+    paths = []
+    for generator_name, generator in index.list_dir(generators_path).items():
+        if not generator.is_dir:
             continue
-
-        def validate(generator_path: Path, name: str) -> bool:
-            return has_secret(generator_path / name)
-
-        paths = []
-        for obj in list_objects(
-            generator_path, functools.partial(validate, generator_path)
-        ):
-            paths.append(generator_path / obj)
-        return paths
-    return []
+        generator_path = generators_path / generator_name
+        for name in index.list_dir(generator_path):
+            if has_secret(generator_path / name):
+                paths.append(generator_path / name)
+    return paths
 
 
 def list_vars_secrets(flake_dir: Path) -> list[Path]:
-    secret_paths = []
-    shared_dir = flake_dir / "vars" / "shared"
-    if shared_dir.is_dir():
-        secret_paths.extend(list_generators_secrets(shared_dir))
-
+    secret_paths = list_generators_secrets(flake_dir / "vars" / "shared")
     machines_dir = flake_dir / "vars" / "per-machine"
-    if machines_dir.is_dir():
-        for machine_dir in machines_dir.iterdir():
-            if not machine_dir.is_dir():
-                continue
-            secret_paths.extend(list_generators_secrets(machine_dir))
+    for machine_name, machine in index.list_dir(machines_dir).items():
+        if machine.is_dir:
+            secret_paths.extend(list_generators_secrets(machines_dir / machine_name))
     return secret_paths
 
 
 def update_secrets(
-    flake_dir: Path, filter_secrets: Callable[[Path], bool] = lambda _: True
+    flake_dir: Path,
+    filter_secrets: Callable[[Path], bool] = lambda _: True,
+    max_workers: int | None = None,
 ) -> list[Path]:
     changed_files = []
     secret_paths = [sops_secrets_folder(flake_dir) / s for s in list_secrets(flake_dir)]
     secret_paths.extend(list_vars_secrets(flake_dir))
 
+    secrets = []
     for path in secret_paths:
         if not filter_secrets(path):
             continue
@@ -87,46 +79,58 @@ def update_secrets(
         changed_files.extend(cleanup_dangling_symlinks(path / "users"))
         changed_files.extend(cleanup_dangling_symlinks(path / "groups"))
         changed_files.extend(cleanup_dangling_symlinks(path / "machines"))
-        changed_files.extend(
-            update_keys(
-                path,
-                collect_keys_for_path(path),
-            )
-        )
+        keys = collect_keys_for_path(path)
+        # only secrets with different recipients need to go through sops
+        recipients = {(key.pubkey, key.key_type) for key in index.get_recipients(path)}
+        if recipients != keys:
+            secrets.append((path, keys))
+    changed_files.extend(update_keys_parallel(secrets, max_workers))
     return changed_files
 
 
-def cleanup_dangling_symlinks(folder: Path) -> list[Path]:
-    if not folder.exists():
+# secrets per sops process, small enough to report progress regularly
+UPDATE_KEYS_BATCH_SIZE = 16
+
+
+def update_keys_parallel(
+    secrets: list[tuple[Path, set[tuple[str, sops.KeyType]]]],
+    max_workers: int | None = None,
+) -> list[Path]:
+    """
+    Update the keys of the secrets in batches on a bounded thread pool.
+    Returns the secret files that were modified.
+    """
+    if not secrets:
         return []
+    batches = [
+        secrets[i : i + UPDATE_KEYS_BATCH_SIZE]
+        for i in range(0, len(secrets), UPDATE_KEYS_BATCH_SIZE)
+    ]
+    changed_files: list[Path] = []
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = {
+            executor.submit(update_keys_batch, batch): batch for batch in batches
+        }
+        for future in as_completed(futures):
+            changed_files.extend(future.result())
+            done += len(futures[future])
+            log.info(f"Updated keys of {done}/{len(secrets)} secrets")
+    return changed_files
+
+
+def cleanup_dangling_symlinks(folder: Path) -> list[Path]:
     removed: list[Path] = []
-    for link in folder.iterdir():
-        if link.is_symlink() and not link.exists():
+    for name, entry in index.list_dir(folder).items():
+        if entry.target is not None and not index.exists(entry.target):
+            link = folder / name
             link.unlink()
-            removed.append(folder / link)
+            removed.append(link)
     return removed
 
 
 def collect_keys_for_type(folder: Path) -> set[tuple[str, sops.KeyType]]:
-    if not folder.exists():
-        return set()
-    keys = set()
-    for p in folder.iterdir():
-        if not p.is_symlink():
-            continue
-        try:
-            target = p.resolve(strict=True)
-        except FileNotFoundError:
-            log.warning(f"Ignoring broken symlink {p}")
-            continue
-        kind = target.parent.name
-        if folder.name != kind:
-            log.warning(
-                f"Expected {p} to point to {folder} but points to {target.parent}"
-            )
-            continue
-        keys.add(read_key(target))
-    return keys
+    return index.collect_keys(folder)
 
 
 def collect_keys_for_path(path: Path) -> set[tuple[str, sops.KeyType]]:
@@ -134,11 +138,11 @@ def collect_keys_for_path(path: Path) -> set[tuple[str, sops.KeyType]]:
     keys.update(collect_keys_for_type(path / "machines"))
     keys.update(collect_keys_for_type(path / "users"))
     groups = path / "groups"
-    if not groups.is_dir():
-        return keys
-    for group in groups.iterdir():
-        keys.update(collect_keys_for_type(group / "machines"))
-        keys.update(collect_keys_for_type(group / "users"))
+    for group, entry in index.list_dir(groups).items():
+        # members of a linked group are resolved relative to the group itself
+        group_path = Path(entry.target) if entry.target else groups / group
+        keys.update(collect_keys_for_type(group_path / "machines"))
+        keys.update(collect_keys_for_type(group_path / "users"))
     return keys
 
 
@@ -323,7 +327,7 @@ def disallow_member(group_folder: Path, name: str) -> list[Path]:
 
 
 def has_secret(secret_path: Path) -> bool:
-    return (secret_path / "secret").exists()
+    return index.exists(secret_path / "secret")
 
 
 def list_secrets(flake_dir: Path, pattern: str | None = None) -> list[str]:
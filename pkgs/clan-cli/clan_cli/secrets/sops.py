@@ -4,19 +4,20 @@ import io
 import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 from collections.abc import Iterable, Sequence
 from contextlib import suppress
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import IO
+from typing import IO, Any
 
 from clan_cli.api import API
 from clan_cli.cmd import Log, RunOpts, run
 from clan_cli.dirs import user_config_dir
 from clan_cli.errors import ClanError
-from clan_cli.nix import nix_shell
+from clan_cli.nix import nix_shell, nix_shell_program
 
 from .folders import sops_machines_folder, sops_users_folder
 
@@ -182,11 +183,35 @@ def sops_run(
     run_opts: RunOpts | None = None,
 ) -> tuple[int, str]:
     """Call the sops binary for the given operation."""
+    return sops_run_batch(call, [(secret_path, public_keys)], run_opts)
+
+
+def _key_groups(public_keys: Iterable[tuple[str, KeyType]]) -> list[dict]:
+    keys_by_type: dict[KeyType, list[str]] = {key_type: [] for key_type in KeyType}
+    for key, key_type in public_keys:
+        keys_by_type[key_type].append(key)
+    it = keys_by_type.items()
+    return [{key_type.name.lower(): keys for key_type, keys in it}]
+
+
+def sops_run_batch(
+    call: Operation,
+    secrets: Sequence[tuple[Path, Iterable[tuple[str, KeyType]]]],
+    run_opts: RunOpts | None = None,
+) -> tuple[int, str]:
+    """
+    Call the sops binary once for several files.
+    Only `updatekeys` accepts more than one file,
+    each file gets a creation rule with its own keys.
+    """
     # louis(2024-11-19): I regrouped the call into the sops binary into this
     # one place because calling into sops needs to be done with a carefully
     # setup context, and I don't feel good about the idea of having that logic
     # exist in multiple places.
-    sops_cmd = ["sops"]
+    if len(secrets) != 1 and call != Operation.UPDATE_KEYS:
+        msg = f"sops {call.value} only supports a single file"
+        raise ClanError(msg)
+    sops_cmd = [nix_shell_program("nixpkgs#sops", "sops")]
     environ = os.environ.copy()
     with NamedTemporaryFile(delete=False, mode="w") as manifest:
         if call == Operation.DECRYPT:
@@ -197,14 +222,22 @@ def sops_run(
             # used.
             sops_cmd.extend(["--config", manifest.name])
 
-            keys_by_type: dict[KeyType, list[str]] = {}
-            keys_by_type = {key_type: [] for key_type in KeyType}
-            for key, key_type in public_keys:
-                keys_by_type[key_type].append(key)
-            it = keys_by_type.items()
-            key_groups = [{key_type.name.lower(): keys for key_type, keys in it}]
-            rules = {"creation_rules": [{"key_groups": key_groups}]}
-            json.dump(rules, manifest, indent=2)
+            rules: list[dict[str, Any]]
+            if len(secrets) == 1:
+                rules = [{"key_groups": _key_groups(secrets[0][1])}]
+            else:
+                # sops matches the path either absolute or relative to the
+                # directory of the config file
+                rules = [
+                    {
+                        "path_regex": r"^(/|(\.\./)+)"
+                        + re.escape(str(path.absolute()).lstrip("/"))
+                        + "$",
+                        "key_groups": _key_groups(public_keys),
+                    }
+                    for path, public_keys in secrets
+                ]
+            json.dump({"creation_rules": rules}, manifest, indent=2)
             manifest.flush()
 
             if call == Operation.ENCRYPT:
@@ -231,9 +264,8 @@ def sops_run(
                     f"(known operations: {known_operations})"
                 )
                 raise ClanError(msg)
-        sops_cmd.append(str(secret_path))
+        sops_cmd.extend(str(secret_path) for secret_path, _ in secrets)
 
-        cmd = nix_shell(["nixpkgs#sops"], sops_cmd)
         opts = (
             dataclasses.replace(run_opts, env=environ)
             if run_opts
@@ -242,14 +274,14 @@ def sops_run(
         if call == Operation.EDIT:
             # Use direct stdout / stderr, as else it breaks editor integration.
             # We never need this in our UI. TUI only.
-            p1 = subprocess.run(cmd, check=False, text=True)
+            p1 = subprocess.run(sops_cmd, check=False, text=True)
             return p1.returncode, ""
-        p = run(cmd, opts)
+        p = run(sops_cmd, opts)
         return p.returncode, p.stdout
 
 
 def get_public_age_key(privkey: str) -> str:
-    cmd = nix_shell(["nixpkgs#age"], ["age-keygen", "-y"])
+    cmd = [nix_shell_program("nixpkgs#age", "age-keygen"), "-y"]
 
     error_msg = "Failed to get public key for age private key. Is the key malformed?"
     res = run(cmd, RunOpts(input=privkey.encode(), error_msg=error_msg))
@@ -371,6 +403,26 @@ def update_keys(secret_path: Path, keys: Iterable[tuple[str, KeyType]]) -> list[
     return [secret_path] if was_modified else []
 
 
+def update_keys_batch(
+    secrets: Sequence[tuple[Path, Iterable[tuple[str, KeyType]]]],
+) -> list[Path]:
+    """
+    Like update_keys(), but with a single sops process for all secrets.
+    Returns the secret files that were modified.
+    """
+    if not secrets:
+        return []
+    secret_files = [(secret_path / "secret", keys) for secret_path, keys in secrets]
+    # sops does not report which files it modified
+    before = {path: path.read_bytes() for path, _ in secret_files}
+    sops_run_batch(
+        Operation.UPDATE_KEYS,
+        secret_files,
+        RunOpts(log=Log.BOTH, error_msg="Could not update keys of secrets"),
+    )
+    return [path for path, content in before.items() if path.read_bytes() != content]
+
+
 def encrypt_file(
     secret_path: Path,
     content: str | IO[bytes] | bytes | None,
@@ -447,8 +499,55 @@ def decrypt_file(secret_path: Path) -> str:
     return stdout
 
 
+# sops writes its metadata after the encrypted values,
+# so it is read from the end of the file, starting with this many bytes.
+SOPS_METADATA_TAIL = 64 * 1024
+SOPS_METADATA_KEY = re.compile(rb'[{,]\s*"sops"\s*:\s*')
+
+
+def _metadata_from_tail(tail: bytes) -> dict[str, Any] | None:
+    """
+    Parse the top-level "sops" object at the end of a json document,
+    None if `tail` does not end with one.
+    """
+    matches = list(SOPS_METADATA_KEY.finditer(tail))
+    if not matches:
+        return None
+    start = matches[-1].end()
+    try:
+        text = tail[start:].decode()
+        metadata, end = json.JSONDecoder().raw_decode(text)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    # only the closing brace of the document may follow
+    if text[end:].strip() != "}" or not isinstance(metadata, dict):
+        return None
+    return metadata
+
+
+def read_sops_metadata(secret_file: Path) -> dict[str, Any]:
+    """
+    Returns the "sops" metadata of an encrypted json file,
+    without loading the encrypted values, which can be megabytes for binary secrets.
+    """
+    with secret_file.open("rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        tail_size = SOPS_METADATA_TAIL
+        while True:
+            start = max(size - tail_size, 0)
+            f.seek(start)
+            metadata = _metadata_from_tail(f.read())
+            if metadata is not None:
+                return metadata
+            if start == 0:
+                break
+            tail_size *= 4
+    # not written by sops, let the full parser report what is wrong with it
+    return json.loads(secret_file.read_text())["sops"]
+
+
 def get_recipients(secret_path: Path) -> set[SopsKey]:
-    sops_attrs = json.loads((secret_path / "secret").read_text())["sops"]
+    sops_attrs = read_sops_metadata(secret_path / "secret")
     return {
         SopsKey(
             pubkey=recipient[key_type.sops_recipient_attr],
@@ -1,11 +1,16 @@
 # Adapted from https://github.com/numtide/deploykit
 
+import atexit
 import logging
 import os
 import shlex
+import shutil
 import socket
 import subprocess
+import tempfile
+import threading
 from dataclasses import dataclass, field
+from pathlib import Path
 from shlex import quote
 from typing import Any
 
@@ -21,6 +26,49 @@ cmdlog = logging.getLogger(__name__)
 # Seconds until a message is printed when _run produces no output.
 NO_OUTPUT_TIMEOUT = 20
 
+# Seconds an idle ssh master connection stays open after its last client exited.
+CONTROL_PERSIST = 60
+
+_control_dir: Path | None = None
+_control_lock = threading.Lock()
+
+
+def ssh_control_dir() -> Path:
+    """
+    Directory holding the ssh ControlMaster sockets of this process.
+    It is created on first use and removed, together with all master
+    connections, when the process exits.
+    """
+    global _control_dir
+    with _control_lock:
+        if _control_dir is None:
+            # kept short, unix socket paths are limited to ~100 bytes
+            _control_dir = Path(tempfile.mkdtemp(prefix="clan-ssh-"))
+            atexit.register(close_ssh_masters)
+        return _control_dir
+
+
+def close_ssh_masters() -> None:
+    """
+    Stop all ssh master connections opened by this process.
+    """
+    global _control_dir
+    with _control_lock:
+        control_dir = _control_dir
+        _control_dir = None
+    if control_dir is None:
+        return
+    for socket_path in control_dir.iterdir():
+        # the host argument is required but unused, the socket identifies the master
+        subprocess.run(
+            ["ssh", "-o", f"ControlPath={socket_path}", "-O", "exit", "clan"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    shutil.rmtree(control_dir, ignore_errors=True)
+
 
 @dataclass
 class Host:
@@ -34,6 +82,8 @@ class Host:
     meta: dict[str, Any] = field(default_factory=dict)
     verbose_ssh: bool = False
     ssh_options: dict[str, str] = field(default_factory=dict)
+    # share one ssh connection between all commands to this host
+    control_master: bool = True
 
     def __post_init__(self) -> None:
         if not self.command_prefix:
@@ -59,6 +109,7 @@ class Host:
             meta=host.meta.copy(),
             verbose_ssh=host.verbose_ssh,
             ssh_options=host.ssh_options.copy(),
+            control_master=host.control_master,
         )
 
     def run_local(
@@ -155,16 +206,26 @@ class Host:
         # Run the ssh command
         return run(ssh_cmd, opts)
 
-    def nix_ssh_env(self, env: dict[str, str] | None) -> dict[str, str]:
+    def nix_ssh_env(
+        self, env: dict[str, str] | None, control_master: bool = True
+    ) -> dict[str, str]:
+        """
+        Sets NIX_SSHOPTS, so nix copy and nixos-rebuild reuse the ssh connection.
+        `control_master` must be False if the environment is used on another machine,
+        as the socket directory only exists locally.
+        """
         if env is None:
             env = {}
-        env["NIX_SSHOPTS"] = " ".join(self.ssh_cmd_opts)
+        env["NIX_SSHOPTS"] = " ".join(self._ssh_opts(control_master))
         return env
 
     @property
     def ssh_cmd_opts(
         self,
     ) -> list[str]:
+        return self._ssh_opts(control_master=True)
+
+    def _ssh_opts(self, control_master: bool) -> list[str]:
         ssh_opts = ["-A"] if self.forward_agent else []
 
         for k, v in self.ssh_options.items():
@@ -172,6 +233,23 @@ class Host:
 
         ssh_opts.extend(self.host_key_check.to_ssh_opt())
 
+        # Options from ssh_options take precedence, ssh uses the first value it sees.
+        if (
+            control_master
+            and self.control_master
+            and "ControlMaster" not in self.ssh_options
+        ):
+            ssh_opts.extend(
+                [
+                    "-o",
+                    "ControlMaster=auto",
+                    "-o",
+                    f"ControlPath={ssh_control_dir()}/%C",
+                    "-o",
+                    f"ControlPersist={CONTROL_PERSIST}",
+                ]
+            )
+
         return ssh_opts
 
     def ssh_cmd(
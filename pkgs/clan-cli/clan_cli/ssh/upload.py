@@ -1,12 +1,112 @@
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import secrets
+import shlex
 import tarfile
+import threading
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from typing import IO, Any
 
 from clan_cli.cmd import Log, RunOpts
 from clan_cli.cmd import run as run_local
+from clan_cli.dirs import user_data_dir
 from clan_cli.errors import ClanError
 from clan_cli.ssh.host import Host
 
+log = logging.getLogger(__name__)
+
+# stored next to the uploaded files, lists the keyed hash of every file
+MANIFEST_NAME = ".clan-upload-manifest.json"
+MANIFEST_VERSION = 2
+
+# the new content is unpacked in here and moved into the destination entry by entry
+STAGING_NAME = ".clan-upload"
+# replaced entries are moved here before they are deleted
+TRASH_NAME = ".clan-upload-old"
+
+
+def manifest_key() -> bytes:
+    """
+    The local key of the file hashes in upload manifests.
+    The manifest on the target does not reveal the hash of a secret that
+    could be checked against guesses. A manifest created with a different key
+    only leads to a full upload.
+    """
+    key_file = user_data_dir() / "clan" / "upload-manifest.key"
+    try:
+        return key_file.read_bytes()
+    except FileNotFoundError:
+        pass
+    key_file.parent.mkdir(parents=True, exist_ok=True)
+    key = secrets.token_bytes(32)
+    tmp_file = key_file.with_name(f".{key_file.name}.{os.getpid()}")
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    tmp_file.replace(key_file)
+    return key
+
+
+def upload_manifest(
+    local_src: Path,
+    file_user: str,
+    file_group: str,
+    dir_mode: int,
+    file_mode: int,
+    key: bytes,
+) -> dict[str, Any]:
+    dirs = []
+    files = {}
+    for root, dirnames, filenames in local_src.walk():
+        for mdir in dirnames:
+            dirs.append(str((root / mdir).relative_to(local_src)))
+        for file in filenames:
+            file_path = root / file
+            with file_path.open("rb") as f:
+                digest = hashlib.file_digest(
+                    f, lambda: hmac.new(key, digestmod="sha256")
+                ).hexdigest()
+            files[str(file_path.relative_to(local_src))] = digest
+    return {
+        "version": MANIFEST_VERSION,
+        "owner": f"{file_user}:{file_group}",
+        "dir_mode": dir_mode,
+        "file_mode": file_mode,
+        "dirs": sorted(dirs),
+        "files": files,
+    }
+
+
+def _remote_manifest(host: Host, remote_dest: Path) -> dict[str, Any] | None:
+    manifest_path = shlex.quote(str(remote_dest / MANIFEST_NAME))
+    proc = run_local(
+        [*host.ssh_cmd(), f"cat {manifest_path} 2>/dev/null || true"],
+        RunOpts(
+            log=Log.STDERR,
+            prefix=host.command_prefix,
+            needs_user_terminal=True,
+        ),
+    )
+    try:
+        manifest = json.loads(proc.stdout)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _open_tar_stream(
+    fileobj: IO[bytes], compression_level: int | None
+) -> tarfile.TarFile:
+    if compression_level is None:
+        return tarfile.open(fileobj=fileobj, mode="w|")
+    return tarfile.open(fileobj=fileobj, mode="w|gz", compresslevel=compression_level)
+
 
 def upload(
     host: Host,
@@ -16,7 +116,21 @@ def upload(
     file_group: str = "root",
     dir_mode: int = 0o700,
     file_mode: int = 0o400,
+    delta: bool = False,
+    compression_level: int | None = 6,
 ) -> None:
+    """
+    Replace the content of `remote_dest` with the content of `local_src`.
+    The new content is unpacked into a staging directory inside `remote_dest`
+    and then moved in place one top level entry at a time, so the target never
+    sees a partially written file or subdirectory. `remote_dest` itself is
+    never renamed, it can be a mountpoint.
+
+    With `delta`, a manifest with a keyed hash of every file is stored in
+    `remote_dest`, and only files that changed since the last upload are sent.
+    The tarball is gzip compressed with `compression_level`, None disables
+    compression.
+    """
     # check if the remote destination is a directory (no suffix)
     if remote_dest.suffix:
         msg = "Only directories are allowed"
@@ -26,13 +140,43 @@ def upload(
         msg = "Only directories are allowed"
         raise ClanError(msg)
 
-    # Create the tarball from the temporary directory
-    with TemporaryDirectory(prefix="facts-upload-") as tardir:
-        tar_path = Path(tardir) / "upload.tar.gz"
+    manifest = None
+    remote_manifest = None
+    if delta:
+        manifest = upload_manifest(
+            local_src, file_user, file_group, dir_mode, file_mode, manifest_key()
+        )
+        remote_manifest = _remote_manifest(host, remote_dest)
+        if remote_manifest == manifest:
+            log.debug(f"{remote_dest} on {host.target} is up to date")
+            return
+        if remote_manifest is not None and any(
+            remote_manifest.get(key) != manifest[key]
+            for key in ["owner", "dir_mode", "file_mode"]
+        ):
+            remote_manifest = None
+
+    # files that are already on the target are copied from the old directory
+    keep_files: set[str] = set()
+    removed: list[str] = []
+    if manifest is not None and remote_manifest is not None:
+        remote_files = remote_manifest.get("files", {})
+        keep_files = {
+            path
+            for path, digest in manifest["files"].items()
+            if remote_files.get(path) == digest
+        }
+        removed = [
+            path
+            for path in [*remote_files, *remote_manifest.get("dirs", [])]
+            if path not in manifest["files"] and path not in manifest["dirs"]
+        ]
+
+    def write_tar(fileobj: IO[bytes]) -> None:
         # We set the permissions of the files and directories in the tarball to read only and owned by root
         # As first uploading the tarball and then changing the permissions can lead an attacker to
         # do a race condition attack
-        with tarfile.open(str(tar_path), "w:gz") as tar:
+        with _open_tar_stream(fileobj, compression_level) as tar:
             for root, dirs, files in local_src.walk():
                 for mdir in dirs:
                     dir_path = Path(root) / mdir
@@ -45,43 +189,90 @@ def upload(
                     tar.addfile(tarinfo)
                 for file in files:
                     file_path = Path(root) / file
-                    tarinfo = tar.gettarinfo(
-                        file_path,
-                        arcname=str(file_path.relative_to(str(local_src))),
-                    )
+                    arcname = str(file_path.relative_to(str(local_src)))
+                    if arcname in keep_files:
+                        continue
+                    tarinfo = tar.gettarinfo(file_path, arcname=arcname)
                     tarinfo.mode = file_mode
                     tarinfo.uname = file_user
                     tarinfo.gname = file_group
                     with file_path.open("rb") as f:
                         tar.addfile(tarinfo, f)
+            if manifest is not None:
+                data = json.dumps(manifest).encode()
+                tarinfo = tarfile.TarInfo(MANIFEST_NAME)
+                tarinfo.size = len(data)
+                tarinfo.mode = file_mode
+                tarinfo.uname = file_user
+                tarinfo.gname = file_group
+                tar.addfile(tarinfo, io.BytesIO(data))
 
-        cmd = [
-            *host.ssh_cmd(),
-            "rm",
-            "-r",
-            str(remote_dest),
-            ";",
-            "mkdir",
-            "-m",
-            f"{dir_mode:o}",
-            "-p",
-            str(remote_dest),
-            "&&",
-            "tar",
-            "-C",
-            str(remote_dest),
-            "-xzf",
-            "-",
-        ]
+    # all top level entries of a directory, including hidden ones
+    entries = "* .[!.]* ..?*"
+    skip = (
+        f"case $e in {STAGING_NAME} | {TRASH_NAME} | {MANIFEST_NAME}) continue ;; esac"
+    )
+    exists = '[ -e "$e" ] || [ -L "$e" ] || continue'
+    script = [
+        "set -eu",
+        f"mkdir -m {dir_mode:o} -p {shlex.quote(str(remote_dest))}",
+        f"cd {shlex.quote(str(remote_dest))}",
+        f"rm -rf {STAGING_NAME} {TRASH_NAME}",
+        f"mkdir -m {dir_mode:o} {STAGING_NAME}",
+        f"mkdir -m 700 {TRASH_NAME}",
+    ]
+    if remote_manifest is not None:
+        # unchanged files are copied from the current content
+        script.append(
+            f'for e in {entries}; do {skip}; {exists}; cp -a "$e" {STAGING_NAME}/; done'
+        )
+    if removed:
+        paths = " ".join(shlex.quote(f"{STAGING_NAME}/{p}") for p in removed)
+        script.append(f"rm -rf -- {paths}")
+    script += [
+        f"tar -C {STAGING_NAME} -x{'' if compression_level is None else 'z'}f -",
+        # an interrupted sync leaves no manifest behind, the next upload is a full one
+        f"rm -f {MANIFEST_NAME}",
+        # entries that are no longer uploaded
+        f'for e in {entries}; do {skip}; {exists}; [ -e {STAGING_NAME}/"$e" ] || mv "$e" {TRASH_NAME}/; done',
+        f"cd {STAGING_NAME}",
+        f'for e in {entries}; do {skip}; {exists}; if [ -e ../"$e" ] || [ -L ../"$e" ]; then mv ../"$e" ../{TRASH_NAME}/; fi; mv "$e" ../; done',
+        f"if [ -e {MANIFEST_NAME} ]; then mv {MANIFEST_NAME} ../; fi",
+        "cd ..",
+        f"rm -rf {STAGING_NAME} {TRASH_NAME}",
+    ]
+    cmd = [*host.ssh_cmd(), "; ".join(script)]
+
+    # The tarball is written into a pipe by a thread while ssh reads from it,
+    # so it is never held in memory or on disk as a whole.
+    read_fd, write_fd = os.pipe()
+    errors: list[BaseException] = []
+
+    def produce() -> None:
+        try:
+            with os.fdopen(write_fd, "wb") as pipe:
+                write_tar(pipe)
+        except BrokenPipeError:
+            # ssh exited early, its error is reported by run_local
+            pass
+        except BaseException as e:
+            errors.append(e)
 
-        # TODO accept `input` to be  an IO object instead of bytes so that we don't have to read the tarfile into memory.
-        with tar_path.open("rb") as f:
+    producer = threading.Thread(target=produce, name="upload-tar")
+    producer.start()
+    try:
+        with os.fdopen(read_fd, "rb") as pipe:
             run_local(
                 cmd,
                 RunOpts(
-                    input=f.read(),
+                    input=pipe,
                     log=Log.BOTH,
                     prefix=host.command_prefix,
                     needs_user_terminal=True,
                 ),
             )
+    finally:
+        producer.join()
+    if errors:
+        msg = f"Failed to create the upload tarball of {local_src}"
+        raise ClanError(msg) from errors[0]
@@ -1,21 +1,26 @@
 import argparse
+import contextvars
 import logging
 import os
 import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
 from functools import cached_property
+from graphlib import TopologicalSorter
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from typing import TYPE_CHECKING, Any
 
+from clan_cli.async_run import AsyncContext, get_async_ctx, set_async_ctx
 from clan_cli.cmd import RunOpts, run
 from clan_cli.completions import (
     add_dynamic_completer,
+    complete_generators_for_machine,
     complete_machines,
-    complete_services_for_machine,
 )
 from clan_cli.errors import ClanError
-from clan_cli.git import commit_files
+from clan_cli.git import commit_files, commit_transaction
 from clan_cli.machines.inventory import get_all_machines, get_selected_machines
 from clan_cli.nix import nix_shell, nix_test_store
 from clan_cli.vars._types import StoreBase
@@ -33,6 +38,8 @@ log = logging.getLogger(__name__)
 if TYPE_CHECKING:
     from clan_cli.machines.machines import Machine
 
+_store_lock = threading.Lock()
+
 
 @dataclass
 class Generator:
@@ -154,13 +161,17 @@ def dependencies_as_dir(
             file_path.write_bytes(file)
 
 
-def execute_generator(
+def _execute_generator(
     machine: "Machine",
     generator: Generator,
     secret_vars_store: StoreBase,
     public_vars_store: StoreBase,
     prompt_values: dict[str, str],
-) -> None:
+) -> list[Path]:
+    """
+    Run the generator and store its files.
+    Returns the files that need to be committed.
+    """
     if not isinstance(machine.flake, Path):
         msg = f"flake is not a Path: {machine.flake}"
         msg += "fact/secret generation is only supported for local flakes"
@@ -212,41 +223,61 @@ def execute_generator(
         files = generator.files
         public_changed = False
         secret_changed = False
-        for file in files:
-            secret_file = tmpdir_out / file.name
-            if not secret_file.is_file():
-                msg = f"did not generate a file for '{file.name}' when running the following command:\n"
-                msg += str(generator.final_script)
-                raise ClanError(msg)
-            if file.secret:
-                file_path = secret_vars_store.set(
-                    generator,
-                    file,
-                    secret_file.read_bytes(),
-                )
-                secret_changed = True
-            else:
-                file_path = public_vars_store.set(
-                    generator,
-                    file,
-                    secret_file.read_bytes(),
-                )
-                public_changed = True
-            if file_path:
-                files_to_commit.append(file_path)
-            if generator.validation is not None:
-                if public_changed:
-                    files_to_commit.append(
-                        public_vars_store.set_validation(
-                            generator, generator.validation
-                        )
+        # generators run in parallel, but the stores share files (sops groups,
+        # the password-store git repository) and must only be written by one
+        with _store_lock:
+            for file in files:
+                secret_file = tmpdir_out / file.name
+                if not secret_file.is_file():
+                    msg = f"did not generate a file for '{file.name}' when running the following command:\n"
+                    msg += str(generator.final_script)
+                    raise ClanError(msg)
+                if file.secret:
+                    file_path = secret_vars_store.set(
+                        generator,
+                        file,
+                        secret_file.read_bytes(),
                     )
-                if secret_changed:
-                    files_to_commit.append(
-                        secret_vars_store.set_validation(
-                            generator, generator.validation
-                        )
+                    secret_changed = True
+                else:
+                    file_path = public_vars_store.set(
+                        generator,
+                        file,
+                        secret_file.read_bytes(),
                     )
+                    public_changed = True
+                if file_path:
+                    files_to_commit.append(file_path)
+                if generator.validation is not None:
+                    if public_changed:
+                        files_to_commit.append(
+                            public_vars_store.set_validation(
+                                generator, generator.validation
+                            )
+                        )
+                    if secret_changed:
+                        files_to_commit.append(
+                            secret_vars_store.set_validation(
+                                generator, generator.validation
+                            )
+                        )
+    return files_to_commit
+
+
+def execute_generator(
+    machine: "Machine",
+    generator: Generator,
+    secret_vars_store: StoreBase,
+    public_vars_store: StoreBase,
+    prompt_values: dict[str, str],
+) -> None:
+    files_to_commit = _execute_generator(
+        machine,
+        generator,
+        secret_vars_store,
+        public_vars_store,
+        prompt_values,
+    )
     commit_files(
         files_to_commit,
         machine.flake_dir,
@@ -359,7 +390,7 @@ def _migrate_file(
 def _migrate_files(
     machine: "Machine",
     generator: Generator,
-) -> None:
+) -> list[Path]:
     not_found = []
     files_to_commit = []
     for file in generator.files:
@@ -373,11 +404,7 @@ def _migrate_files(
     if len(not_found) > 0:
         msg = f"Could not migrate the following files for generator {generator.name}, as no fact or secret exists with the same name: {not_found}"
         raise ClanError(msg)
-    commit_files(
-        files_to_commit,
-        machine.flake_dir,
-        f"migrated facts to vars for generator {generator.name} for machine {machine.name}",
-    )
+    return files_to_commit
 
 
 def _check_can_migrate(
@@ -418,20 +445,9 @@ def _check_can_migrate(
     )
 
 
-def generate_vars_for_machine(
-    machine: "Machine",
-    generator_name: str | None,
-    regenerate: bool,
-) -> bool:
-    _generator = None
-    if generator_name:
-        for generator in machine.vars_generators:
-            if generator.name == generator_name:
-                _generator = generator
-                break
-
-    pub_healtcheck_msg = machine.public_vars_store.health_check(_generator)
-    sec_healtcheck_msg = machine.secret_vars_store.health_check(_generator)
+def _health_check(machine: "Machine", generator: Generator | None) -> None:
+    pub_healtcheck_msg = machine.public_vars_store.health_check(generator)
+    sec_healtcheck_msg = machine.secret_vars_store.health_check(generator)
 
     if pub_healtcheck_msg or sec_healtcheck_msg:
         msg = f"Health check failed for machine {machine.name}:\n"
@@ -441,47 +457,179 @@ def generate_vars_for_machine(
             msg += f"Secret vars store: {sec_healtcheck_msg}"
         raise ClanError(msg)
 
-    closure = get_closure(machine, generator_name, regenerate)
-    if len(closure) == 0:
-        return False
-    for generator in closure:
-        if _check_can_migrate(machine, generator):
-            _migrate_files(machine, generator)
+
+# (machine name, generator name), shared generators use SHARED as machine name
+GeneratorKey = tuple[str | None, str]
+SHARED = None
+
+
+class GeneratorJob:
+    """
+    One node of the generator graph.
+    A shared generator runs once, for the first machine that needs it.
+    The other machines only get access to its files afterwards.
+    """
+
+    def __init__(self, machine: "Machine", generator: Generator) -> None:
+        self.machine = machine
+        self.generator = generator
+        # decided before any generator runs, as running it changes the answer
+        self.migrate = _check_can_migrate(machine, generator)
+        self.prompt_values: dict[str, str] = {}
+        self.sharing_machines: list[tuple[Machine, Generator]] = []
+
+    def run(self) -> None:
+        parent_ctx = get_async_ctx()
+        set_async_ctx(
+            AsyncContext(
+                prefix=self.machine.name,
+                stdout=parent_ctx.stdout,
+                stderr=parent_ctx.stderr,
+            )
+        )
+        if self.migrate:
+            with _store_lock:
+                files_to_commit = _migrate_files(self.machine, self.generator)
         else:
-            execute_generator(
-                machine=machine,
-                generator=generator,
-                secret_vars_store=machine.secret_vars_store,
-                public_vars_store=machine.public_vars_store,
-                prompt_values=_ask_prompts(generator),
+            files_to_commit = _execute_generator(
+                machine=self.machine,
+                generator=self.generator,
+                secret_vars_store=self.machine.secret_vars_store,
+                public_vars_store=self.machine.public_vars_store,
+                prompt_values=self.prompt_values,
             )
+        with _store_lock:
+            for machine, generator in self.sharing_machines:
+                _health_check(machine, generator)
+        # joins the transaction of _generate_vars
+        commit_files(files_to_commit, self.machine.flake_dir, self.commit_message)
+
+    @property
+    def commit_message(self) -> str:
+        if self.migrate:
+            return f"migrated facts to vars for generator {self.generator.name} for machine {self.machine.name}"
+        return f"Update vars via generator {self.generator.name} for machine {self.machine.name}"
+
+
+def _generate_vars(
+    machines: list["Machine"],
+    generator_name: str | None,
+    regenerate: bool,
+    max_workers: int | None,
+) -> bool:
+    if not machines:
+        return False
+    with commit_transaction(machines[0].flake_dir, "Update vars"):
+        errors = _run_generators(machines, generator_name, regenerate, max_workers)
+        if errors is None:
+            return False
     # flush caches to make sure the new secrets are available in evaluation
-    machine.flush_caches()
+    for machine in machines:
+        machine.flush_caches()
+
+    if len(errors) == 1:
+        raise errors[0][1]
+    if len(errors) > 1:
+        msg = f"Failed to generate vars for {len(errors)} generators:"
+        for job, error in errors:
+            msg += f"\n{job.machine}/{job.generator.name}: {error}"
+        raise ClanError(msg) from errors[0][1]
     return True
 
 
+def _run_generators(
+    machines: list["Machine"],
+    generator_name: str | None,
+    regenerate: bool,
+    max_workers: int | None,
+) -> list[tuple[GeneratorJob, Exception]] | None:
+    """
+    Returns the failed generators, or None if there was nothing to generate.
+    """
+    jobs: dict[GeneratorKey, GeneratorJob] = {}
+    graph: dict[GeneratorKey, set[GeneratorKey]] = {}
+
+    # Everything that touches the stores before the generators run, or needs
+    # a terminal, happens here, before any worker is started.
+    for machine in machines:
+        _generator = None
+        if generator_name:
+            for generator in machine.vars_generators:
+                if generator.name == generator_name:
+                    _generator = generator
+                    break
+        _health_check(machine, _generator)
+
+        def key(generator: Generator, machine: "Machine" = machine) -> GeneratorKey:
+            return (SHARED if generator.share else machine.name, generator.name)
+
+        closure = get_closure(machine, generator_name, regenerate)
+        closure_names = {generator.name for generator in closure}
+        for generator in closure:
+            if key(generator) in jobs:
+                jobs[key(generator)].sharing_machines.append((machine, generator))
+                continue
+            job = GeneratorJob(machine, generator)
+            if not job.migrate:
+                job.prompt_values = _ask_prompts(generator)
+            jobs[key(generator)] = job
+            graph[key(generator)] = set()
+        for generator in closure:
+            graph[key(generator)] |= {
+                key(dep)
+                for dep in machine.vars_generators
+                if dep.name in generator.dependencies and dep.name in closure_names
+            }
+
+    if not jobs:
+        return None
+
+    sorter = TopologicalSorter(graph)
+    sorter.prepare()
+    errors: list[tuple[GeneratorJob, Exception]] = []
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        running: dict[Future[None], GeneratorKey] = {}
+        while True:
+            # stop scheduling new generators after the first failure
+            if not errors:
+                for node in sorter.get_ready():
+                    # in a copy of the context, to join the git transaction
+                    context = contextvars.copy_context()
+                    running[executor.submit(context.run, jobs[node].run)] = node
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    future.result()
+                except Exception as exc:
+                    errors.append((jobs[node], exc))
+                    continue
+                sorter.done(node)
+    return errors
+
+
+def generate_vars_for_machine(
+    machine: "Machine",
+    generator_name: str | None,
+    regenerate: bool,
+) -> bool:
+    return _generate_vars([machine], generator_name, regenerate, max_workers=None)
+
+
 def generate_vars(
     machines: list["Machine"],
     generator_name: str | None = None,
     regenerate: bool = False,
+    max_workers: int | None = None,
 ) -> bool:
-    was_regenerated = False
-    for machine in machines:
-        errors = []
-        try:
-            was_regenerated |= generate_vars_for_machine(
-                machine, generator_name, regenerate
-            )
-            machine.flush_caches()
-        except Exception as exc:
-            errors += [(machine, exc)]
-        if len(errors) == 1:
-            raise errors[0][1]
-        if len(errors) > 1:
-            msg = f"Failed to generate facts for {len(errors)} hosts:"
-            for machine, error in errors:
-                msg += f"\n{machine}: {error}"
-            raise ClanError(msg) from errors[0][1]
+    """
+    Run the generators of all machines.
+    Generators whose dependencies are done run in parallel,
+    on at most `max_workers` threads.
+    """
+    was_regenerated = _generate_vars(machines, generator_name, regenerate, max_workers)
 
     if not was_regenerated and len(machines) > 0:
         for machine in machines:
@@ -498,7 +646,7 @@ def generate_command(args: argparse.Namespace) -> None:
         machines = get_all_machines(args.flake, args.option)
     else:
         machines = get_selected_machines(args.flake, args.option, args.machines)
-    generate_vars(machines, args.generator, args.regenerate)
+    generate_vars(machines, args.generator, args.regenerate, args.max_parallel)
 
 
 def register_generate_parser(parser: argparse.ArgumentParser) -> None:
@@ -518,7 +666,7 @@ def register_generate_parser(parser: argparse.ArgumentParser) -> None:
         help="execute only the specified generator. If unset, execute all generators",
         default=None,
     )
-    add_dynamic_completer(service_parser, complete_services_for_machine)
+    add_dynamic_completer(service_parser, complete_generators_for_machine)
 
     parser.add_argument(
         "--regenerate",
@@ -528,4 +676,11 @@ def register_generate_parser(parser: argparse.ArgumentParser) -> None:
         default=None,
     )
 
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        help="maximum number of generators to run at the same time (default: number of cpus)",
+        default=None,
+    )
+
     parser.set_defaults(func=generate_command)
@@ -8,6 +8,7 @@ from pathlib import Path
 from tempfile import TemporaryDirectory
 
 from clan_cli.cmd import Log, RunOpts, run
+from clan_cli.git import last_commits
 from clan_cli.machines.machines import Machine
 from clan_cli.nix import nix_shell
 from clan_cli.ssh.upload import upload
@@ -86,54 +87,15 @@ class SecretStore(StoreBase):
         ).exists()
 
     def generate_hash(self) -> bytes:
-        hashes = []
-        hashes.append(
-            run(
-                nix_shell(
-                    ["nixpkgs#git"],
-                    [
-                        "git",
-                        "-C",
-                        self._password_store_dir,
-                        "log",
-                        "-1",
-                        "--format=%H",
-                        self.entry_prefix,
-                    ],
-                ),
-                RunOpts(check=False),
-            )
-            .stdout.strip()
-            .encode()
-        )
-        shared_dir = Path(self._password_store_dir) / self.entry_prefix / "shared"
-        machine_dir = (
-            Path(self._password_store_dir)
-            / self.entry_prefix
-            / "per-machine"
-            / self.machine.name
-        )
+        store_dir = Path(self._password_store_dir)
+        commits = last_commits(store_dir, self.entry_prefix)
+        hashes = [commits.get(self.entry_prefix, "").encode()]
+        shared_dir = store_dir / self.entry_prefix / "shared"
+        machine_dir = store_dir / self.entry_prefix / "per-machine" / self.machine.name
         for symlink in chain(shared_dir.glob("**/*"), machine_dir.glob("**/*")):
             if symlink.is_symlink():
-                hashes.append(
-                    run(
-                        nix_shell(
-                            ["nixpkgs#git"],
-                            [
-                                "git",
-                                "-C",
-                                self._password_store_dir,
-                                "log",
-                                "-1",
-                                "--format=%H",
-                                str(symlink),
-                            ],
-                        ),
-                        RunOpts(check=False),
-                    )
-                    .stdout.strip()
-                    .encode()
-                )
+                path = str(symlink.relative_to(store_dir))
+                hashes.append(commits.get(path, "").encode())
 
         # we sort the hashes to make sure that the order is always the same
         hashes.sort()
@@ -1,3 +1,6 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -5,7 +8,7 @@ from typing import override
 
 from clan_cli.errors import ClanError
 from clan_cli.machines.machines import Machine
-from clan_cli.secrets import sops
+from clan_cli.secrets import index, sops
 from clan_cli.secrets.folders import (
     sops_groups_folder,
     sops_machines_folder,
@@ -26,6 +29,11 @@ from clan_cli.vars._types import StoreBase
 from clan_cli.vars.generate import Generator
 from clan_cli.vars.var import Var
 
+log = logging.getLogger(__name__)
+
+# sops processes running at once, each can ask for a passphrase or a hardware key touch
+DECRYPT_WORKERS = 4
+
 
 @dataclass
 class SopsKey:
@@ -88,9 +96,9 @@ class SecretStore(StoreBase):
         self, key_dir: Path, generator: Generator, secret_name: str
     ) -> bool:
         secret_path = self.secret_path(generator, secret_name)
-        recipient = sops.SopsKey.load_dir(key_dir)
-        recipients = sops.get_recipients(secret_path)
-        return recipient in recipients
+        pubkey, key_type = index.read_key(key_dir)
+        recipient = sops.SopsKey(pubkey, "", key_type)
+        return recipient in index.get_recipients(secret_path)
 
     def secret_path(self, generator: Generator, secret_name: str) -> Path:
         return self.directory(generator, secret_name)
@@ -163,47 +171,87 @@ class SecretStore(StoreBase):
         ).encode("utf-8")
 
     def populate_dir(self, output_dir: Path, phases: list[str]) -> None:
+        # (target, secret, mode) of every file to decrypt
+        files: list[tuple[Path, Path, int | None]] = []
         if "users" in phases or "services" in phases:
             key_name = f"{self.machine.name}-age.key"
             if not has_secret(sops_secrets_folder(self.machine.flake_dir) / key_name):
                 # skip uploading the secret, not managed by us
                 return
-            key = decrypt_secret(
-                self.machine.flake_dir,
-                sops_secrets_folder(self.machine.flake_dir) / key_name,
+            files.append(
+                (
+                    output_dir / "key.txt",
+                    sops_secrets_folder(self.machine.flake_dir) / key_name,
+                    None,
+                )
             )
-            (output_dir / "key.txt").touch(mode=0o600)
-            (output_dir / "key.txt").write_text(key)
 
         if "activation" in phases:
             for generator in self.machine.vars_generators:
                 for file in generator.files:
                     if file.needed_for == "activation":
-                        target_path = (
-                            output_dir / "activation" / generator.name / file.name
-                        )
-                        target_path.parent.mkdir(
-                            parents=True,
-                            exist_ok=True,
+                        files.append(
+                            (
+                                output_dir / "activation" / generator.name / file.name,
+                                self.secret_path(generator, file.name),
+                                file.mode,
+                            )
                         )
-                        # chmod after in case it doesn't have u+w
-                        target_path.touch(mode=0o600)
-                        target_path.write_bytes(self.get(generator, file.name))
-                        target_path.chmod(file.mode)
 
         if "partitioning" in phases:
             for generator in self.machine.vars_generators:
                 for file in generator.files:
                     if file.needed_for == "partitioning":
-                        target_path = output_dir / generator.name / file.name
-                        target_path.parent.mkdir(
-                            parents=True,
-                            exist_ok=True,
+                        files.append(
+                            (
+                                output_dir / generator.name / file.name,
+                                self.secret_path(generator, file.name),
+                                file.mode,
+                            )
                         )
-                        # chmod after in case it doesn't have u+w
-                        target_path.touch(mode=0o600)
-                        target_path.write_bytes(self.get(generator, file.name))
-                        target_path.chmod(file.mode)
+
+        self.decrypt_files(output_dir, files)
+
+    def decrypt_files(
+        self,
+        output_dir: Path,
+        files: list[tuple[Path, Path, int | None]],
+        max_workers: int = DECRYPT_WORKERS,
+    ) -> None:
+        """
+        Decrypt secrets straight into their target files.
+        Every secret needs its own sops process, at most `max_workers` of them
+        run at once.
+        """
+        if not files:
+            return
+
+        def decrypt(target: Path, secret_path: Path, mode: int | None) -> float:
+            start = time.perf_counter()
+            value = decrypt_secret(self.machine.flake_dir, secret_path)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # chmod after in case it doesn't have u+w
+            target.touch(mode=0o600)
+            target.write_bytes(value.encode("utf-8"))
+            if mode is not None:
+                target.chmod(mode)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(decrypt, *file): file[0] for file in files}
+            try:
+                for future in as_completed(futures):
+                    duration = future.result()
+                    target = futures[future].relative_to(output_dir)
+                    log.debug(f"Decrypted {target} in {duration:.2f}s")
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+        log.info(
+            f"Decrypted {len(files)} secrets of {self.machine.name} "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
 
     def upload(self, phases: list[str]) -> None:
         if "partitioning" in phases:
@@ -212,11 +260,15 @@ class SecretStore(StoreBase):
         with TemporaryDirectory(prefix="sops-upload-") as tempdir:
             sops_upload_dir = Path(tempdir)
             self.populate_dir(sops_upload_dir, phases)
-            upload(self.machine.target_host, sops_upload_dir, Path("/var/lib/sops-nix"))
+            upload(
+                self.machine.target_host,
+                sops_upload_dir,
+                Path("/var/lib/sops-nix"),
+                delta=True,
+            )
 
     def exists(self, generator: Generator, name: str) -> bool:
-        secret_folder = self.secret_path(generator, name)
-        return (secret_folder / "secret").exists()
+        return has_secret(self.secret_path(generator, name))
 
     def ensure_machine_has_access(self, generator: Generator, name: str) -> None:
         if self.machine_has_access(generator, name):
@@ -251,7 +303,7 @@ class SecretStore(StoreBase):
     #        }
     def needs_fix(self, generator: Generator, name: str) -> tuple[bool, str | None]:
         secret_path = self.secret_path(generator, name)
-        current_recipients = sops.get_recipients(secret_path)
+        current_recipients = index.get_recipients(secret_path)
         wanted_recipients = self.collect_keys_for_secret(secret_path)
         needs_update = current_recipients != wanted_recipients
         recipients_to_add = wanted_recipients - current_recipients
@@ -17,9 +17,29 @@ pytest_plugins = [
     "fixtures_flakes",
     "stdout",
     "nix_config",
+    "fake_machine",
 ]
 
 
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="also run the tests marked as benchmark",
+    )
+
+
+def pytest_collection_modifyitems(
+    config: pytest.Config, items: list[pytest.Item]
+) -> None:
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
 # Executed on pytest session start
 def pytest_sessionstart(session: pytest.Session) -> None:
     # This function will be called once at the beginning of the test session
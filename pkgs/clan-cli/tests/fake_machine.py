@@ -0,0 +1,67 @@
+from collections.abc import Callable
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, cast
+
+import pytest
+from clan_cli.machines.machines import Machine
+from clan_cli.ssh.host import Host
+
+
+class FakeMachine:
+    """
+    Stands in for a Machine in tests that do not evaluate a flake,
+    with the attributes that deploying and generating vars read.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        flake_dir: Path,
+        vars_generators: list[Any] | None = None,
+    ) -> None:
+        self.name = name
+        self.flake_dir = flake_dir
+        self.flake = SimpleNamespace(
+            is_local=False, identifier="github:clan/flake", hash="sha256-1"
+        )
+        self.vars_generators = vars_generators or []
+        self.secret_vars_store = None
+        self.public_vars_store = None
+        self.override_build_host: str | None = None
+        self.deployment: dict[str, Any] = {}
+        self.nix_options: list[str] = []
+
+    @property
+    def target_host(self) -> Host:
+        return Host(self.name)
+
+    @property
+    def build_host(self) -> Host:
+        return Host(self.override_build_host or self.name)
+
+    def flush_caches(self) -> None:
+        pass
+
+    def info(self, msg: str) -> None:
+        pass
+
+    def error(self, msg: str) -> None:
+        pass
+
+
+FakeMachineFactory = Callable[..., Machine]
+
+
+@pytest.fixture
+def fake_machine(tmp_path: Path) -> FakeMachineFactory:
+    """
+    Creates FakeMachines in a flake directory under tmp_path,
+    typed as Machine to pass them to the code under test.
+    """
+    flake_dir = tmp_path / "flake"
+
+    def create(name: str = "machine1", **kwargs: Any) -> Machine:
+        return cast(Machine, FakeMachine(name, flake_dir, **kwargs))
+
+    return create
@@ -0,0 +1,42 @@
+import tracemalloc
+
+import pytest
+from clan_cli.cmd import MAX_READ_SIZE, Log, RunOpts, run
+
+
+def test_run_input_and_output() -> None:
+    # larger than the pipe buffer in both directions
+    data = b"x" * 10_000_000
+    out = run(["sh", "-c", "cat; echo done >&2"], RunOpts(input=data, log=Log.NONE))
+    assert out.stdout == data.decode()
+    assert out.stderr == "done\n"
+
+
+def test_run_without_retaining_output() -> None:
+    out = run(["echo", "hello"], RunOpts(log=Log.NONE, retain_output=False))
+    assert out.returncode == 0
+    assert out.stdout == ""
+
+
+def test_handle_io_retained_output() -> None:
+    size = 4 * MAX_READ_SIZE
+    out = run(["head", "-c", str(size), "/dev/zero"], RunOpts(log=Log.NONE))
+    assert len(out.stdout) == size
+    assert out.stdout.count("\0") == size
+
+
+@pytest.mark.benchmark
+def test_handle_io_streaming_memory() -> None:
+    # 1 GiB of output that is neither logged nor retained
+    size = 1024**3
+    cmd = ["head", "-c", str(size), "/dev/zero"]
+    tracemalloc.start()
+    try:
+        out = run(cmd, RunOpts(log=Log.NONE, retain_output=False))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert out.returncode == 0
+    assert out.stdout == ""
+    # only a few reads are held in memory at any time
+    assert peak < 4 * MAX_READ_SIZE
@@ -0,0 +1,111 @@
+import argparse
+import fcntl
+import json
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+from clan_cli import completions
+from clan_cli.errors import ClanError
+
+
+def test_completions_from_index(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(completions, "clan_dir", lambda flake: str(tmp_path))
+    spawned: list[list[str]] = []
+
+    def fake_spawn(path: str, argv: list[str], *args: Any, **kwargs: Any) -> int:
+        spawned.append(argv)
+        return 0
+
+    monkeypatch.setattr(completions.os, "posix_spawn", fake_spawn)
+
+    # no index yet, a refresh is started
+    assert completions.completion_index() is None
+    assert spawned[0][-2:] == ["clan_cli.completions", str(tmp_path)]
+
+    index_path = completions.completion_index_path(str(tmp_path))
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    index_path.write_text(
+        json.dumps(
+            {
+                "hash": "sha256-1",
+                "machines": ["machine1"],
+                "tags": ["all"],
+                "perMachine": {
+                    "machine1": {
+                        "services": [],
+                        "generators": ["ssh"],
+                        "backupProviders": [],
+                        "stateServices": [],
+                        "targetHost": "root@machine1",
+                    }
+                },
+            }
+        )
+    )
+    args = argparse.Namespace(machines=["machine1"], machine="machine1")
+    assert cast(dict[str, str], completions.complete_machines("", args)) == {
+        "machine1": "machine"
+    }
+    assert cast(dict[str, str], completions.complete_tags("", args)) == {"all": "tag"}
+    assert cast(
+        dict[str, str], completions.complete_generators_for_machine("", args)
+    ) == {"ssh": "generator"}
+    assert cast(dict[str, str], completions.complete_target_host("", args)) == {
+        "root@machine1": "target_host"
+    }
+    # the index was just written, no further refresh is needed
+    assert len(spawned) == 1
+
+
+def test_completion_index_refresh(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(completions, "clan_dir", lambda flake: str(tmp_path))
+    spawned: list[list[str]] = []
+
+    def fake_spawn(path: str, argv: list[str], *args: Any, **kwargs: Any) -> int:
+        spawned.append(argv)
+        return 0
+
+    monkeypatch.setattr(completions.os, "posix_spawn", fake_spawn)
+    monkeypatch.setattr(completions, "INDEX_REFRESH_INTERVAL", -1)
+    lock_path = completions.completion_index_path(str(tmp_path)).with_suffix(".lock")
+
+    completions.completion_index()
+    assert len(spawned) == 1
+
+    # no new refresh while one is still running
+    with lock_path.open("w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        completions.completion_index()
+        assert len(spawned) == 1
+
+    completions.completion_index()
+    assert len(spawned) == 2
+
+
+def test_refresh_completion_index_logs_errors(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    log_path = completions.completion_index_path(str(tmp_path)).with_suffix(".log")
+
+    def build_completion_index(flake: str) -> None:
+        msg = "evaluation failed"
+        raise ClanError(msg)
+
+    monkeypatch.setattr(completions, "build_completion_index", build_completion_index)
+    completions.refresh_completion_index(str(tmp_path))
+    log = log_path.read_text()
+    assert f"Failed to refresh the completion index of {tmp_path}" in log
+    assert "evaluation failed" in log
+
+    # successful refreshes leave the log of the last failure alone
+    monkeypatch.setattr(completions, "build_completion_index", lambda flake: None)
+    completions.refresh_completion_index(str(tmp_path))
+    assert log_path.read_text() == log
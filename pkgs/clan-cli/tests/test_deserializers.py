@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from enum import Enum
 from pathlib import Path
 from typing import Any, Literal
 
@@ -294,3 +295,58 @@ def test_enum_roundtrip() -> None:
     assert from_dict(Person, data2) == expected2
 
     assert dataclass_to_dict(expected2) == data2
+
+
+def test_union_order() -> None:
+    # equal unions are cached separately, the first type is constructed
+    assert from_dict(int | str, 1.5) == 1
+    with pytest.raises(ClanError):
+        from_dict(str | int, 1.5)
+
+
+def test_machine_records_roundtrip() -> None:
+    class MachineClass(Enum):
+        NIXOS = "nixos"
+        DARWIN = "darwin"
+
+    @dataclass
+    class Deploy:
+        target_host: str | None = field(default=None, metadata={"alias": "targetHost"})
+        build_host: str | None = field(default=None, metadata={"alias": "buildHost"})
+
+    @dataclass
+    class MachineRecord:
+        name: str
+        machine_class: MachineClass = field(metadata={"alias": "machineClass"})
+        deploy: Deploy
+        tags: list[str]
+        description: str | None = None
+        icon: Path | None = None
+        state: Literal["online", "offline", "unknown"] = "unknown"
+        options: dict[str, Any] = field(default_factory=dict)
+
+    data = [
+        {
+            "name": f"machine{i}",
+            "machineClass": "nixos" if i % 2 else "darwin",
+            "deploy": {"targetHost": f"root@machine{i}", "buildHost": None},
+            "tags": ["all", f"rack{i % 10}"],
+            "description": f"Machine number {i}",
+            "icon": f"/icons/machine{i}.svg",
+            "state": "online",
+            "options": {"cores": i % 64, "zfs": bool(i % 3)},
+        }
+        for i in range(20)
+    ]
+
+    # the second call goes through the cached constructors
+    for _ in range(2):
+        records = from_dict(list[MachineRecord], data)
+        serialized = dataclass_to_dict(records)
+
+        assert len(records) == 20
+        assert records[1].machine_class is MachineClass.NIXOS
+        assert records[1].deploy == Deploy(target_host="root@machine1")
+        assert serialized[1]["deploy"] == {"targetHost": "root@machine1"}
+        assert serialized[1]["icon"] == "/icons/machine1.svg"
+        assert from_dict(list[MachineRecord], serialized) == records
@@ -0,0 +1,161 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from clan_cli.errors import ClanError
+from clan_cli.eval_server import (
+    EvalServer,
+    EvalServerState,
+    eval_server_request,
+    eval_server_socket,
+)
+from clan_cli.flake import Flake
+from clan_cli.machines.machines import Machine
+from fixtures_flakes import ClanFlake
+
+
+def test_eval_server_socket(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    socket_path = tmp_path / "eval-server.sock"
+    monkeypatch.setenv("CLAN_EVAL_SERVER", str(socket_path))
+    assert eval_server_socket() is None
+
+    with EvalServer(socket_path):
+        assert eval_server_socket() == socket_path
+        monkeypatch.setenv("CLAN_EVAL_SERVER", "0")
+        assert eval_server_socket() is None
+
+
+def test_eval_server_error(tmp_path: Path) -> None:
+    socket_path = tmp_path / "eval-server.sock"
+    with EvalServer(socket_path) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with pytest.raises(ClanError) as exc_info:
+                eval_server_request(socket_path, {"method": "frobnicate"})
+            assert exc_info.value.description is not None
+            assert "Unknown eval server method" in exc_info.value.description
+        finally:
+            server.shutdown()
+            thread.join()
+
+
+def test_eval_server_prefetch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    hashes = {str(tmp_path): "sha256-1", "github:clan/clan": "sha256-1"}
+    prefetches = []
+
+    def fake_prefetch(self: Flake) -> None:
+        prefetches.append(self.identifier)
+        self._hash = hashes[self.identifier]
+
+    evaluations = []
+
+    def fake_nix(self: Machine, method: str, attr: str) -> str:
+        evaluations.append(attr)
+        return f"{attr} of {hashes[self.flake.identifier]}"
+
+    monkeypatch.setattr(Flake, "prefetch", fake_prefetch)
+    monkeypatch.setattr(Machine, "nix", fake_nix)
+    state = EvalServerState()
+    (tmp_path / "flake.nix").write_text("{}")
+    request = {
+        "method": "eval",
+        "flake": str(tmp_path),
+        "machine": "machine1",
+        "attr": "config.foo",
+    }
+
+    # the local flake is only prefetched again once its files changed
+    assert state.handle(request) == "config.foo of sha256-1"
+    assert state.handle(request) == "config.foo of sha256-1"
+    assert prefetches == [str(tmp_path)]
+    (tmp_path / "flake.nix").write_text("{ }")
+    assert state.handle(request) == "config.foo of sha256-1"
+    assert prefetches == [str(tmp_path)] * 2
+    assert evaluations == ["config.foo"]
+
+    # a narHash sent by the client is compared without prefetching
+    assert state.handle({**request, "hash": "sha256-1"}) == "config.foo of sha256-1"
+    assert len(prefetches) == 2
+    hashes[str(tmp_path)] = "sha256-2"
+    assert state.handle({**request, "hash": "sha256-2"}) == "config.foo of sha256-2"
+    assert len(prefetches) == 3
+    assert evaluations == ["config.foo"] * 2
+
+    # refresh evaluates again, remote flakes are checked after REMOTE_TTL
+    assert state.handle({**request, "refresh": True}) == "config.foo of sha256-2"
+    assert evaluations == ["config.foo"] * 3
+    remote = {**request, "flake": "github:clan/clan"}
+    state.handle(remote)
+    state.handle(remote)
+    assert prefetches.count("github:clan/clan") == 1
+
+    with pytest.raises(ClanError, match="must be resolved by the client"):
+        state.handle({**request, "flake": "."})
+
+
+def test_eval_server_concurrent_requests(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def fake_prefetch(self: Flake) -> None:
+        self._hash = "sha256-1"
+
+    lock = threading.Lock()
+    evaluations = []
+    running = 0
+    max_running = 0
+
+    def fake_nix(self: Machine, method: str, attr: str) -> str:
+        nonlocal running, max_running
+        with lock:
+            evaluations.append(attr)
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return f"{attr} of {self.name}"
+
+    monkeypatch.setattr(Flake, "prefetch", fake_prefetch)
+    monkeypatch.setattr(Machine, "nix", fake_nix)
+    state = EvalServerState()
+    requests = [
+        {
+            "method": "eval",
+            "flake": str(tmp_path),
+            "machine": machine,
+            "attr": "config.foo",
+        }
+        for machine in ["machine1", "machine2"] * 4
+    ]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(state.handle, requests))
+
+    assert results == ["config.foo of machine1", "config.foo of machine2"] * 4
+    # requests for one flake are handled one at a time, each value is evaluated once
+    assert max_running == 1
+    assert len(evaluations) == 2
+
+
+@pytest.mark.with_core
+def test_eval_server_select(flake: ClanFlake, tmp_path: Path) -> None:
+    flake.machines["machine1"]["nixpkgs"]["hostPlatform"] = "x86_64-linux"
+    flake.refresh()
+    socket_path = tmp_path / "eval-server.sock"
+    request = {
+        "method": "select",
+        "flake": str(flake.path),
+        "selector": "nixosConfigurations.machine1.config.networking.hostName",
+    }
+    with EvalServer(socket_path) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            assert eval_server_request(socket_path, request) == "machine1"
+            # the second request is answered from the cache
+            assert eval_server_request(socket_path, request) == "machine1"
+        finally:
+            server.shutdown()
+            thread.join()
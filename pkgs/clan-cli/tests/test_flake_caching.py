@@ -1,5 +1,13 @@
+import sqlite3
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
 import pytest
-from clan_cli.flake import Flake, FlakeCache, FlakeCacheEntry
+from clan_cli.flake import Flake, FlakeCache, FlakeCacheEntry, split_selector
 from fixtures_flakes import ClanFlake
 
 
@@ -13,6 +21,18 @@ def test_select() -> None:
     assert not test_cache.is_cached(["x", "z", 1])
 
 
+def test_split_selector() -> None:
+    selectors = split_selector('x."y.z".{a,b}.0.*')
+    assert selectors[:4] == ("x", "y.z", frozenset({"a", "b"}), frozenset({0}))
+    # parsed selectors are immutable and memoized
+    assert split_selector('x."y.z".{a,b}.0.*') is selectors
+
+    test_cache = FlakeCache()
+    test_cache.insert({"a": "foo", "b": "bar"}, "x.{a,b}")
+    assert test_cache.is_cached(split_selector("x.{a,b}"))
+    assert test_cache.select(split_selector("x.{a,b}")) == {"a": "foo", "b": "bar"}
+
+
 def test_out_path() -> None:
     testdict = {"x": {"y": [123, 345, 456], "z": "/nix/store/bla"}}
     test_cache = FlakeCacheEntry(testdict, [])
@@ -20,6 +40,30 @@ def test_out_path() -> None:
     assert test_cache.select(["x", "z", "outPath"]) == "/nix/store/bla"
 
 
+@pytest.mark.benchmark
+def test_cache_entry_benchmark() -> None:
+    leaves = 100_000
+    testdict = {
+        f"machine{i}": {"config": {f"option{j}": f"value{j}" for j in range(100)}}
+        for i in range(leaves // 100)
+    }
+
+    tracemalloc.start()
+    try:
+        test_cache = FlakeCacheEntry(testdict, [])
+        memory, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    all_options = split_selector("*.config.*")
+    assert test_cache.is_cached(all_options)
+    assert len(test_cache.select(all_options)) == leaves // 100
+    for i in range(leaves // 100):
+        assert test_cache.select([f"machine{i}", "config", "option42"]) == "value42"
+    # a leaf is a slotted entry plus its selector, no per-object __dict__
+    assert memory / leaves < 300
+
+
 @pytest.mark.with_core
 def test_flake_caching(flake: ClanFlake) -> None:
     m1 = flake.machines["machine1"]
@@ -58,3 +102,265 @@ def test_cache_persistance(flake: ClanFlake) -> None:
     assert flake2._cache.is_cached(  # noqa: SLF001
         "nixosConfigurations.*.config.networking.{hostName,hostId}"
     )
+
+
+@pytest.mark.with_core
+def test_precache(flake: ClanFlake) -> None:
+    m1 = flake.machines["machine1"]
+    m1["nixpkgs"]["hostPlatform"] = "x86_64-linux"
+    flake.machines["machine2"] = m1.copy()
+    flake.refresh()
+
+    flake_ = Flake(str(flake.path))
+    selectors = [
+        "nixosConfigurations.machine1.config.networking.hostName",
+        "nixosConfigurations.machine2.config.networking.hostName",
+    ]
+    flake_.precache(selectors)
+    assert isinstance(flake_._cache, FlakeCache)  # noqa: SLF001
+    for selector in selectors:
+        assert flake_._cache.is_cached(selector)  # noqa: SLF001
+    assert flake_.select(selectors[1]) == "machine2"
+
+
+def test_cache_file_concurrent_writers(tmp_path: Path) -> None:
+    cache_path = tmp_path / "flake-cache.sqlite"
+    writer1 = FlakeCache()
+    writer2 = FlakeCache()
+    writer1.insert({"x": {"y": "foo"}}, "")
+    writer2.insert({"x": {"z": "bar"}}, "")
+    writer1.save_to_file(cache_path)
+    writer2.save_to_file(cache_path)
+
+    # writer2 picked up the entry of writer1 while appending its own
+    assert writer2.is_cached("x.y")
+    assert writer2.select("x.y") == "foo"
+
+    reader = FlakeCache()
+    reader.load_from_file(cache_path)
+    assert reader.select("x.{y,z}") == {"y": "foo", "z": "bar"}
+
+    # loading again only replays new entries
+    writer1.insert({"w": 1}, "")
+    writer1.save_to_file(cache_path)
+    reader.load_from_file(cache_path)
+    assert reader.select("w") == 1
+
+
+def test_cache_file_reload_only_on_change(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache_path = tmp_path / "flake-cache.sqlite"
+    writer = FlakeCache()
+    writer.insert({"x": "foo"}, "")
+    writer.save_to_file(cache_path)
+
+    reader = FlakeCache()
+    reader.load_from_file(cache_path)
+    assert reader.select("x") == "foo"
+
+    replays = []
+    replay = reader._replay  # noqa: SLF001
+
+    def counting_replay(conn: sqlite3.Connection) -> None:
+        replays.append(conn)
+        replay(conn)
+
+    monkeypatch.setattr(reader, "_replay", counting_replay)
+
+    reader.load_from_file(cache_path)
+    assert replays == []
+
+    writer.insert({"y": "bar"}, "")
+    writer.save_to_file(cache_path)
+    reader.load_from_file(cache_path)
+    assert len(replays) == 1
+    assert reader.select("y") == "bar"
+
+
+# like the default deployment data of a machine
+DEPLOYMENT_DATA = {
+    "targetHost": None,
+    "buildHost": None,
+    "dependencies": ["machine2", "machine3"],
+    "deploymentAddress": [],
+    "facts": {"services": {}, "secretModule": "clan_cli.facts.secret_modules.sops"},
+    "vars": {"generators": {}, "secretModule": "clan_cli.vars.secret_modules.sops"},
+}
+
+
+def test_cache_null_and_list_values() -> None:
+    test_cache = FlakeCache()
+    test_cache.insert({"a": None, "b": ["x", None, 1], "c": []}, "")
+    assert test_cache.is_cached("a")
+    assert test_cache.select("a") is None
+    assert test_cache.select("b") == ["x", None, 1]
+    assert test_cache.select("c") == []
+    assert test_cache.select("") == {"a": None, "b": ["x", None, 1], "c": []}
+
+    test_cache.insert({"x": None}, "d")
+    assert test_cache.select("d") == {"x": None}
+
+
+def test_get_all_machines_cached(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from clan_cli.machines import inventory
+
+    monkeypatch.setattr(inventory, "nix_config", lambda: {"system": "x86_64-linux"})
+    flake = Flake(str(tmp_path))
+    # what prefetch loads from the cache file of the current flake hash
+    flake._cache = FlakeCache()  # noqa: SLF001
+    flake.flake_cache_path = tmp_path / "cache.sqlite"
+    flake._cache.insert(  # noqa: SLF001
+        {"machine1": DEPLOYMENT_DATA, "machine2": {**DEPLOYMENT_DATA, "vars": {}}},
+        "clanInternals.machines.x86_64-linux.*.config.system.clan.deployment.data",
+    )
+
+    machines = inventory.get_all_machines(flake, [])
+    assert [machine.name for machine in machines] == ["machine1", "machine2"]
+    assert machines[0].deployment == DEPLOYMENT_DATA
+    assert machines[1].deployment["vars"] == {}
+
+    # the same values come back after a round trip through the cache file
+    flake._cache.save_to_file(flake.flake_cache_path)  # noqa: SLF001
+    flake._cache = FlakeCache()  # noqa: SLF001
+    flake._cache.load_from_file(flake.flake_cache_path)  # noqa: SLF001
+    machines = inventory.get_all_machines(flake, [])
+    assert machines[0].deployment == DEPLOYMENT_DATA
+
+
+def test_get_selected_machines_precached(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from clan_cli.machines import inventory
+
+    monkeypatch.setattr(inventory, "nix_config", lambda: {"system": "x86_64-linux"})
+    flake = Flake(str(tmp_path))
+    flake._cache = FlakeCache()  # noqa: SLF001
+    flake.flake_cache_path = tmp_path / "cache.sqlite"
+    evaluations: list[list[str]] = []
+
+    def get_from_nix(selectors: list[str]) -> None:
+        evaluations.append(selectors)
+        for selector in selectors:
+            flake._cache.insert(DEPLOYMENT_DATA, selector)  # type: ignore[union-attr]  # noqa: SLF001
+
+    monkeypatch.setattr(flake, "get_from_nix", get_from_nix)
+
+    machines = inventory.get_selected_machines(flake, [], ["machine1", "machine2"])
+    # both machines are resolved in a single evaluation
+    assert len(evaluations) == 1
+    assert len(evaluations[0]) == 2
+    assert [machine.deployment for machine in machines] == [DEPLOYMENT_DATA] * 2
+
+
+def test_flake_select_while_invalidating(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    prefetches = []
+
+    def fake_prefetch(self: Flake) -> None:
+        # slow enough for other threads to run in between
+        time.sleep(0.001)
+        prefetches.append(self.identifier)
+        cache = FlakeCache()
+        cache.insert({"b": 1}, "a")
+        self.store_path = "/nix/store/flake"
+        self.flake_cache_path = tmp_path / "cache.sqlite"
+        self._hash = f"sha256-{len(prefetches)}"
+        self._cache = cache
+
+    monkeypatch.setattr(Flake, "_prefetch", fake_prefetch)
+
+    # threads waiting for a running prefetch use its result
+    flake = Flake("flake")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        hashes = list(executor.map(lambda _: flake.hash, range(8)))
+    assert hashes == ["sha256-1"] * 8
+    assert len(prefetches) == 1
+
+    # like the deploy jobs of several machines, that each flush the caches
+    stop = threading.Event()
+
+    def invalidate() -> None:
+        while not stop.is_set():
+            flake.invalidate_cache()
+
+    def select() -> list[Any]:
+        return [flake.select("a") for _ in range(200)]
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        invalidator = executor.submit(invalidate)
+        selects = [executor.submit(select) for _ in range(4)]
+        try:
+            results = [future.result() for future in selects]
+        finally:
+            stop.set()
+        invalidator.result()
+    assert results == [[{"b": 1}] * 200] * 4
+    assert len(prefetches) > 1
+
+
+def test_machine_eval_cache_lru(tmp_path: Path) -> None:
+    from clan_cli.machines.eval_cache import MachineEvalCache
+
+    cache = MachineEvalCache(tmp_path / "cache.sqlite", max_size=25)
+    cache.set("a", "1" * 9)
+    cache.set("b", "2" * 9)
+    # a is now more recently used than b
+    assert cache.get("a") == "1" * 9
+    cache.set("c", "3" * 9)
+    assert cache.get("a") == "1" * 9
+    assert cache.get("b") is None
+    assert cache.get("c") == "3" * 9
+
+
+def test_machine_eval_nix_disk_cache(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from clan_cli.machines import machines
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setenv("CLAN_EVAL_SERVER", "0")
+    flake_hashes = {"flake": "sha256-1"}
+    prefetches = []
+
+    def fake_prefetch(self: Flake) -> None:
+        prefetches.append(self.identifier)
+        self._cache = FlakeCache()
+        self._hash = flake_hashes[self.identifier]
+
+    monkeypatch.setattr(Flake, "prefetch", fake_prefetch)
+    evaluations = []
+
+    def fake_nix(self: machines.Machine, method: str, attr: str, *args: Any) -> str:
+        evaluations.append(attr)
+        return f'"{attr} of {flake_hashes["flake"]}"'
+
+    monkeypatch.setattr(machines.Machine, "nix", fake_nix)
+
+    def eval_once() -> str:
+        # a new machine per cli invocation
+        machine = machines.Machine(name="machine1", flake=Flake("flake"))
+        return machine.eval_nix("config.foo")
+
+    assert eval_once() == '"config.foo of sha256-1"'
+    assert eval_once() == '"config.foo of sha256-1"'
+    assert evaluations == ["config.foo"]
+
+    flake_hashes["flake"] = "sha256-2"
+    assert eval_once() == '"config.foo of sha256-2"'
+    assert evaluations == ["config.foo", "config.foo"]
+
+    # the narHash of the flake is reused, until the machine flushes its caches
+    flake = Flake("flake")
+    machine = machines.Machine(name="machine1", flake=flake)
+    prefetches.clear()
+    machine.eval_nix("config.foo")
+    machines.Machine(name="machine2", flake=flake).eval_nix("config.foo")
+    assert prefetches == ["flake"]
+    flake_hashes["flake"] = "sha256-3"
+    machine.flush_caches()
+    assert machine.eval_nix("config.foo") == '"config.foo of sha256-3"'
+    assert prefetches == ["flake", "flake"]
@@ -1,5 +1,7 @@
+import contextvars
 import subprocess
 import tempfile
+import threading
 from pathlib import Path
 
 import pytest
@@ -63,3 +65,73 @@ def test_clan_flake_in_subdir(git_repo: Path, monkeypatch: pytest.MonkeyPatch) -
         ).decode("utf-8")
         == "test commit\n\n"
     )
+
+
+def test_commit_transaction(git_repo: Path) -> None:
+    with git.commit_transaction(git_repo, "batched commit"):
+        for name in ["a", "b"]:
+            (git_repo / name).mkdir()
+            (git_repo / name / "file with space").write_text(name)
+            git.commit_files([git_repo / name], git_repo, f"add {name}")
+        # nothing is committed before the transaction ends
+        assert subprocess.check_output(["git", "status", "--porcelain"], cwd=git_repo)
+    assert not subprocess.check_output(["git", "status", "--porcelain"], cwd=git_repo)
+    assert (
+        subprocess.check_output(
+            ["git", "log", "-1", "--pretty=%B"], cwd=git_repo
+        ).decode("utf-8")
+        == "batched commit\n\nadd a\nadd b\n\n"
+    )
+
+
+def test_commit_transaction_threads(git_repo: Path) -> None:
+    def commit(name: str) -> None:
+        (git_repo / name).write_text(name)
+        git.commit_files([git_repo / name], git_repo, f"add {name}")
+
+    def log() -> list[str]:
+        return subprocess.check_output(
+            ["git", "log", "--format=%s"], cwd=git_repo, text=True
+        ).splitlines()
+
+    with git.commit_transaction(git_repo, "batched commit"):
+        # threads running in a copy of the context join the transaction
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(commit, "a"))
+        thread.start()
+        thread.join()
+        # other threads commit on their own
+        thread = threading.Thread(target=commit, args=("b",))
+        thread.start()
+        thread.join()
+        assert log()[0] == "add b"
+    assert log()[:2] == ["add a", "add b"]
+
+
+def test_last_commits(git_repo: Path) -> None:
+    def last_commit(path: str) -> str:
+        return subprocess.check_output(
+            ["git", "log", "-1", "--format=%H", "--", path], cwd=git_repo, text=True
+        ).strip()
+
+    secrets = git_repo / "machines" / "machine1"
+    secrets.mkdir(parents=True)
+    (secrets / "a").write_text("a")
+    (secrets / "link-a").symlink_to("a")
+    git.commit_files([secrets], git_repo, "add a")
+    (secrets / "b").write_text("b")
+    (secrets / "link b ü").symlink_to("b")
+    git.commit_files([secrets], git_repo, "add b")
+
+    commits = git.last_commits(git_repo, "machines/machine1")
+    assert commits["machines/machine1"] == last_commit("machines/machine1")
+    for name in ["a", "link-a", "b", "link b ü"]:
+        path = f"machines/machine1/{name}"
+        assert commits[path] == last_commit(path)
+    assert commits["machines/machine1/a"] != commits["machines/machine1/b"]
+
+    # a new commit invalidates the cached result
+    (secrets / "a").write_text("changed")
+    git.commit_files([secrets / "a"], git_repo, "change a")
+    commits = git.last_commits(git_repo, "machines/machine1")
+    assert commits["machines/machine1/a"] == last_commit("machines/machine1")
@@ -0,0 +1,251 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, cast
+
+import pytest
+from clan_cli.errors import ClanError, CmdOut
+from clan_cli.machines import update
+from clan_cli.machines.machines import Machine
+from clan_cli.ssh.host import Host
+from fake_machine import FakeMachine, FakeMachineFactory
+
+
+class Deployments:
+    def __init__(self) -> None:
+        self.started: list[str] = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+
+@pytest.fixture
+def deployments(monkeypatch: pytest.MonkeyPatch) -> Deployments:
+    """
+    Replaces the first step of a deployment, every deployment fails after it.
+    Generating facts and vars does nothing.
+    """
+    deployments = Deployments()
+
+    def fake_upload_secrets(machine: Machine) -> None:
+        with deployments.lock:
+            deployments.started.append(machine.name)
+            deployments.running += 1
+            deployments.max_running = max(deployments.max_running, deployments.running)
+        time.sleep(0.05)
+        with deployments.lock:
+            deployments.running -= 1
+        msg = f"{machine.name} failed"
+        raise ClanError(msg)
+
+    monkeypatch.setattr(update, "generate_facts", lambda *args, **kwargs: None)
+    monkeypatch.setattr(update, "generate_vars", lambda *args, **kwargs: None)
+    monkeypatch.setattr(update, "upload_secrets", fake_upload_secrets)
+    return deployments
+
+
+def test_deploy_max_parallel(
+    deployments: Deployments, fake_machine: FakeMachineFactory
+) -> None:
+    with pytest.raises(ClanError, match="5 hosts failed"):
+        update.deploy_machines(
+            [fake_machine(name) for name in ["a", "b", "c", "d", "e"]], max_parallel=2
+        )
+    assert sorted(deployments.started) == ["a", "b", "c", "d", "e"]
+    assert deployments.max_running == 2
+
+
+def test_deploy_failure_budget(
+    deployments: Deployments, fake_machine: FakeMachineFactory
+) -> None:
+    batches = [
+        [fake_machine(name) for name in ["a", "b", "c"]],
+        [fake_machine("d")],
+    ]
+    with pytest.raises(ClanError, match="2 hosts failed"):
+        update.deploy_machines([], max_parallel=1, batches=batches, max_failures=2)
+    assert deployments.started == ["a", "b"]
+
+
+def test_deploy_generates_first(
+    deployments: Deployments,
+    monkeypatch: pytest.MonkeyPatch,
+    fake_machine: FakeMachineFactory,
+) -> None:
+    generated: list[tuple[str, list[str]]] = []
+
+    def fake_generate_facts(machines: list[Machine], **kwargs: Any) -> None:
+        generated.append((machines[0].name, list(deployments.started)))
+        if machines[0].name == "b":
+            msg = "b failed to generate"
+            raise ClanError(msg)
+
+    monkeypatch.setattr(update, "generate_facts", fake_generate_facts)
+    with pytest.raises(ClanError, match="3 hosts failed"):
+        update.deploy_machines(
+            [fake_machine(name) for name in ["a", "b", "c"]], max_parallel=3
+        )
+    # generating changes the shared flake, nothing is deployed at the same time
+    assert generated == [("a", []), ("b", []), ("c", [])]
+    # a failed generation only fails the deployment of its machine
+    assert sorted(deployments.started) == ["a", "c"]
+
+
+def test_deployment_batches(fake_machine: FakeMachineFactory) -> None:
+    machines = [fake_machine(name) for name in ["web1", "db1", "other", "web2"]]
+    # web2 is built on db1
+    cast(FakeMachine, machines[3]).override_build_host = "db1"
+    batches = update.deployment_batches(
+        machines,
+        ["db", "web"],
+        {"web1": ["web"], "web2": ["web", "db"], "db1": ["db"]},
+    )
+    assert [[m.name for m in batch] for batch in batches] == [
+        ["db1", "web2"],
+        ["web1"],
+        ["other"],
+    ]
+    assert [m.name for m in update.build_host_first(machines)] == [
+        "db1",
+        "web1",
+        "other",
+        "web2",
+    ]
+
+
+def test_build_toplevels(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, fake_machine: FakeMachineFactory
+) -> None:
+    commands = []
+
+    def fake_run(cmd: list[str], opts: Any = None) -> CmdOut:
+        commands.append(cmd)
+        installables = [arg for arg in cmd if "#" in arg]
+        names = [arg.split('"')[1] for arg in installables]
+        results = [{"outputs": {"out": f"/nix/store/{name}-system"}} for name in names]
+        return CmdOut(json.dumps(results), "", None, Path.cwd(), cmd, 0, None)
+
+    monkeypatch.setattr(update, "run", fake_run)
+    machines = [fake_machine(name) for name in ["a", "b"]]
+    cast(FakeMachine, machines[1]).nix_options = ["--option", "foo", "bar"]
+    machines += [fake_machine("c")]
+
+    toplevels = update.build_toplevels(machines)
+
+    # machines with the same flake and options are built together
+    assert len(commands) == 2
+    # the system nixos-rebuild would build, not the one of clanInternals
+    # that is evaluated for the local platform
+    assert [arg for arg in commands[0] if "#" in arg] == [
+        f'path:{tmp_path}/flake#nixosConfigurations."a".config.system.build.toplevel',
+        f'path:{tmp_path}/flake#nixosConfigurations."c".config.system.build.toplevel',
+    ]
+    assert toplevels == {
+        "a": Path("/nix/store/a-system"),
+        "b": Path("/nix/store/b-system"),
+        "c": Path("/nix/store/c-system"),
+    }
+
+
+def test_nix_copy_url() -> None:
+    assert update.nix_copy_url(Host("machine1")) == "ssh://root@machine1"
+    assert update.nix_copy_url(Host("machine1", user="root")) == "ssh://root@machine1"
+    # unsigned paths are only accepted from trusted users
+    assert (
+        update.nix_copy_url(Host("machine1", user="admin"))
+        == "ssh-ng://admin@machine1?remote-program=sudo%20--%20nix-daemon"
+    )
+
+
+def test_upload_sources_once_per_build_host(
+    monkeypatch: pytest.MonkeyPatch, fake_machine: FakeMachineFactory
+) -> None:
+    metadata_calls = []
+    uploads = []
+
+    def fake_metadata(flake_url: str) -> dict[str, Any]:
+        metadata_calls.append(flake_url)
+        return {"path": "/nix/store/source"}
+
+    def fake_upload(
+        machine: Machine, host: Host, flake_url: str, flake_data: dict[str, Any]
+    ) -> str:
+        time.sleep(0.05)
+        uploads.append(host.host)
+        return flake_data["path"]
+
+    monkeypatch.setattr(update, "nix_metadata", fake_metadata)
+    monkeypatch.setattr(update, "_upload_flake", fake_upload)
+
+    machines = [fake_machine(name) for name in ["a", "b", "c"]]
+    for machine in machines[:2]:
+        cast(FakeMachine, machine).override_build_host = "builder"
+
+    source_uploads = update.SourceUploads()
+    with ThreadPoolExecutor() as executor:
+        paths = list(
+            executor.map(
+                lambda machine: update.upload_sources(machine, source_uploads),
+                machines,
+            )
+        )
+
+    assert paths == ["/nix/store/source"] * 3
+    assert metadata_calls == ["github:clan/flake"]
+    assert sorted(uploads) == ["builder", "c"]
+
+    # generating values for a machine changes the narHash of the flake
+    cast(FakeMachine, machines[2]).flake.hash = "sha256-2"
+    update.upload_sources(machines[2], source_uploads)
+    assert metadata_calls == ["github:clan/flake"] * 2
+
+
+def test_deploy_build_locally_generate_failure(
+    monkeypatch: pytest.MonkeyPatch, fake_machine: FakeMachineFactory
+) -> None:
+    def fake_generate_facts(machines: list[Machine], **kwargs: Any) -> None:
+        if machines[0].name == "a":
+            msg = "a failed"
+            raise ClanError(msg)
+
+    built: list[str] = []
+    activated: list[str] = []
+
+    def fake_build_toplevels(machines: list[Machine]) -> dict[str, Path]:
+        built.extend(machine.name for machine in machines)
+        return {
+            machine.name: Path(f"/nix/store/{machine.name}") for machine in machines
+        }
+
+    monkeypatch.setattr(update, "generate_facts", fake_generate_facts)
+    monkeypatch.setattr(update, "generate_vars", lambda *args, **kwargs: None)
+    monkeypatch.setattr(update, "upload_secrets", lambda machine: None)
+    monkeypatch.setattr(update, "upload_secret_vars", lambda machine: None)
+    monkeypatch.setattr(update, "build_toplevels", fake_build_toplevels)
+    monkeypatch.setattr(
+        update,
+        "activate_toplevel",
+        lambda machine, toplevel: activated.append(machine.name),
+    )
+
+    # the failed generation counts against the budget of the deployment
+    with pytest.raises(ClanError, match="1 hosts failed"):
+        update.deploy_machines(
+            [fake_machine(name) for name in ["a", "b", "c"]],
+            max_parallel=1,
+            build_locally=True,
+        )
+    assert built == ["b", "c"]
+    assert activated == ["b", "c"]
+
+    activated.clear()
+    with pytest.raises(ClanError, match="1 hosts failed"):
+        update.deploy_machines(
+            [fake_machine(name) for name in ["a", "b", "c"]],
+            max_parallel=1,
+            max_failures=1,
+            build_locally=True,
+        )
+    assert activated == []
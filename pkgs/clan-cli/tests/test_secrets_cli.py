@@ -863,3 +863,75 @@ def test_secrets_key_generate_gpg(
         with capture_output as output:
             cli.run(["secrets", "get", "--flake", str(test_flake.path), "secret-name"])
         assert output.out == "secret-value"
+
+
+def test_secrets_update_keys_batch(
+    test_flake: FlakeForTest,
+    capture_output: CaptureOutput,
+    monkeypatch: pytest.MonkeyPatch,
+    age_keys: list["KeyPair"],
+) -> None:
+    monkeypatch.setenv("SOPS_AGE_KEY", age_keys[0].privkey)
+    flake = str(test_flake.path)
+    cli.run(["secrets", "users", "add", "--flake", flake, "user1", age_keys[0].pubkey])
+    cli.run(
+        ["secrets", "machines", "add", "--flake", flake, "machine1", age_keys[1].pubkey]
+    )
+    monkeypatch.setenv("SOPS_NIX_SECRET", "foo")
+    for secret in ["secret1", "secret2"]:
+        cli.run(["secrets", "set", "--flake", flake, secret])
+        cli.run(
+            ["secrets", "machines", "add-secret", "--flake", flake, "machine1", secret]
+        )
+
+    # rotating the machine key updates both secrets with one sops call
+    cli.run(
+        [
+            "secrets",
+            "machines",
+            "add",
+            "--flake",
+            flake,
+            "-f",
+            "machine1",
+            age_keys[2].pubkey,
+        ]
+    )
+    monkeypatch.setenv("SOPS_AGE_KEY", age_keys[2].privkey)
+    for secret in ["secret1", "secret2"]:
+        with capture_output as output:
+            cli.run(["secrets", "get", "--flake", flake, secret])
+        assert output.out == "foo"
+
+
+def test_update_secrets_skips_up_to_date_recipients(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, age_keys: list["KeyPair"]
+) -> None:
+    from clan_cli.secrets import secrets
+    from clan_cli.secrets.sops import KeyType, write_key
+
+    user_folder = tmp_path / "sops" / "users" / "user1"
+    write_key(user_folder, age_keys[0].pubkey, KeyType.AGE, overwrite=False)
+    for name, recipients in [("uptodate", [age_keys[0].pubkey]), ("outdated", [])]:
+        secret_folder = tmp_path / "sops" / "secrets" / name
+        (secret_folder / "users").mkdir(parents=True)
+        (secret_folder / "users" / "user1").symlink_to(
+            os.path.relpath(user_folder, secret_folder / "users")
+        )
+        sops_attrs = {
+            "age": [{"recipient": recipient} for recipient in recipients],
+            "pgp": None,
+        }
+        (secret_folder / "secret").write_text(json.dumps({"sops": sops_attrs}))
+
+    updated: list[Path] = []
+
+    def update_keys_batch(batch: list[tuple[Path, set]]) -> list[Path]:
+        updated.extend(path for path, _ in batch)
+        return [path / "secret" for path, _ in batch]
+
+    monkeypatch.setattr(secrets, "update_keys_batch", update_keys_batch)
+    changed = secrets.update_secrets(tmp_path)
+    outdated = tmp_path / "sops" / "secrets" / "outdated"
+    assert updated == [outdated]
+    assert changed == [outdated / "secret"]
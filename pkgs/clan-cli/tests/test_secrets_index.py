@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+from clan_cli.secrets import index, secrets, sops
+from clan_cli.secrets.sops import KeyType, write_key
+
+
+def link(path: Path, target: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.symlink_to(os.path.relpath(target, path.parent))
+
+
+def make_secret(path: Path) -> None:
+    path.mkdir(parents=True, exist_ok=True)
+    sops_attrs = {"age": [{"recipient": "age1alice"}], "pgp": None}
+    (path / "secret").write_text(json.dumps({"sops": sops_attrs}))
+
+
+def age(tree: Path) -> None:
+    """Move all mtimes out of the window in which the index does not cache."""
+    old = 1_000_000_000
+    for root, dirs, files in tree.walk(top_down=False):
+        for name in [*files, *dirs]:
+            os.utime(root / name, (old, old), follow_symlinks=False)
+    os.utime(tree, (old, old))
+
+
+@pytest.fixture
+def flake(tmp_path: Path) -> Path:
+    index.clear()
+    sops_dir = tmp_path / "sops"
+    write_key(sops_dir / "users" / "alice", "age1alice", KeyType.AGE, False)
+    write_key(sops_dir / "users" / "bob", "age1bob", KeyType.AGE, False)
+    write_key(sops_dir / "machines" / "m1", "age1m1", KeyType.AGE, False)
+    link(sops_dir / "groups" / "admins" / "users" / "bob", sops_dir / "users" / "bob")
+
+    secret = sops_dir / "secrets" / "s1"
+    make_secret(secret)
+    link(secret / "users" / "alice", sops_dir / "users" / "alice")
+    link(secret / "machines" / "m1", sops_dir / "machines" / "m1")
+    link(secret / "groups" / "admins", sops_dir / "groups" / "admins")
+
+    for var in [
+        "vars/per-machine/m1/gen1/a",
+        "vars/per-machine/m1/gen2/b",
+        "vars/shared/gen3/c",
+    ]:
+        make_secret(tmp_path / var)
+    return tmp_path
+
+
+def test_collect_keys_for_path(flake: Path) -> None:
+    keys = secrets.collect_keys_for_path(flake / "sops" / "secrets" / "s1")
+    assert keys == {
+        ("age1alice", KeyType.AGE),
+        ("age1bob", KeyType.AGE),
+        ("age1m1", KeyType.AGE),
+    }
+    assert secrets.list_secrets(flake) == ["s1"]
+
+
+def test_list_vars_secrets(flake: Path) -> None:
+    assert sorted(secrets.list_vars_secrets(flake)) == [
+        flake / "vars/per-machine/m1/gen1/a",
+        flake / "vars/per-machine/m1/gen2/b",
+        flake / "vars/shared/gen3/c",
+    ]
+
+
+def test_cleanup_dangling_symlinks(flake: Path) -> None:
+    secret = flake / "sops" / "secrets" / "s1"
+    age(flake)
+    assert secrets.cleanup_dangling_symlinks(secret / "machines") == []
+
+    shutil.rmtree(flake / "sops" / "machines" / "m1")
+    assert secrets.cleanup_dangling_symlinks(secret / "machines") == [
+        secret / "machines" / "m1"
+    ]
+    assert not (secret / "machines" / "m1").is_symlink()
+
+
+def test_invalidation(flake: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    users = flake / "sops" / "users"
+    secret = flake / "sops" / "secrets" / "s1"
+    age(flake)
+
+    # listings are reused until the directory changes
+    assert index.list_dir(users) is index.list_dir(users)
+    listing = index.list_dir(users)
+    write_key(users / "carol", "age1carol", KeyType.AGE, False)
+    assert index.list_dir(users) is not listing
+    assert "carol" in index.list_dir(users)
+
+    # parsed files are reused until the file changes
+    reads: list[Path] = []
+    read_key = sops.read_key
+
+    def counting_read_key(path: Path) -> tuple[str, KeyType]:
+        reads.append(path)
+        return read_key(path)
+
+    monkeypatch.setattr(sops, "read_key", counting_read_key)
+    for _ in range(3):
+        secrets.collect_keys_for_path(secret)
+    assert len(reads) == 3
+
+    write_key(users / "alice", "age1alice2", KeyType.AGE, True)
+    assert ("age1alice2", KeyType.AGE) in secrets.collect_keys_for_path(secret)
+    assert len(reads) == 4
@@ -0,0 +1,101 @@
+import json
+import os
+from pathlib import Path
+from typing import IO, Any, Self
+
+import pytest
+from clan_cli.secrets import sops
+from clan_cli.secrets.sops import KeyType, SopsKey
+
+
+def write_secret(path: Path, data: dict, recipients: list[str]) -> None:
+    metadata = {
+        "kms": None,
+        "age": [
+            {
+                "recipient": recipient,
+                "enc": "-----BEGIN AGE ENCRYPTED FILE-----\nYWdl\n-----END AGE ENCRYPTED FILE-----\n",
+            }
+            for recipient in recipients
+        ],
+        "pgp": None,
+        "lastmodified": "2024-01-01T00:00:00Z",
+        "mac": "ENC[AES256_GCM,data:bWFj,type:str]",
+        "version": "3.9.0",
+    }
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "secret").write_text(json.dumps({**data, "sops": metadata}, indent=4))
+
+
+def test_read_sops_metadata(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    recipients = [f"age1recipient{i}" for i in range(50)]
+    # a user value named "sops" must not be mistaken for the metadata
+    data = {"data": "ENC[AES256_GCM,data:eA==]", "nested": {"sops": {"age": []}}}
+    write_secret(tmp_path, data, recipients)
+
+    expected = json.loads((tmp_path / "secret").read_text())["sops"]
+    assert sops.read_sops_metadata(tmp_path / "secret") == expected
+    assert sops.get_recipients(tmp_path) == {
+        SopsKey(recipient, "", KeyType.AGE) for recipient in recipients
+    }
+
+    # the tail grows until it contains all of the metadata
+    monkeypatch.setattr(sops, "SOPS_METADATA_TAIL", 16)
+    assert sops.read_sops_metadata(tmp_path / "secret") == expected
+
+
+def test_read_sops_metadata_invalid(tmp_path: Path) -> None:
+    (tmp_path / "secret").write_text(json.dumps({"data": "plain"}))
+    with pytest.raises(KeyError):
+        sops.get_recipients(tmp_path)
+
+    (tmp_path / "secret").write_text('{"sops": {"age": [')
+    with pytest.raises(json.JSONDecodeError):
+        sops.get_recipients(tmp_path)
+
+
+class CountingReader:
+    def __init__(self, f: IO[bytes]) -> None:
+        self.f = f
+        self.bytes_read = 0
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.f.close()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.f.seek(offset, whence)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_read_sops_metadata_tail(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # a large binary secret, like a backup key or a certificate bundle
+    data = {"data": f"ENC[AES256_GCM,data:{'A' * 4 * 1024 * 1024},type:str]"}
+    write_secret(tmp_path, data, ["age1alice", "age1bob"])
+    secret_file = tmp_path / "secret"
+    expected = json.loads(secret_file.read_text())["sops"]
+
+    readers: list[CountingReader] = []
+    path_open = Path.open
+
+    def counting_open(self: Path, *args: Any, **kwargs: Any) -> CountingReader:
+        reader = CountingReader(path_open(self, *args, **kwargs))
+        readers.append(reader)
+        return reader
+
+    monkeypatch.setattr(Path, "open", counting_open)
+    assert sops.read_sops_metadata(secret_file) == expected
+    monkeypatch.undo()
+
+    # only the tail of the file was read
+    assert len(readers) == 1
+    assert 0 < readers[0].bytes_read <= sops.SOPS_METADATA_TAIL
+    assert secret_file.stat().st_size > 4 * 1024 * 1024
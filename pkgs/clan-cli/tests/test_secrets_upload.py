@@ -1,6 +1,12 @@
-from typing import TYPE_CHECKING
+import hashlib
+import io
+import tarfile
+from pathlib import Path
+from typing import IO, TYPE_CHECKING
 
 import pytest
+from clan_cli.cmd import RunOpts
+from clan_cli.ssh import upload as ssh_upload
 from clan_cli.ssh.host import Host
 from fixtures_flakes import FlakeForTest
 from helpers import cli
@@ -61,3 +67,64 @@ def test_secrets_upload(
 
     assert sops_key.exists()
     assert sops_key.read_text() == age_keys[0].privkey
+
+
+def test_upload_delta(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "data"))
+    # run the remote commands with a local shell
+    host = Host("localhost")
+    monkeypatch.setattr(host, "ssh_cmd", lambda: ["sh", "-c"])
+    inputs: list[bytes | IO[bytes] | None] = []
+    run_local = ssh_upload.run_local
+
+    def run(cmd: list[str], opts: RunOpts) -> object:
+        if opts.input is not None and not isinstance(opts.input, bytes):
+            opts.input = opts.input.read()
+        inputs.append(opts.input)
+        return run_local(cmd, opts)
+
+    monkeypatch.setattr(ssh_upload, "run_local", run)
+
+    src = tmp_path / "src"
+    (src / "activation" / "gen").mkdir(parents=True)
+    (src / "key.txt").write_text("key")
+    (src / "activation" / "gen" / "old").write_text("old")
+    dest = tmp_path / "dest" / "sops-nix"
+    ssh_upload.upload(host, src, dest, file_user="", file_group="", delta=True)
+    assert (dest / "key.txt").read_text() == "key"
+    manifest = (dest / ssh_upload.MANIFEST_NAME).read_text()
+    # the manifest does not contain plain hashes of the secrets
+    assert hashlib.sha256(b"key").hexdigest() not in manifest
+    # the destination is synced in place, it might be a mountpoint
+    inode = dest.stat().st_ino
+
+    # nothing changed, only the manifest is read
+    inputs.clear()
+    ssh_upload.upload(host, src, dest, file_user="", file_group="", delta=True)
+    assert inputs == [None]
+
+    # only the changed file is sent, removed files are removed
+    (src / "activation" / "gen" / "old").unlink()
+    (src / "activation" / "gen" / "new").write_text("new")
+    inputs.clear()
+    ssh_upload.upload(host, src, dest, file_user="", file_group="", delta=True)
+    assert isinstance(inputs[-1], bytes)
+    with tarfile.open(fileobj=io.BytesIO(inputs[-1])) as tar:
+        sent = {member.name for member in tar.getmembers() if member.isfile()}
+    assert sent == {"activation/gen/new", ssh_upload.MANIFEST_NAME}
+    assert not (dest / "activation" / "gen" / "old").exists()
+    assert (dest / "activation" / "gen" / "new").read_text() == "new"
+    assert (dest / "key.txt").read_text() == "key"
+    assert dest.stat().st_ino == inode
+    assert sorted(p.name for p in dest.iterdir()) == [
+        ssh_upload.MANIFEST_NAME,
+        "activation",
+        "key.txt",
+    ]
+
+    # a full upload replaces the content, but not the destination itself
+    (dest / "stale").write_text("stale")
+    ssh_upload.upload(host, src, dest, file_user="", file_group="")
+    assert dest.stat().st_ino == inode
+    assert sorted(p.name for p in dest.iterdir()) == ["activation", "key.txt"]
+    assert (dest / "activation" / "gen" / "new").read_text() == "new"
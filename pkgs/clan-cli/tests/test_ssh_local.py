@@ -1,6 +1,6 @@
 from clan_cli.async_run import AsyncRuntime
 from clan_cli.cmd import ClanCmdTimeoutError, Log, RunOpts
-from clan_cli.ssh.host import Host
+from clan_cli.ssh.host import Host, close_ssh_masters, ssh_control_dir
 
 host = Host("some_host")
 
@@ -47,3 +47,18 @@ def test_run_exception(runtime: AsyncRuntime) -> None:
 def test_run_local_non_shell(runtime: AsyncRuntime) -> None:
     p2 = runtime.async_run(None, host.run_local, ["echo", "1"], RunOpts(log=Log.STDERR))
     assert p2.wait().result.stdout == "1\n"
+
+
+def test_control_master_opts() -> None:
+    control_dir = ssh_control_dir()
+    env = host.nix_ssh_env(None)
+    assert f"ControlPath={control_dir}/%C" in env["NIX_SSHOPTS"]
+    assert "ControlMaster=auto" in host.ssh_cmd()
+    remote_env = host.nix_ssh_env(None, control_master=False)
+    assert "ControlPath" not in remote_env["NIX_SSHOPTS"]
+
+    no_master = Host("some_host", ssh_options={"ControlMaster": "no"})
+    assert "ControlMaster=auto" not in no_master.ssh_cmd()
+
+    close_ssh_masters()
+    assert not control_dir.exists()
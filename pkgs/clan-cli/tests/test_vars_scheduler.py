@@ -0,0 +1,95 @@
+import threading
+from pathlib import Path
+from typing import Any
+
+import pytest
+from clan_cli.errors import ClanError
+from clan_cli.machines.machines import Machine
+from clan_cli.vars import generate
+from clan_cli.vars.generate import Generator
+from fake_machine import FakeMachineFactory
+
+
+class Runs:
+    def __init__(self) -> None:
+        self.events: list[tuple[str, str]] = []
+        self.lock = threading.Lock()
+        # generator name -> function called while the generator runs
+        self.hooks: dict[str, Any] = {}
+
+    def log(self, event: str, name: str) -> None:
+        with self.lock:
+            self.events.append((event, name))
+
+
+@pytest.fixture
+def runs(monkeypatch: pytest.MonkeyPatch) -> Runs:
+    """
+    Replaces everything around the scheduler,
+    generators only record when they start and end.
+    """
+    runs = Runs()
+
+    def fake_execute_generator(
+        machine: Machine, generator: Generator, **kwargs: Any
+    ) -> list[Path]:
+        runs.log("start", generator.name)
+        if hook := runs.hooks.get(generator.name):
+            hook()
+        runs.log("end", generator.name)
+        return []
+
+    monkeypatch.setattr(generate, "_execute_generator", fake_execute_generator)
+    monkeypatch.setattr(generate, "_health_check", lambda machine, generator: None)
+    monkeypatch.setattr(generate, "_check_can_migrate", lambda *args: False)
+    monkeypatch.setattr(generate, "_ask_prompts", lambda generator: {})
+    monkeypatch.setattr(
+        generate,
+        "get_closure",
+        lambda machine, generator_name, regenerate: machine.vars_generators,
+    )
+    return runs
+
+
+def generators(**dependencies: list[str]) -> list[Generator]:
+    return [
+        Generator(name=name, dependencies=deps) for name, deps in dependencies.items()
+    ]
+
+
+def test_dependency_order(runs: Runs, fake_machine: FakeMachineFactory) -> None:
+    machine = fake_machine(vars_generators=generators(c=["b"], b=["a"], a=[]))
+    assert generate.generate_vars([machine], max_workers=4)
+    assert runs.events == [
+        ("start", "a"),
+        ("end", "a"),
+        ("start", "b"),
+        ("end", "b"),
+        ("start", "c"),
+        ("end", "c"),
+    ]
+
+
+def test_independent_generators_in_parallel(
+    runs: Runs, fake_machine: FakeMachineFactory
+) -> None:
+    # every generator waits until all of them are running
+    barrier = threading.Barrier(3, timeout=10)
+    runs.hooks = dict.fromkeys(["a", "b", "c"], barrier.wait)
+    machine = fake_machine(
+        vars_generators=generators(a=[], b=[], c=[], d=["a", "b", "c"])
+    )
+    assert generate.generate_vars([machine], max_workers=3)
+    assert runs.events[-2:] == [("start", "d"), ("end", "d")]
+
+
+def test_failure_stops_dependents(runs: Runs, fake_machine: FakeMachineFactory) -> None:
+    def fail() -> None:
+        msg = "generator a failed"
+        raise ClanError(msg)
+
+    runs.hooks = {"a": fail}
+    machine = fake_machine(vars_generators=generators(a=[], b=["a"], c=["b"]))
+    with pytest.raises(ClanError, match="generator a failed"):
+        generate.generate_vars([machine], max_workers=2)
+    assert runs.events == [("start", "a")]
@@ -0,0 +1,81 @@
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from clan_cli.errors import ClanError
+from clan_cli.vars.secret_modules import sops
+from fake_machine import FakeMachineFactory
+
+
+def make_store(fake_machine: FakeMachineFactory, files: int) -> sops.SecretStore:
+    store = sops.SecretStore.__new__(sops.SecretStore)
+    generator = SimpleNamespace(
+        name="gen",
+        share=False,
+        files=[
+            SimpleNamespace(name=f"file{i}", needed_for="activation", mode=0o440)
+            for i in range(files)
+        ]
+        + [SimpleNamespace(name="disk", needed_for="partitioning", mode=0o400)],
+    )
+    store.machine = fake_machine(vars_generators=[generator])
+    age_key = store.machine.flake_dir / "sops" / "secrets" / "machine1-age.key"
+    age_key.mkdir(parents=True)
+    (age_key / "secret").write_text("{}")
+    return store
+
+
+def test_populate_dir(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, fake_machine: FakeMachineFactory
+) -> None:
+    files = 16
+    store = make_store(fake_machine, files)
+    # the first decrypts wait until the pool is full
+    barrier = threading.Barrier(sops.DECRYPT_WORKERS, timeout=10)
+    lock = threading.Lock()
+    calls = 0
+    running = 0
+    max_running = 0
+
+    def decrypt_secret(flake_dir: Path, secret_path: Path) -> str:
+        nonlocal calls, running, max_running
+        with lock:
+            calls += 1
+            first = calls <= sops.DECRYPT_WORKERS
+            running += 1
+            max_running = max(max_running, running)
+        if first:
+            barrier.wait()
+        with lock:
+            running -= 1
+        return f"value of {secret_path.name}"
+
+    monkeypatch.setattr(sops, "decrypt_secret", decrypt_secret)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    store.populate_dir(output_dir, ["users", "services", "activation", "partitioning"])
+
+    assert (output_dir / "key.txt").read_text() == "value of machine1-age.key"
+    for i in range(files):
+        target = output_dir / "activation" / "gen" / f"file{i}"
+        assert target.read_text() == f"value of file{i}"
+        assert target.stat().st_mode & 0o777 == 0o440
+    assert (output_dir / "gen" / "disk").stat().st_mode & 0o777 == 0o400
+    assert max_running == sops.DECRYPT_WORKERS
+
+
+def test_populate_dir_error(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, fake_machine: FakeMachineFactory
+) -> None:
+    store = make_store(fake_machine, 4)
+
+    def decrypt_secret(flake_dir: Path, secret_path: Path) -> str:
+        if secret_path.name == "file2":
+            msg = f"Could not decrypt {secret_path}"
+            raise ClanError(msg)
+        return "value"
+
+    monkeypatch.setattr(sops, "decrypt_secret", decrypt_secret)
+    with pytest.raises(ClanError, match="file2"):
+        store.populate_dir(tmp_path, ["activation"])